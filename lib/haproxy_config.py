@@ -0,0 +1,778 @@
+"""Compact haproxy configuration model with a streaming parser and writer.
+
+The model mirrors the pyhaproxy objects the charm was written against
+(Configuration, Frontend, Backend, Config, Server, ...) so it can be used
+as a drop in replacement, and renders the same text for the same input.
+Unlike pyhaproxy, sections keep their order in the file, which matters for
+configurations with several defaults sections, and comment lines are kept.
+"""
+import io
+import re
+from abc import ABCMeta, abstractmethod
+from operator import attrgetter
+
+from haproxy_index import ConfigBlock, ConfigIndex
+
+INDENT = "    "
+SECTION_KEYWORDS = ("global", "defaults", "userlist", "listen", "frontend", "backend")
+
+
+class Config:
+    """A generic `<keyword> <value>` line."""
+
+    __slots__ = ("keyword", "value")
+    index_keys = (("config", attrgetter("keyword")),)
+
+    def __init__(self, keyword, value):
+        """Create the line."""
+        self.keyword = keyword
+        self.value = value
+
+    def render(self):
+        """Render the line."""
+        return "{}{} {}\n".format(INDENT, self.keyword, self.value)
+
+
+class Option:
+    """An `option <keyword> <value>` line."""
+
+    __slots__ = ("keyword", "value")
+    index_keys = (("option", attrgetter("keyword")),)
+
+    def __init__(self, keyword, value):
+        """Create the line."""
+        self.keyword = keyword
+        self.value = value
+
+    def render(self):
+        """Render the line."""
+        return "{}option {} {}\n".format(INDENT, self.keyword, self.value)
+
+
+class Bind:
+    """A `bind <host>:<port> <attributes>` line."""
+
+    __slots__ = ("host", "port", "attributes")
+    # Counted so section headers know if they must render an address
+    index_keys = (("bind", attrgetter("port")),)
+
+    def __init__(self, host, port, attributes):
+        """Create the line."""
+        self.host = host
+        self.port = port
+        self.attributes = attributes or []
+
+    def render(self):
+        """Render the line."""
+        return "{}bind {}:{} {}\n".format(
+            INDENT, self.host, self.port, " ".join(self.attributes)
+        )
+
+
+class Acl:
+    """An `acl <name> <value>` line."""
+
+    __slots__ = ("name", "value")
+    index_keys = (("acl", attrgetter("name")),)
+
+    def __init__(self, name, value):
+        """Create the line."""
+        self.name = name
+        self.value = value
+
+    def render(self):
+        """Render the line."""
+        return "{}acl {} {}\n".format(INDENT, self.name, self.value)
+
+
+class Server:
+    """A `server <name> <host>:<port> <attributes>` line."""
+
+    __slots__ = ("name", "host", "port", "attributes")
+    index_keys = (("server", attrgetter("name")),)
+
+    def __init__(self, name, host, port, attributes=()):
+        """Create the line."""
+        self.name = name
+        self.host = host
+        self.port = port
+        self.attributes = [attr.strip() for attr in attributes]
+
+    def render(self):
+        """Render the line."""
+        return "{}server {} {}:{} {}\n".format(
+            INDENT, self.name, self.host, self.port, " ".join(self.attributes)
+        )
+
+
+class UseBackend:
+    """A `use_backend` or `default_backend` line."""
+
+    __slots__ = ("backend_name", "operator", "backend_condition", "is_default")
+    index_keys = (
+        ("use_backend", attrgetter("backend_condition")),
+        ("backend", attrgetter("backend_name")),
+    )
+
+    def __init__(self, backend_name, operator, backend_condition, is_default=False):
+        """Create the line."""
+        self.backend_name = backend_name
+        self.operator = operator
+        self.backend_condition = backend_condition
+        self.is_default = is_default
+
+    def render(self):
+        """Render the line."""
+        return "{}{} {} {} {}\n".format(
+            INDENT,
+            "default_backend" if self.is_default else "use_backend",
+            self.backend_name,
+            self.operator,
+            self.backend_condition,
+        )
+
+
+class User:
+    """A `user` line of a userlist."""
+
+    __slots__ = ("name", "passwd", "passwd_type", "group_names")
+
+    def __init__(self, name, passwd, passwd_type, group_names):
+        """Create the line."""
+        self.name = name
+        self.passwd = passwd
+        self.passwd_type = passwd_type
+        self.group_names = group_names or []
+
+    def render(self):
+        """Render the line."""
+        groups = "groups " + ",".join(self.group_names) if self.group_names else ""
+
+        return "{}user {} {} {} {}\n".format(
+            INDENT, self.name, self.passwd_type, self.passwd, groups
+        )
+
+
+class Group:
+    """A `group` line of a userlist."""
+
+    __slots__ = ("name", "user_names")
+
+    def __init__(self, name, user_names):
+        """Create the line."""
+        self.name = name
+        self.user_names = user_names or []
+
+    def render(self):
+        """Render the line."""
+        users = "users " + ",".join(self.user_names) if self.user_names else ""
+
+        return "{}group {} {}\n".format(INDENT, self.name, users)
+
+
+class Comment:
+    """A comment line, kept verbatim."""
+
+    __slots__ = ("text",)
+
+    def __init__(self, text):
+        """Create the line."""
+        self.text = text
+
+    def render(self):
+        """Render the line."""
+        return self.text + "\n"
+
+
+class Section(metaclass=ABCMeta):
+    """Base for sections holding a config block."""
+
+    __slots__ = ("config_block",)
+
+    def __init__(self, config_block):
+        """Create the section."""
+        self.config_block = ConfigBlock(config_block, self)
+
+    def _find(self, line_type):
+        return [line for line in self.config_block if type(line) is line_type]
+
+    def _add(self, line, line_type):
+        if not isinstance(line, line_type):
+            raise TypeError("{} is only supported".format(line_type.__name__))
+        self.config_block.append(line)
+
+    def _remove(self, line):
+        if line is not None:
+            self.config_block.remove(line)
+
+    @abstractmethod
+    def header(self):
+        """Render the section header."""
+
+    def render(self):
+        """Render the section."""
+        return "\n{}\n{}\n".format(
+            self.header(), "".join(line.render() for line in self.config_block)
+        )
+
+    def __reduce__(self):
+        """Pickle the lines as a plain list, the block is rebuilt on load."""
+        fields = {
+            name: getattr(self, name)
+
+            for cls in type(self).__mro__
+
+            for name in getattr(cls, "__slots__", ())
+
+            if name != "config_block"
+        }
+
+        return (_restore_section, (type(self), fields, list(self.config_block)))
+
+    def options(self):
+        """Return the option lines."""
+        return self._find(Option)
+
+    def option(self, keyword, value):
+        """Return the option line matching keyword and value."""
+        for line in self.config_block.lookup("option", keyword):
+            if line.value == value:
+                return line
+
+    def add_option(self, option):
+        """Add an option line."""
+        self._add(option, Option)
+
+    def remove_option(self, keyword, value):
+        """Remove the option line matching keyword and value."""
+        self._remove(self.option(keyword, value))
+
+    def configs(self):
+        """Return the generic config lines."""
+        return self._find(Config)
+
+    def config(self, keyword, value):
+        """Return the config line matching keyword and value."""
+        for line in self.config_block.lookup("config", keyword):
+            if line.value == value:
+                return line
+
+    def add_config(self, config):
+        """Add a config line."""
+        self._add(config, Config)
+
+    def remove_config(self, keyword, value):
+        """Remove the config line matching keyword and value."""
+        self._remove(self.config(keyword, value))
+
+    def servers(self):
+        """Return the server lines."""
+        return self._find(Server)
+
+    def server(self, name):
+        """Return the server line with name."""
+        return self.config_block.first("server", name)
+
+    def add_server(self, server):
+        """Add a server line."""
+        self._add(server, Server)
+
+    def remove_server(self, name):
+        """Remove the server line with name."""
+        self._remove(self.server(name))
+
+    def binds(self):
+        """Return the bind lines."""
+        return self._find(Bind)
+
+    def bind(self, host, port):
+        """Return the bind line for host and port."""
+        for line in self.binds():
+            if line.host == host and line.port == port:
+                return line
+
+    def add_bind(self, bind):
+        """Add a bind line."""
+        self._add(bind, Bind)
+
+    def remove_bind(self, host, port):
+        """Remove the bind line for host and port."""
+        self._remove(self.bind(host, port))
+
+    def acls(self):
+        """Return the acl lines."""
+        return self._find(Acl)
+
+    def acl(self, name):
+        """Return the acl line with name."""
+        return self.config_block.first("acl", name)
+
+    def add_acl(self, acl):
+        """Add an acl line."""
+        self._add(acl, Acl)
+
+    def remove_acl(self, name):
+        """Remove the acl line with name."""
+        self._remove(self.acl(name))
+
+    def users(self):
+        """Return the user lines."""
+        return self._find(User)
+
+    def user(self, name):
+        """Return the user line with name."""
+        for line in self.users():
+            if line.name == name:
+                return line
+
+    def add_user(self, user):
+        """Add a user line."""
+        self._add(user, User)
+
+    def remove_user(self, name):
+        """Remove the user line with name."""
+        self._remove(self.user(name))
+
+    def groups(self):
+        """Return the group lines."""
+        return self._find(Group)
+
+    def group(self, name):
+        """Return the group line with name."""
+        for line in self.groups():
+            if line.name == name:
+                return line
+
+    def add_group(self, group):
+        """Add a group line."""
+        self._add(group, Group)
+
+    def remove_group(self, name):
+        """Remove the group line with name."""
+        self._remove(self.group(name))
+
+    def usebackends(self):
+        """Return the use_backend and default_backend lines."""
+        return self._find(UseBackend)
+
+    def usebackend(self, name):
+        """Return the use_backend line for backend name."""
+        return self.config_block.first("backend", name)
+
+    def add_usebackend(self, usebackend):
+        """Add a use_backend line."""
+        self._add(usebackend, UseBackend)
+
+    def remove_usebackend(self, name):
+        """Remove the use_backend line for backend name."""
+        self._remove(self.usebackend(name))
+
+
+class Global(Section):
+    """The `global` section."""
+
+    __slots__ = ()
+
+    def header(self):
+        """Render the section header."""
+        return "global"
+
+
+class Defaults(Section):
+    """A `defaults` section."""
+
+    __slots__ = ("name",)
+
+    def __init__(self, name, config_block):
+        """Create the section."""
+        super().__init__(config_block)
+        self.name = name
+
+    def header(self):
+        """Render the section header."""
+        return "defaults {}".format(self.name)
+
+
+class Userlist(Section):
+    """A `userlist` section."""
+
+    __slots__ = ("name",)
+
+    def __init__(self, name, config_block):
+        """Create the section."""
+        super().__init__(config_block)
+        self.name = name
+
+    def header(self):
+        """Render the section header."""
+        return "userlist {}".format(self.name)
+
+
+class Listen(Section):
+    """A `listen` section."""
+
+    __slots__ = ("name", "host", "port")
+
+    def __init__(self, name, host, port, config_block):
+        """Create the section."""
+        super().__init__(config_block)
+        self.name = name
+        self.host = host
+        self.port = port
+
+    def header(self):
+        """Render the section header."""
+        address = ""
+
+        if not self.config_block.total("bind"):
+            address = "{}:{}".format(self.host, self.port)
+
+        return "listen {} {}".format(self.name, address)
+
+
+class Frontend(Listen):
+    """A `frontend` section."""
+
+    __slots__ = ()
+
+    def header(self):
+        """Render the section header."""
+        address = ""
+
+        if not self.config_block.total("bind"):
+            address = "{}:{}".format(self.host, self.port)
+
+        return "frontend {} {}".format(self.name, address)
+
+
+class Backend(Section):
+    """A `backend` section."""
+
+    __slots__ = ("name",)
+
+    def __init__(self, name, config_block):
+        """Create the section."""
+        super().__init__(config_block)
+        self.name = name
+
+    def header(self):
+        """Render the section header."""
+        return "backend {}".format(self.name)
+
+
+class Configuration:
+    """A whole haproxy configuration."""
+
+    __slots__ = (
+        "index",
+        "comments",
+        "defaults",
+        "userlists",
+        "listens",
+        "frontends",
+        "backends",
+        "_globall",
+        "_order",
+    )
+
+    def __init__(self):
+        """Create an empty configuration."""
+        self.index = ConfigIndex(self)
+        self.comments = []
+        self._globall = None
+        self._order = []
+        self.defaults = self.index.section_list([], "defaults", "name")
+        self.userlists = self.index.section_list([], "userlist", "name")
+        self.listens = self.index.section_list([], "listen", "name")
+        self.frontends = self.index.section_list([], "frontend", "port")
+        self.backends = self.index.section_list([], "backend", "name")
+
+    @property
+    def globall(self):
+        """Return the global section."""
+        return self._globall
+
+    @globall.setter
+    def globall(self, section):
+        """Replace the global section."""
+        if self._globall is not None:
+            self.index.detach(self._globall)
+        self._globall = section
+
+        if section is not None:
+            self.index.attach(section, "global")
+
+    def _groups(self):
+        return (
+            [self.globall] if self.globall is not None else [],
+            self.defaults,
+            self.userlists,
+            self.listens,
+            self.frontends,
+            self.backends,
+        )
+
+    def add_section(self, section):
+        """Append a parsed section, keeping its position in the file."""
+        if isinstance(section, Global):
+            self.globall = section
+        elif isinstance(section, Defaults):
+            self.defaults.append(section)
+        elif isinstance(section, Userlist):
+            self.userlists.append(section)
+        elif isinstance(section, Frontend):
+            self.frontends.append(section)
+        elif isinstance(section, Listen):
+            self.listens.append(section)
+        elif isinstance(section, Backend):
+            self.backends.append(section)
+        self._order.append(section)
+
+    def __reduce__(self):
+        """Pickle the comments and sections, the index is rebuilt on load."""
+        return (_restore_configuration, (self.comments, self.sections()))
+
+    def sections(self):
+        """Return every section in rendering order.
+
+        Sections keep their order in the file. Sections added since are
+        placed after the previous section of the same type, or after the
+        sections of the preceding types, which is where pyhaproxy would
+        render them.
+        """
+        groups = self._groups()
+        ranks = {}
+
+        for rank, group in enumerate(groups):
+            for section in group:
+                ranks[id(section)] = rank
+        ordered = [section for section in self._order if id(section) in ranks]
+        placed = {id(section) for section in ordered}
+
+        for rank, group in enumerate(groups):
+            previous = None
+
+            for section in group:
+                if id(section) not in placed:
+                    if previous is not None:
+                        position = ordered.index(previous) + 1
+                    else:
+                        position = 0
+
+                        for number, other in enumerate(ordered):
+                            if ranks[id(other)] < rank:
+                                position = number + 1
+                    ordered.insert(position, section)
+                    placed.add(id(section))
+                previous = section
+        self._order = ordered
+
+        return list(ordered)
+
+
+def _restore_section(section_type, fields, lines):
+    section = section_type.__new__(section_type)
+    Section.__init__(section, lines)
+
+    for name, value in fields.items():
+        setattr(section, name, value)
+
+    return section
+
+
+def _restore_configuration(comments, sections):
+    configuration = Configuration()
+    configuration.comments = list(comments)
+
+    for section in sections:
+        configuration.add_section(section)
+
+    return configuration
+
+
+# Line parsing, the patterns follow the grammar pyhaproxy used so lines are
+# split into the same keyword, value and attribute fields
+_NAME = r"[a-zA-z0-9\-_.:]+"
+_ADDRESS = r"(?P<host>\d+\.\d+\.\d+\.\d+|[a-zA-Z\-.\d]+|\*):?(?P<port>\d*)"
+_VALUE = r"[ \t]*(?P<value>[^#\n]*)"
+_LINE_PATTERNS = (
+    (
+        "server",
+        re.compile(r"server[ \t]+(?P<name>{})[ \t]+{}{}".format(_NAME, _ADDRESS, _VALUE)),
+    ),
+    ("option", re.compile(r"option[ \t]+(?P<keyword>[a-z0-9\-_.]+){}".format(_VALUE))),
+    ("bind", re.compile(r"bind[ \t]+{}{}".format(_ADDRESS, _VALUE))),
+    ("acl", re.compile(r"acl[ \t]+(?P<name>{}){}".format(_NAME, _VALUE))),
+    (
+        "backend",
+        re.compile(
+            r"(?P<type>use_backend|default_backend)[ \t]+(?P<name>{}|%\[[^\]\s]*\])[ \t]*"
+            r"(?P<operator>if|unless)?[ \t]*(?P<condition>[^#\n]*)".format(_NAME)
+        ),
+    ),
+    (
+        "group",
+        re.compile(r"group[ \t]+(?P<name>{})[ \t]*(?:users (?P<users>\S+))?".format(_NAME)),
+    ),
+    (
+        "user",
+        re.compile(
+            r"user[ \t]+(?P<name>{})[ \t]+(?P<type>password|insecure-password)[ \t]+"
+            r"(?P<passwd>[^# \t\n]+)[ \t]*(?:groups (?P<groups>\S+))?".format(_NAME)
+        ),
+    ),
+    (
+        "config",
+        re.compile(
+            r"(?P<keyword>(?:(?:errorfile|timeout)[ \t]+)?[^ \t#\n]+){}".format(_VALUE)
+        ),
+    ),
+)
+_HEADER = re.compile(
+    r"(?P<type>\w+)[ \t]*(?P<name>{})?[ \t]*(?:{})?".format(_NAME, _ADDRESS)
+)
+
+
+def _parse_line(body):
+    """Parse a config block line, body has its indentation removed."""
+    for kind, pattern in _LINE_PATTERNS:
+        match = pattern.match(body)
+
+        if not match:
+            continue
+        fields = match.groupdict()
+
+        if kind == "server":
+            return Server(
+                fields["name"], fields["host"], fields["port"], [fields["value"]]
+            )
+        elif kind == "option":
+            return Option(fields["keyword"], fields["value"])
+        elif kind == "bind":
+            return Bind(fields["host"], fields["port"], [fields["value"]])
+        elif kind == "acl":
+            return Acl(fields["name"], fields["value"])
+        elif kind == "backend":
+            return UseBackend(
+                fields["name"],
+                fields["operator"] or "",
+                fields["condition"],
+                fields["type"] == "default_backend",
+            )
+        elif kind == "group":
+            users = fields["users"]
+
+            return Group(fields["name"], users.split(",") if users else [])
+        elif kind == "user":
+            groups = fields["groups"]
+
+            return User(
+                fields["name"],
+                fields["passwd"],
+                fields["type"],
+                groups.split(",") if groups else [],
+            )
+
+        return Config(fields["keyword"], fields["value"])
+
+
+def _new_section(body):
+    """Create an empty section from its header line."""
+    fields = _HEADER.match(body).groupdict()
+    name = fields["name"] or ""
+
+    if fields["type"] == "global":
+        return Global([])
+    elif fields["type"] == "defaults":
+        return Defaults(name, [])
+    elif fields["type"] == "userlist":
+        return Userlist(name, [])
+    elif fields["type"] == "backend":
+        return Backend(name, [])
+    elif fields["type"] == "listen":
+        return Listen(name, fields["host"] or "", fields["port"] or "", [])
+
+    return Frontend(name, fields["host"] or "", fields["port"] or "", [])
+
+
+def _finish_section(section):
+    """Fill in frontend and listen addresses from their first bind line."""
+    if isinstance(section, Listen) and not section.host and not section.port:
+        binds = section.binds()
+
+        if not binds:
+            raise ValueError(
+                "No host and port for {} {}".format(
+                    type(section).__name__.lower(), section.name
+                )
+            )
+        section.host, section.port = binds[0].host, binds[0].port
+
+
+def parse_lines(lines, configuration=None):
+    """Parse an iterable of config lines into a Configuration.
+
+    Passing a configuration adds the parsed sections to it, so several
+    files can be read into one model.
+    """
+    if configuration is None:
+        configuration = Configuration()
+    section = None
+
+    for line in lines:
+        line = line.rstrip("\n")
+        body = line.lstrip(" \t")
+
+        if not body:
+            continue
+
+        if body.startswith("#"):
+            if section is None:
+                configuration.comments.append(Comment(line))
+            else:
+                section.config_block.append(Comment(line))
+
+            continue
+        keyword = body.split(None, 1)[0]
+
+        if keyword in SECTION_KEYWORDS:
+            if section is not None:
+                _finish_section(section)
+                configuration.add_section(section)
+            section = _new_section(body)
+        elif section is not None:
+            section.config_block.append(_parse_line(body))
+
+    if section is not None:
+        _finish_section(section)
+        configuration.add_section(section)
+
+    return configuration
+
+
+def parse(path, configuration=None):
+    """Parse the config file at path, a missing file is an empty config."""
+    try:
+        with open(path) as cfg_file:
+            return parse_lines(cfg_file, configuration)
+    except FileNotFoundError:
+        return configuration or Configuration()
+
+
+def parse_string(text, configuration=None):
+    """Parse config text."""
+    return parse_lines(io.StringIO(text), configuration)
+
+
+def render(configuration):
+    """Render a Configuration to text."""
+    parts = [comment.render() for comment in configuration.comments]
+    parts.extend(section.render() for section in configuration.sections())
+
+    return "".join(parts)
+
+
+def dump(configuration, path):
+    """Write a Configuration to path."""
+    with open(path, "w") as cfg_file:
+        cfg_file.write(render(configuration))
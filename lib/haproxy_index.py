@@ -0,0 +1,381 @@
+"""Lookup tables kept in step with a parsed haproxy configuration."""
+from operator import attrgetter
+
+
+class ConfigBlock(list):
+    """Config block of a section that indexes its lines by kind and key.
+
+    Line classes list the keys they are indexed under in an index_keys
+    class attribute, as (kind, key getter) pairs. The tables are built on
+    the first lookup, so blocks that are never searched cost nothing.
+    """
+
+    __slots__ = ("section", "index", "_lines", "_totals")
+
+    def __init__(self, lines=(), section=None, index=None):
+        """Create the block, its lookup tables are built when first needed."""
+        super().__init__(lines)
+        self.section = section
+        self.index = None
+        self._lines = None
+        self._totals = None
+
+        if index is not None:
+            self.attach(section, index)
+
+    @staticmethod
+    def _keys(line):
+        for kind, getter in getattr(type(line), "index_keys", ()):
+            yield kind, getter(line)
+
+    def _build(self):
+        """Build the lookup tables if they haven't been yet."""
+        if self._lines is None:
+            self._lines = {}
+            self._totals = {}
+
+            for line in self:
+                self._count(line, 1)
+
+    def _live(self):
+        return self.index is not None and self.index.live
+
+    def _count(self, line, delta):
+        """Update the tables for a line, returning the keys it is under."""
+        keys = list(self._keys(line))
+
+        for kind, key in keys:
+            lines = self._lines.setdefault(kind, {}).setdefault(key, {})
+
+            if delta > 0:
+                lines[id(line)] = line
+            else:
+                del lines[id(line)]
+
+                if not lines:
+                    del self._lines[kind][key]
+            self._totals[kind] = self._totals.get(kind, 0) + delta
+
+        return keys
+
+    def _track(self, line, delta):
+        # Nothing to update until the tables are built
+        if self._lines is None:
+            return
+        keys = self._count(line, delta)
+
+        if self._live():
+            for kind, key in keys:
+                self.index._track(kind, key, self.section, delta)
+
+    def _reindex(self):
+        if self._live():
+            self._report(-1)
+            self._lines = None
+            self._build()
+            self._report(1)
+        else:
+            self._lines = None
+
+    def _report(self, delta):
+        self._build()
+
+        for kind, keys in self._lines.items():
+            for key, lines in keys.items():
+                self.index._track(kind, key, self.section, delta * len(lines))
+
+    def attach(self, section, index):
+        """Start reporting this block's lines to a configuration index."""
+        self.detach()
+        self.section = section
+        self.index = index
+
+        if self._live():
+            self._report(1)
+
+    def detach(self):
+        """Stop reporting this block's lines to the configuration index."""
+        if self._live():
+            self._report(-1)
+        self.index = None
+
+    def lookup(self, kind, key):
+        """Return the lines of the given kind matching key, in block order."""
+        self._build()
+
+        return list(self._lines.get(kind, {}).get(key, {}).values())
+
+    def first(self, kind, key):
+        """Return the first line of the given kind matching key, or None."""
+        self._build()
+
+        for line in self._lines.get(kind, {}).get(key, {}).values():
+            return line
+
+        return None
+
+    def total(self, kind):
+        """Return the number of lines of the given kind."""
+        self._build()
+
+        return self._totals.get(kind, 0)
+
+    def append(self, line):
+        """Append a line and index it."""
+        super().append(line)
+        self._track(line, 1)
+
+    def extend(self, lines):
+        """Append several lines and index them."""
+        for line in lines:
+            self.append(line)
+
+    def __iadd__(self, lines):
+        """Append several lines and index them."""
+        self.extend(lines)
+
+        return self
+
+    def remove(self, line):
+        """Remove the first occurrence of a line and drop it from the index."""
+        super().remove(line)
+        self._track(line, -1)
+
+    def pop(self, position=-1):
+        """Remove and return the line at position."""
+        line = super().pop(position)
+        self._track(line, -1)
+
+        return line
+
+    def clear(self):
+        """Remove every line."""
+        super().clear()
+        self._reindex()
+
+    def insert(self, position, line):
+        """Insert a line at position and rebuild the index to keep block order."""
+        super().insert(position, line)
+        self._reindex()
+
+    def __setitem__(self, position, value):
+        """Replace lines and rebuild the index."""
+        super().__setitem__(position, value)
+        self._reindex()
+
+    def __delitem__(self, position):
+        """Delete lines and rebuild the index."""
+        super().__delitem__(position)
+        self._reindex()
+
+    def sort(self, *args, **kwargs):
+        """Sort the lines and rebuild the index."""
+        super().sort(*args, **kwargs)
+        self._reindex()
+
+    def reverse(self):
+        """Reverse the lines and rebuild the index."""
+        super().reverse()
+        self._reindex()
+
+
+class SectionList(list):
+    """List of sections of one type indexed by a key such as port or name."""
+
+    __slots__ = ("index", "role", "key", "_by_key")
+
+    def __init__(self, sections, index, role, key):
+        """Attach each section to the index and build the key table."""
+        super().__init__(sections)
+        self.index = index
+        self.role = role
+        self.key = key
+        self._by_key = {}
+
+        for section in self:
+            self.index.attach(section, self.role)
+        self._rebuild()
+
+    def _rebuild(self):
+        self._by_key = {}
+
+        for section in self:
+            self._by_key.setdefault(self.key(section), []).append(section)
+
+    def _sync(self, previous):
+        """Detach sections that left the list and attach the new ones."""
+        current = {id(section): section for section in self}
+
+        for section in previous:
+            if id(section) not in current:
+                self.index.detach(section)
+        previous_ids = {id(section) for section in previous}
+
+        for section in self:
+            if id(section) not in previous_ids:
+                self.index.attach(section, self.role)
+        self._rebuild()
+
+    def lookup(self, key):
+        """Return the sections matching key, in list order."""
+        sections = self._by_key.get(key, [])
+
+        # Keys such as a frontend port can be changed in place, rebuild
+        # the table if a hit no longer matches so the lookup stays accurate
+        if any(self.key(section) != key for section in sections):
+            self._rebuild()
+            sections = self._by_key.get(key, [])
+
+        return list(sections)
+
+    def append(self, section):
+        """Append a section and index it."""
+        super().append(section)
+        self.index.attach(section, self.role)
+        self._by_key.setdefault(self.key(section), []).append(section)
+
+    def extend(self, sections):
+        """Append several sections and index them."""
+        for section in sections:
+            self.append(section)
+
+    def __iadd__(self, sections):
+        """Append several sections and index them."""
+        self.extend(sections)
+
+        return self
+
+    def remove(self, section):
+        """Remove a section and drop it from the index."""
+        previous = list(self)
+        super().remove(section)
+        self._sync(previous)
+
+    def pop(self, position=-1):
+        """Remove and return the section at position."""
+        previous = list(self)
+        section = super().pop(position)
+        self._sync(previous)
+
+        return section
+
+    def clear(self):
+        """Remove every section."""
+        previous = list(self)
+        super().clear()
+        self._sync(previous)
+
+    def insert(self, position, section):
+        """Insert a section at position."""
+        previous = list(self)
+        super().insert(position, section)
+        self._sync(previous)
+
+    def __setitem__(self, position, value):
+        """Replace sections, e.g. filtering with a slice assignment."""
+        previous = list(self)
+        super().__setitem__(position, value)
+        self._sync(previous)
+
+    def __delitem__(self, position):
+        """Delete sections."""
+        previous = list(self)
+        super().__delitem__(position)
+        self._sync(previous)
+
+    def sort(self, *args, **kwargs):
+        """Sort the sections and rebuild the key table."""
+        super().sort(*args, **kwargs)
+        self._rebuild()
+
+    def reverse(self):
+        """Reverse the sections and rebuild the key table."""
+        super().reverse()
+        self._rebuild()
+
+
+class ConfigIndex:
+    """Index over a haproxy configuration.
+
+    Sections are indexed by their SectionList (frontends by port, the
+    others by name) and the lines of every section by kind and key, so
+    lookups don't need to scan the configuration. Adding or removing
+    sections and lines through the usual list and section calls keeps
+    the index consistent. The table of sections owning each line is built
+    on its first use, after which blocks report their changes to it.
+    """
+
+    def __init__(self, configuration):
+        """Create an empty index for the configuration."""
+        self.configuration = configuration
+        self.live = False
+        self._sections = {}
+        self._owners = {}
+
+    def section_list(self, sections, role, key):
+        """Return an indexed list of sections."""
+        return SectionList(sections, self, role, attrgetter(key))
+
+    def attach(self, section, role):
+        """Index a section and its config block."""
+        self._sections[id(section)] = (section, role)
+
+        if isinstance(section.config_block, ConfigBlock):
+            section.config_block.attach(section, self)
+        else:
+            section.config_block = ConfigBlock(section.config_block, section, self)
+
+    def detach(self, section):
+        """Remove a section from the index."""
+        self._sections.pop(id(section), None)
+
+        if isinstance(section.config_block, ConfigBlock):
+            section.config_block.detach()
+
+    def _track(self, kind, key, section, delta):
+        owners = self._owners.setdefault((kind, key), {})
+        entry = owners.setdefault(id(section), [section, 0])
+        entry[1] += delta
+
+        if entry[1] <= 0:
+            del owners[id(section)]
+
+            if not owners:
+                del self._owners[(kind, key)]
+
+    def frontend(self, port):
+        """Return the first frontend for port, or None."""
+        frontends = self.configuration.frontends.lookup(port)
+
+        return frontends[0] if frontends else None
+
+    def backend(self, name):
+        """Return the last backend with name, or None."""
+        backends = self.configuration.backends.lookup(name)
+
+        return backends[-1] if backends else None
+
+    def _go_live(self):
+        if not self.live:
+            self.live = True
+
+            for section, role in self._sections.values():
+                section.config_block._report(1)
+
+    def owners(self, kind, key, role=None):
+        """Return the sections holding a line of the given kind and key."""
+        self._go_live()
+        sections = [
+            section for section, count in self._owners.get((kind, key), {}).values()
+        ]
+
+        if role is not None:
+            sections = [
+                section
+
+                for section in sections
+
+                if self._sections.get(id(section), (None, None))[1] == role
+            ]
+
+        return sections
@@ -0,0 +1,274 @@
+"""Client for the haproxy runtime API on the admin stats socket.
+
+The client switches the socket to prompt mode, so one connection can be
+kept open for the whole hook and several commands can be written at once,
+each answer being read back up to the prompt that follows it.
+"""
+import base64
+import re
+import socket
+
+PROMPT = b"\n> "
+# Answers of set and del commands that mean the command wasn't applied,
+# successful ones are empty or say what was changed
+ERROR = re.compile(
+    r"^(No such|Require|Unknown|Permission denied|Invalid|Can't|Failed|Out of memory"
+    r"|Entry not found|Key not found|'.*' expects)",
+    re.IGNORECASE,
+)
+
+
+class RuntimeAPIError(Exception):
+    """The runtime API couldn't be reached or gave an unexpected answer."""
+
+
+def _value(text):
+    """Return text as an int if it is one."""
+    try:
+        return int(text)
+    except ValueError:
+        return text
+
+
+def parse_info(text):
+    """Parse `show info` output into a dict."""
+    info = {}
+
+    for line in text.splitlines():
+        name, sep, value = line.partition(":")
+
+        if sep:
+            info[name.strip()] = _value(value.strip())
+
+    return info
+
+
+def parse_stat(text):
+    """Parse `show stat` CSV output into a list of dicts, one per proxy line."""
+    lines = text.splitlines()
+
+    if not lines or not lines[0].startswith("# "):
+        raise RuntimeAPIError("Unexpected show stat output: {!r}".format(text[:80]))
+    # Lines end with a comma, so the last field is an empty name
+    fields = lines[0][2:].split(",")
+
+    return [
+        {
+            name: _value(value)
+            for name, value in zip(fields, line.split(","))
+            if name
+        }
+        for line in lines[1:]
+        if line
+    ]
+
+
+def parse_servers_state(text):
+    """Parse `show servers state` output into a list of dicts, one per server."""
+    lines = text.splitlines()
+
+    if len(lines) < 2 or not lines[1].startswith("# "):
+        raise RuntimeAPIError(
+            "Unexpected show servers state output: {!r}".format(text[:80])
+        )
+    fields = lines[1][2:].split()
+
+    return [
+        dict(zip(fields, (_value(value) for value in line.split())))
+        for line in lines[2:]
+        if line and not line.startswith("#")
+    ]
+
+
+class RuntimeAPI:
+    """Connection to the haproxy runtime API.
+
+    The socket is opened on the first command and kept open until close is
+    called, it is opened again by the next command. If haproxy closed it in
+    between, for example on a timeout, it is opened again before the
+    commands are sent. After a reload the old worker keeps the connection,
+    so it has to be closed to reach the new one.
+    """
+
+    def __init__(self, path, timeout=10):
+        """Create the client for the socket at path."""
+        self.path = path
+        self.timeout = timeout
+        self._socket = None
+        self._buffer = b""
+
+    def __enter__(self):
+        """Return the client."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Close the connection."""
+        self.close()
+
+    def _connect(self):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(self.timeout)
+
+        try:
+            connection.connect(self.path)
+            connection.sendall(b"prompt\n")
+            self._socket = connection
+            self._buffer = b""
+            self._read()
+        except OSError as error:
+            connection.close()
+            self._socket = None
+            raise RuntimeAPIError(
+                "Can't connect to {}: {}".format(self.path, error)
+            ) from error
+
+    def _read(self):
+        """Read the answer to one command, up to the next prompt."""
+        # Every answer, even an empty one, is followed by a blank line and
+        # the prompt
+        while True:
+            end = self._buffer.find(PROMPT)
+
+            if end >= 0:
+                answer = self._buffer[:end]
+                self._buffer = self._buffer[end + len(PROMPT):]
+
+                return answer.decode("utf-8", "replace")
+            data = self._socket.recv(65536)
+
+            if not data:
+                raise ConnectionError("Connection closed by haproxy")
+            self._buffer += data
+
+    def close(self):
+        """Close the connection if it is open."""
+        if self._socket is not None:
+            try:
+                self._socket.sendall(b"quit\n")
+            except OSError:
+                pass
+            self._socket.close()
+            self._socket = None
+
+    def execute(self, *commands):
+        """Run commands in one write and return their answers in order.
+
+        A command ending its first line with `<<` is followed by its payload
+        on the next lines, which mustn't be empty as that ends the payload.
+        """
+        request = ""
+
+        for command in commands:
+            first, _, payload = command.partition("\n")
+
+            if payload and not first.endswith("<<") or "\n\n" in command:
+                raise ValueError("Command {!r} spans lines".format(command))
+            request += command + ("\n\n" if payload else "\n")
+        request = request.encode("utf-8")
+
+        for attempt in (1, 2):
+            if self._socket is None:
+                self._connect()
+
+            answers = []
+
+            try:
+                self._socket.sendall(request)
+
+                for _ in commands:
+                    answers.append(self._read())
+
+                return answers
+            except OSError as error:
+                self._socket.close()
+                self._socket = None
+
+                # Only retry when haproxy dropped an idle connection before
+                # running anything, commands aren't safe to run twice
+                if attempt == 2 or answers or not isinstance(error, ConnectionError):
+                    raise RuntimeAPIError(
+                        "Runtime API error on {}: {}".format(self.path, error)
+                    ) from error
+
+    def run(self, *commands):
+        """Run commands changing the state of haproxy, failing on an error answer.
+
+        Returns the answers, RuntimeAPIError is raised after all commands
+        have been run if any of them failed.
+        """
+        answers = self.execute(*commands)
+        errors = [
+            "{}: {}".format(command, answer.strip())
+            for command, answer in zip(commands, answers)
+            if ERROR.match(answer)
+        ]
+
+        if errors:
+            raise RuntimeAPIError("; ".join(errors))
+
+        return answers
+
+    def command(self, command):
+        """Run a single command and return its answer."""
+        return self.execute(command)[0]
+
+    def version(self):
+        """Return the major and minor version of the running haproxy."""
+        version = str(self.show_info().get("Version", ""))
+
+        try:
+            return tuple(int(part) for part in version.split(".")[:2])
+        except ValueError as error:
+            raise RuntimeAPIError("Unknown version {!r}".format(version)) from error
+
+    def set_ssl_cert(self, path, pem):
+        """Replace the certificate loaded from path with pem, needs haproxy 2.2.
+
+        The change is aborted if it can't be committed.
+        """
+        payload = "\n".join(line for line in pem.splitlines() if line.strip())
+        self.run("set ssl cert {} <<\n{}".format(path, payload))
+        answer = self.command("commit ssl cert {}".format(path))
+
+        if "Success!" not in answer:
+            self.command("abort ssl cert {}".format(path))
+            raise RuntimeAPIError(
+                "commit ssl cert {}: {}".format(path, answer.strip())
+            )
+
+    def set_ocsp_response(self, response):
+        """Replace the OCSP response stapled for the cert it was issued for.
+
+        haproxy only takes responses for certs that it loaded one for.
+        """
+        answer = self.command(
+            "set ssl ocsp-response {}".format(base64.b64encode(response).decode("ascii"))
+        )
+
+        if "updated" not in answer:
+            raise RuntimeAPIError("set ssl ocsp-response: {}".format(answer.strip()))
+
+    def show_info(self):
+        """Return the process information as a dict."""
+        return parse_info(self.command("show info"))
+
+    def show_stat(self, selection=None):
+        """Return the statistics of every proxy, server and listener.
+
+        selection is the `<proxy> <type> <server>` filter of show stat.
+        """
+        command = "show stat"
+
+        if selection:
+            command += " " + selection
+
+        return parse_stat(self.command(command))
+
+    def show_servers_state(self, backend=None):
+        """Return the state of the servers, of one backend if given."""
+        command = "show servers state"
+
+        if backend:
+            command += " " + backend
+
+        return parse_servers_state(self.command(command))
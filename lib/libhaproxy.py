@@ -1,30 +1,257 @@
 """Helper module for haproxy."""
+import atexit
+import glob
+import hashlib
+import math
+import os
+import pickle
 import re
+import shutil
 import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
 from distutils.version import StrictVersion
 
-import pyhaproxy.config as haproxy_config
-import reactive.letsencrypt as letsencrypt
-from charmhelpers.core import hookenv, host
+import haproxy_config
+from charmhelpers.core import hookenv, host, unitdata
 from charms import layer
-from crontab import CronTab
-from pyhaproxy.parse import Parser
-from pyhaproxy.render import Render
+
+
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40, "CRITICAL": 50}
+# Server slots are `server slot<N>` lines while bound to a unit and part of
+# a `server-template slot <first>-<last>` line while free
+SLOT_NAME = re.compile(r"^slot(\d+)$")
+SLOT_TEMPLATE = re.compile(r"^slot (\d+)-(\d+) (\S+) disabled ?(.*)$")
+# Sample fetches looking up the backend of a request in a map file, in the
+# order of their use_backend rules. The host is matched by prefix, the path
+# like the path and path_beg acls: the bare urlbase exactly and anything
+# below it by the prefix <urlbase>/, both from the start of the path
+MAP_FETCHES = {
+    "host": "req.hdr(host),lower,map_beg({})",
+    "exact": "path,map({})",
+    "path": "path,map_beg({})",
+}
+MAP_ORDER = ("host", "exact", "path")
+# Unit state describing what the config holds, restored along with the
+# config when a changed config fails its check
+CONFIG_STATE = (
+    "haproxy.maps",
+    "haproxy.slots",
+    "haproxy.bind_options",
+    "haproxy.routes.applied",
+)
+# Memory used by a connection besides its two buffers: the session, the
+# client and server connections and their SSL contexts
+CONNECTION_OVERHEAD = 36 * 1024
+# Descriptors kept for listeners, health checks, logs and the runtime API
+RESERVED_FILES = 1000
+# Bind options set by the charm, the listener options and the threads a
+# bind line accepts connections on. Parsed bind attributes are a single
+# string with every option
+BIND_MANAGED = re.compile(
+    r"(?:^|\s)(?:process \S+|thread \S+|backlog \d+|tfo|defer-accept)(?=\s|$)"
+)
+# First and last haproxy versions with the features the charm uses, None
+# where there is no bound
+CAPABILITIES = {
+    "threads": ("1.8", None),
+    "master-worker": ("1.8", None),
+    "http2": ("1.9", None),
+    "server-template": ("1.8", None),
+    "dynamic-cookie": ("1.8", None),
+    "reqrep": (None, "2.0"),
+    "ssl-cert-update": ("2.2", None),
+    "bind-thread": ("2.4", None),
+}
+# Versions the charm can install from the PPAs by series
+SUPPORTED_VERSIONS = {
+    "xenial": ("1.7",),
+    "bionic": ("1.8", "1.9", "2.0", "2.2", "2.4"),
+    "focal": ("2.0", "2.2", "2.4"),
+}
+
+
+class HookLog:
+    """Log facade that batches juju-log calls.
+
+    Every juju-log call is a process, so records below the threshold are
+    dropped, DEBUG and INFO records are buffered and written in a few
+    calls when the process exits, and WARNING and above are written
+    straight away after anything buffered before them.
+    """
+
+    # Keep each juju-log call well within the argument size limit
+    batch_size = 32768
+
+    def __init__(self, threshold=None):
+        """Create the log, the threshold defaults to the log-level config."""
+        self.threshold = threshold
+        self._records = []
+        self._registered = False
+
+    def __call__(self, message, level="INFO"):
+        """Log a message at level."""
+        level = (level or "INFO").upper()
+
+        if level == "WARN":
+            level = "WARNING"
+
+        if self.threshold is None:
+            self.threshold = hookenv.config().get("log-level", "INFO").upper()
+
+        if LOG_LEVELS.get(level, 20) < LOG_LEVELS.get(self.threshold, 20):
+            return
+
+        if LOG_LEVELS.get(level, 20) >= LOG_LEVELS["WARNING"]:
+            self.flush()
+            hookenv.log(message, level)
+
+            return
+        self._records.append((level, message))
+
+        # Written even if the hook fails, so the records leading up to
+        # the error aren't lost
+        if not self._registered:
+            atexit.register(self.flush)
+            self._registered = True
+
+    def flush(self):
+        """Write the buffered records in as few calls as possible.
+
+        Each call is logged at the highest level it holds, lines of a lower
+        level are prefixed with their own.
+        """
+        records, self._records = self._records, []
+
+        while records:
+            size = 0
+            count = 0
+
+            while count < len(records) and size < self.batch_size:
+                size += len(records[count][1])
+                count += 1
+            batch, records = records[:count], records[count:]
+            level = max((level for level, _ in batch), key=LOG_LEVELS.get)
+            hookenv.log(
+                "\n".join(
+                    message if record_level == level else record_level + ": " + message
+                    for record_level, message in batch
+                ),
+                level,
+            )
+
+
+log = HookLog()
 
 
 class ProxyHelper:
     """Helper class for configuring haproxy."""
 
     def __init__(self):
-        """Instantiate variables."""
-        self.charm_config = hookenv.config()
-        self.letsencrypt_config = layer.options("letsencrypt")
+        """Instantiate variables.
+
+        Nothing is read from juju here, the helper is created when the
+        reactive module is imported even if no handler uses it.
+        """
+        self._charm_config = None
+        self._letsencrypt_config = None
+        self._cert_file = None
+        self._opened_ports = None
+        self._runtime = None
+        self._haproxy_version = None
         # self.ppa = "ppa:vbernat/haproxy-{}".format(self.charm_config["version"])
         self.proxy_config_file = "/etc/haproxy/haproxy.cfg"
+        self.proxy_config_dir = "/etc/haproxy/conf.d"
+        self.service_dropin_dir = "/etc/systemd/system/haproxy.service.d"
+        self.map_dir = "/etc/haproxy/maps"
+        self.proc_dir = "/proc"
+        self.cgroup_dir = "/sys/fs/cgroup"
+        self.sysctl_file = "/etc/sysctl.d/60-haproxy-charm.conf"
+        self.config_cache_file = os.path.join(
+            hookenv.charm_dir() or ".", ".haproxy-config.cache"
+        )
         self._proxy_config = None
-        self.domain_name = self.charm_config["letsencrypt-domains"].split(",")[0]
+        self._transaction_depth = 0
+        self._pending_save = False
+        self._pending_reload = False
         self.ssl_path = "/etc/haproxy/ssl/"
-        self.cert_file = self.ssl_path + self.domain_name + ".pem"
+
+    @property
+    def charm_config(self):
+        """Return the charm configuration, read on first use."""
+        if self._charm_config is None:
+            self._charm_config = hookenv.config()
+
+        return self._charm_config
+
+    @property
+    def letsencrypt_config(self):
+        """Return the letsencrypt layer options, read on first use."""
+        if self._letsencrypt_config is None:
+            self._letsencrypt_config = layer.options("letsencrypt")
+
+        return self._letsencrypt_config
+
+    @property
+    def domain_name(self):
+        """Return the first letsencrypt domain."""
+        return self.charm_config["letsencrypt-domains"].split(",")[0]
+
+    @property
+    def cert_file(self):
+        """Return the path of the combined certificate."""
+        return self._cert_file or self.ssl_path + self.domain_name + ".pem"
+
+    @cert_file.setter
+    def cert_file(self, path):
+        """Override the path of the combined certificate."""
+        self._cert_file = path
+
+    def haproxy_version(self):
+        """Return the major.minor version of the installed haproxy.
+
+        The version config is used until haproxy is installed.
+        """
+        if self._haproxy_version is None:
+            try:
+                output = subprocess.check_output(["haproxy", "-v"], stderr=subprocess.STDOUT)
+            except (subprocess.CalledProcessError, OSError):
+                output = None
+            match = re.search(rb"version (\d+\.\d+)", output or b"")
+
+            if match:
+                self._haproxy_version = match.group(1).decode("ascii")
+
+        return self._haproxy_version or str(self.charm_config.get("version"))
+
+    def reset_version(self):
+        """Detect the version again, after haproxy is installed or upgraded."""
+        self._haproxy_version = None
+
+    def supports(self, capability, version=None):
+        """Check if haproxy has a capability, at the installed version by default."""
+        first, last = CAPABILITIES[capability]
+        version = StrictVersion(version or self.haproxy_version())
+
+        if first is not None and version < StrictVersion(first):
+            return False
+
+        return last is None or version <= StrictVersion(last)
+
+    def server_slots(self):
+        """Return the server slots to reserve, 0 if haproxy can't use them.
+
+        Slots are server-template lines with dynamic cookies.
+        """
+        slots = self.charm_config.get("server-slots") or 0
+
+        if slots and not (self.supports("server-template") and self.supports("dynamic-cookie")):
+            log("server-slots needs HAProxy 1.8, adding servers without slots", "WARNING")
+
+            return 0
+
+        return slots
 
     @property
     def ppa(self):
@@ -36,29 +263,998 @@ class ProxyHelper:
     def proxy_config(self):
         """Parse and return proxy configuration."""
         if not self._proxy_config:
-            self._proxy_config = Parser(self.proxy_config_file).build_configuration()
+            self._proxy_config = self._load_config()
 
         return self._proxy_config
 
+    def _config_paths(self):
+        """Return the config files haproxy loads, in load order."""
+        if self.fragments_active():
+            return sorted(glob.glob(os.path.join(self.proxy_config_dir, "*.cfg")))
+
+        return [self.proxy_config_file]
+
+    def _load_config(self):
+        """Load the config from the cache, parsing it if the files changed."""
+        paths = self._config_paths()
+        key = self._cache_key(dict.fromkeys(paths))
+        try:
+            with open(self.config_cache_file, "rb") as cache_file:
+                if pickle.load(cache_file) == key:
+                    log("Using cached config", "DEBUG")
+
+                    return pickle.load(cache_file)
+        except FileNotFoundError:
+            pass
+        except Exception as error:
+            log("Ignoring config cache: {}".format(error), "DEBUG")
+        configuration = haproxy_config.Configuration()
+
+        for path in paths:
+            haproxy_config.parse(path, configuration)
+        self._save_cache(key, configuration)
+
+        return configuration
+
+    def _cache_key(self, fingerprints):
+        """Return the cache key for config files, given by path to sha256.
+
+        Missing fingerprints are read from the files. The key also changes
+        when the model code does, so a charm upgrade doesn't load old
+        objects.
+        """
+        key = [os.stat(haproxy_config.__file__).st_mtime_ns]
+
+        for path, fingerprint in sorted(fingerprints.items()):
+            if fingerprint is None:
+                try:
+                    with open(path, "rb") as cfg_file:
+                        fingerprint = hashlib.sha256(cfg_file.read()).hexdigest()
+                except FileNotFoundError:
+                    pass
+            key.append([path, self._file_state(path, fingerprint)])
+
+        return key
+
+    def _save_cache(self, key, configuration):
+        """Store the parsed config for the next hook or action.
+
+        The config holds the stats password, so the cache is only readable
+        by root.
+        """
+        try:
+            self._replace_file(
+                self.config_cache_file,
+                pickle.dumps(key, pickle.HIGHEST_PROTOCOL)
+                + pickle.dumps(configuration, pickle.HIGHEST_PROTOCOL),
+                mode=0o600,
+            )
+        except (OSError, pickle.PicklingError) as error:
+            log("Could not write config cache: {}".format(error), "DEBUG")
+
+    @property
+    def proxy_index(self):
+        """Return the lookup index over the proxy configuration."""
+        return self.proxy_config.index
+
+    @property
+    def runtime_socket(self):
+        """Return the path of the admin stats socket from the global section."""
+        globall = self.proxy_config.globall
+
+        if globall is not None:
+            for config in globall.config_block.lookup("config", "stats"):
+                if config.value.startswith("socket "):
+                    return config.value.split()[1]
+
+        return "/run/haproxy/admin.sock"
+
+    @property
+    def runtime(self):
+        """Return the runtime API client, connected once for the whole hook."""
+        if self._runtime is None:
+            import haproxy_runtime
+
+            self._runtime = haproxy_runtime.RuntimeAPI(self.runtime_socket)
+            atexit.register(self._runtime.close)
+
+        return self._runtime
+
+    def fragments_active(self):
+        """Check if haproxy is loading its config from the fragment directory."""
+        return os.path.exists(self._service_dropin_path("config-fragments"))
+
+    def fragments_supported(self):
+        """Check if the config can be split into fragment files.
+
+        The defaults section goes to the first file, so with more than one
+        a proxy would no longer get the defaults in front of it.
+        """
+        return len(self.proxy_config.defaults) <= 1
+
+    def fragment_name(self, section):
+        """Return the name of the fragment file a section is written to.
+
+        Files are loaded in lexical order, so global and defaults go first
+        and every relation backend has a file of its own.
+        """
+        if isinstance(section, haproxy_config.Backend):
+            if section.name == "redirect":
+                return "30-redirect.cfg"
+
+            if section.name == "letsencrypt-backend":
+                return "30-letsencrypt.cfg"
+
+            return "40-backend-{}.cfg".format(section.name)
+
+        if isinstance(section, haproxy_config.Frontend):
+            if section.name == "stats":
+                return "20-stats.cfg"
+
+            return "10-frontends.cfg"
+
+        return "00-base.cfg"
+
+    def render_fragments(self):
+        """Render the configuration as fragment files, by path."""
+        fragments = {
+            "00-base.cfg": [
+                comment.render() for comment in self.proxy_config.comments
+            ]
+        }
+
+        for section in self.proxy_config.sections():
+            fragments.setdefault(self.fragment_name(section), []).append(
+                section.render()
+            )
+
+        return {
+            os.path.join(self.proxy_config_dir, name): "".join(parts).encode("utf-8")
+            for name, parts in fragments.items()
+        }
+
+    def enable_fragments(self):
+        """Split the config into fragment files and load haproxy from them."""
+        if self.fragments_active():
+            return
+
+        if not self.fragments_supported():
+            log("config-fragments needs a single defaults section, keeping one file", "WARNING")
+
+            return
+        log("Moving config to {}".format(self.proxy_config_dir), "INFO")
+        # Read the config before the layout changes
+        self.proxy_config
+        os.makedirs(self.proxy_config_dir, exist_ok=True)
+        self.write_service_dropin(
+            "config-fragments",
+            '[Service]\nEnvironment="CONFIG={}"\n'.format(self.proxy_config_dir),
+        )
+        # The config location is only read on start
+        self._pending_save = False
+        self._pending_reload = False
+        self._write_config(restart=True)
+
+    def disable_fragments(self):
+        """Merge the fragment files back into a single config file."""
+        if not self.fragments_active():
+            return
+        log("Moving config to {}".format(self.proxy_config_file), "INFO")
+        self.proxy_config
+        self.write_service_dropin("config-fragments", None)
+        self._pending_save = False
+        self._pending_reload = False
+        self._write_config(restart=True)
+
+        for path in glob.glob(os.path.join(self.proxy_config_dir, "*.cfg")):
+            os.unlink(path)
+
+    def _service_dropin_path(self, name):
+        return os.path.join(self.service_dropin_dir, "{}.conf".format(name))
+
+    def write_service_dropin(self, name, content):
+        """Write, or remove if content is None, a systemd drop-in for haproxy.
+
+        Returns True if the drop-in changed, systemd is reloaded so it is
+        used the next time haproxy is started.
+        """
+        path = self._service_dropin_path(name)
+
+        try:
+            with open(path) as dropin_file:
+                current = dropin_file.read()
+        except FileNotFoundError:
+            current = None
+
+        if current == content:
+            return False
+
+        if content is None:
+            os.unlink(path)
+        else:
+            os.makedirs(self.service_dropin_dir, exist_ok=True)
+            self._replace_file(path, content.encode("utf-8"))
+        subprocess.check_call(["systemctl", "daemon-reload"])
+        log("Updated haproxy.service drop-in {}".format(name), "INFO")
+
+        return True
+
     def add_timeout_tunnel(self, timeout="1h", save=True):
         """Add tunnel_timeout setting to haproxy_config."""
         tunnel_config = haproxy_config.Config("timeout tunnel", "{}".format(timeout))
         defaults = self.proxy_config.defaults[0]
 
-        for cfg in defaults.configs():
-            if cfg.keyword == "timeout tunnel":
-                defaults.remove_config(cfg)
+        for cfg in defaults.config_block.lookup("config", "timeout tunnel"):
+            defaults.config_block.remove(cfg)
         defaults.add_config(tunnel_config)
 
         if save:
             self.save_config()
 
-    def get_config_names(self, configs):
+    def _set_global(self, keyword, value):
+        """Set a global setting, removing it if value is empty."""
+        globall = self.proxy_config.globall
+
+        for cfg in globall.config_block.lookup("config", keyword):
+            globall.config_block.remove(cfg)
+
+        if value:
+            globall.add_config(haproxy_config.Config(keyword, value))
+
+    def _cpu_quota(self):
+        """Return the cgroup CPU quota as a number of CPUs, None if unlimited."""
+        try:
+            with open(os.path.join(self.cgroup_dir, "cpu.max")) as cpu_max:
+                quota, period = cpu_max.read().split()[:2]
+        except (OSError, ValueError):
+            try:
+                with open(os.path.join(self.cgroup_dir, "cpu", "cpu.cfs_quota_us")) as quota_file:
+                    quota = quota_file.read().strip()
+                with open(os.path.join(self.cgroup_dir, "cpu", "cpu.cfs_period_us")) as period_file:
+                    period = period_file.read().strip()
+            except OSError:
+                return None
+
+        if quota in ("max", "-1"):
+            return None
+
+        return int(quota) / int(period)
+
+    def available_cpus(self):
+        """Return the CPUs haproxy can use, within any cgroup CPU limit.
+
+        LXD limits.cpu restricts the affinity of the container processes,
+        limits.cpu.allowance sets a CFS quota instead.
+        """
+        cpus = sorted(os.sched_getaffinity(0))
+        quota = self._cpu_quota()
+
+        if quota:
+            cpus = cpus[: max(1, math.ceil(quota))]
+
+        return cpus
+
+    def _bind_process(self, stats=False):
+        """Return the threads of the bind lines of a frontend, one per line.
+
+        When the stats frontend is enabled and there are several threads,
+        the last thread serves it alone and the others the traffic.
+        """
+        globall = self.proxy_config.globall
+        threads = 1
+
+        if globall is not None:
+            for config in globall.config_block.lookup("config", "nbthread"):
+                threads = int(config.value)
+
+        if threads < 2:
+            return []
+
+        # The process keyword is deprecated once bind lines take threads
+        form = "thread {}" if self.supports("bind-thread") else "process 1/{}"
+
+        if any(fe.name == "stats" for fe in self.proxy_config.frontends):
+            if stats:
+                return [form.format(threads)]
+            threads -= 1
+
+        return [form.format(thread) for thread in range(1, threads + 1)]
+
+    @staticmethod
+    def parse_bind_options(text):
+        """Return the listener options in text, ValueError if one isn't supported."""
+        words = (text or "").split()
+        options = []
+
+        while words:
+            word = words.pop(0)
+
+            if word in ("tfo", "defer-accept"):
+                options.append(word)
+            elif word == "backlog" and words and words[0].isdigit():
+                options.append("backlog {}".format(words.pop(0)))
+            else:
+                raise ValueError("Unsupported bind option {}".format(word))
+
+        return " ".join(options)
+
+    def listener_options(self, port):
+        """Return the listener options of a relation frontend.
+
+        Those set through relation data for the port win over the
+        bind-options config.
+        """
+        options = unitdata.kv().get("haproxy.bind_options", {}).get(str(port))
+
+        if options is not None:
+            return options
+
+        try:
+            return self.parse_bind_options(self.charm_config.get("bind-options"))
+        except ValueError as error:
+            log("Ignoring bind-options: {}".format(error), "WARNING")
+
+            return ""
+
+    def set_listener_options(self, port, text):
+        """Set the listener options of a relation frontend from relation data."""
+        options = self.parse_bind_options(text)
+        kv = unitdata.kv()
+        stored = kv.get("haproxy.bind_options", {})
+
+        if stored.get(str(port)) != options:
+            stored[str(port)] = options
+            kv.set("haproxy.bind_options", stored)
+
+    def update_binds(self, frontend):
+        """Rewrite the bind lines of a frontend with its listener options and threads.
+
+        With several traffic threads each gets a bind line, so a socket, of
+        its own and the kernel spreads new connections over them, rather
+        than every thread accepting from one socket. Options the charm
+        doesn't manage, like ssl, are taken from the first bind line.
+        """
+        binds = frontend.binds()
+
+        if not binds:
+            return
+        first = binds[0]
+        options = BIND_MANAGED.sub("", " ".join(first.attributes)).strip()
+        listener = ""
+
+        if frontend.name.startswith("relation-"):
+            listener = self.listener_options(frontend.port)
+        position = next(
+            number for number, line in enumerate(frontend.config_block) if line is first
+        )
+
+        for bind in binds:
+            frontend.config_block.remove(bind)
+
+        for offset, process in enumerate(
+            self._bind_process(stats=frontend.name == "stats") or [""]
+        ):
+            frontend.config_block.insert(
+                position + offset,
+                haproxy_config.Bind(
+                    first.host,
+                    first.port,
+                    [attribute for attribute in (options, listener, process) if attribute],
+                ),
+            )
+
+    def update_bind_options(self, save=True):
+        """Apply the bind-options config to the relation frontends."""
+        for frontend in self.proxy_config.frontends:
+            self.update_binds(frontend)
+
+        if save:
+            self.save_config()
+
+    def update_threads(self, save=True):
+        """Size nbthread to the threads config and pin threads to the CPUs.
+
+        The threads config is a number or auto, for one thread per CPU.
+        Frontends are placed on their threads, the stats one apart from
+        the traffic when there are several.
+        """
+        globall = self.proxy_config.globall
+        threads = str(self.charm_config.get("threads") or "").strip().lower()
+        cpus = self.available_cpus()
+
+        for keyword in ("nbthread", "cpu-map"):
+            for cfg in globall.config_block.lookup("config", keyword):
+                globall.config_block.remove(cfg)
+
+        try:
+            count = len(cpus) if threads == "auto" else int(threads or 1)
+        except ValueError:
+            log("Invalid threads {}, using one".format(threads), "WARNING")
+            count = 1
+
+        # 1.8 allows up to 64 threads
+        if not self.supports("threads"):
+            count = 1
+        count = min(count, 64)
+
+        if count > 1:
+            globall.add_config(haproxy_config.Config("nbthread", str(count)))
+            reserved = any(fe.name == "stats" for fe in self.proxy_config.frontends)
+            traffic_cpus = cpus[:-1] if reserved and len(cpus) > 1 else cpus
+
+            for thread in range(1, count + 1):
+                if reserved and thread == count:
+                    cpu = cpus[-1]
+                else:
+                    cpu = traffic_cpus[(thread - 1) % len(traffic_cpus)]
+                globall.add_config(
+                    haproxy_config.Config("cpu-map", "1/{} {}".format(thread, cpu))
+                )
+            log("Running {} threads on CPUs {}".format(count, cpus), "INFO")
+
+        for frontend in self.proxy_config.frontends:
+            self.update_binds(frontend)
+
+        if save:
+            self.save_config()
+
+    def _memory_limit(self):
+        """Return the memory of the unit in bytes, within any cgroup limit."""
+        memory = None
+
+        try:
+            with open(os.path.join(self.proc_dir, "meminfo")) as meminfo:
+                for line in meminfo:
+                    if line.startswith("MemTotal:"):
+                        memory = int(line.split()[1]) * 1024
+        except OSError as error:
+            log("Could not read the memory size: {}".format(error), "WARNING")
+
+        for name in ("memory.max", os.path.join("memory", "memory.limit_in_bytes")):
+            try:
+                with open(os.path.join(self.cgroup_dir, name)) as limit_file:
+                    limit = limit_file.read().strip()
+            except OSError:
+                continue
+
+            # Unlimited is max in v2 and a huge number in v1
+            if limit.isdigit() and (memory is None or int(limit) < memory):
+                memory = int(limit)
+
+        return memory
+
+    def _open_files_limit(self):
+        """Return the most files haproxy can raise its limit to as root."""
+        limits = []
+
+        for name in ("nr_open", "file-max"):
+            try:
+                with open(os.path.join(self.proc_dir, "sys", "fs", name)) as limit_file:
+                    limits.append(int(limit_file.read()))
+            except (OSError, ValueError):
+                pass
+
+        return min(limits) if limits else 1048576
+
+    def _buffer_sizes(self):
+        """Return the configured tune.bufsize and tune.maxrewrite."""
+        bufsize = self.charm_config.get("tune-bufsize") or 16384
+        maxrewrite = self.charm_config.get("tune-maxrewrite") or 1024
+
+        if maxrewrite > bufsize // 2:
+            log(
+                "tune-maxrewrite {} is over half of tune-bufsize, using {}".format(
+                    maxrewrite, bufsize // 2
+                ),
+                "WARNING",
+            )
+            maxrewrite = bufsize // 2
+
+        return bufsize, maxrewrite
+
+    def auto_maxconn(self):
+        """Return the connections haproxy can hold in half the memory and the files.
+
+        Every connection has a buffer each way and uses two descriptors.
+        """
+        bufsize, _ = self._buffer_sizes()
+        memory = self._memory_limit()
+        by_files = (self._open_files_limit() - RESERVED_FILES) // 2
+
+        if memory is None:
+            return max(by_files, 100)
+        by_memory = memory // 2 // (2 * bufsize + CONNECTION_OVERHEAD)
+
+        return max(min(by_memory, by_files), 100)
+
+    def _global_maxconn(self):
+        """Return the global maxconn set in the config, None if unset."""
+        globall = self.proxy_config.globall
+
+        if globall is not None:
+            for config in globall.config_block.lookup("config", "maxconn"):
+                return int(config.value)
+
+        return None
+
+    def _set_frontend_maxconn(self, frontend):
+        """Limit the connections of a relation frontend."""
+        maxconn = self.charm_config.get("frontend-maxconn") or self._global_maxconn()
+
+        for cfg in frontend.config_block.lookup("config", "maxconn"):
+            frontend.config_block.remove(cfg)
+
+        if maxconn:
+            frontend.add_config(haproxy_config.Config("maxconn", str(maxconn)))
+
+    def update_sizing(self, save=True):
+        """Set maxconn and the buffer sizes, sized to the unit unless configured.
+
+        The relation frontends are limited to frontend-maxconn, or to the
+        global maxconn.
+        """
+        bufsize, maxrewrite = self._buffer_sizes()
+        maxconn = self.charm_config.get("maxconn") or self.auto_maxconn()
+        self._set_global("maxconn", str(maxconn))
+        self._set_global("tune.bufsize", str(bufsize))
+        self._set_global("tune.maxrewrite", str(maxrewrite))
+        log(
+            "Sized maxconn to {} with {} byte buffers for {} bytes of memory".format(
+                maxconn, bufsize, self._memory_limit()
+            ),
+            "INFO",
+        )
+
+        for frontend in self.proxy_config.frontends:
+            if frontend.name.startswith("relation-"):
+                self._set_frontend_maxconn(frontend)
+
+        if save:
+            self.save_config()
+
+    def sizing_status(self):
+        """Return a status message with maxconn and the memory it may take."""
+        maxconn = self._global_maxconn()
+
+        if not maxconn:
+            return ""
+        bufsize, _ = self._buffer_sizes()
+
+        return "maxconn {} using up to {} MiB".format(
+            maxconn, maxconn * (2 * bufsize + CONNECTION_OVERHEAD) // 1048576
+        )
+
+    def status_message(self):
+        """Return the status message of the unit."""
+        valid, version, _ = self.check_version()
+        pending = "reload pending" if unitdata.kv().get("haproxy.reload.pending") else ""
+        slots = ""
+        fragments = ""
+
+        if self.charm_config.get("server-slots") and not self.server_slots():
+            slots = "server-slots needs HAProxy 1.8"
+
+        if self.charm_config.get("config-fragments") and not self.fragments_active():
+            fragments = "config-fragments needs a single defaults section"
+
+        return ", ".join(
+            message
+
+            for message in (
+                "" if valid else version,
+                pending,
+                slots,
+                fragments,
+                self.sizing_status(),
+                self.worker_status(),
+            )
+
+            if message
+        )
+
+    def active_status(self):
+        """Set the unit status once a hook is done with its changes.
+
+        Blocked while the last config failed its check, else active with
+        the status message.
+        """
+        error = self.config_error()
+
+        if error:
+            hookenv.status_set(
+                "blocked", "Config check failed: {}".format(error.splitlines()[0])
+            )
+        else:
+            hookenv.status_set("active", self.status_message())
+
+    def _sysctl(self, name):
+        """Return the current value of a sysctl setting, None if it is unknown."""
+        try:
+            with open(os.path.join(self.proc_dir, "sys", *name.split("."))) as sysctl_file:
+                return " ".join(sysctl_file.read().split())
+        except OSError:
+            return None
+
+    def _reserved_ports(self, previous):
+        """Return the reserved local ports with the listener ports added.
+
+        previous is the comma separated list of ports and ranges reserved
+        before the charm tuned the host, those are kept.
+        """
+        reserved = [part for part in (previous or "").split(",") if part]
+        ranges = [[int(port) for port in part.split("-")] for part in reserved]
+
+        for port in self.listener_ports():
+            if not any(span[0] <= int(port) <= span[-1] for span in ranges):
+                reserved.append(port)
+
+        return ",".join(reserved)
+
+    def host_tuning(self, previous):
+        """Return the sysctl settings and open files limit for the global maxconn.
+
+        Limits are never lowered from their previous value.
+        """
+        maxconn = self._global_maxconn() or self.auto_maxconn()
+        files = 2 * maxconn + RESERVED_FILES
+        # somaxconn is 16 bits before Linux 5.4
+        backlog = min(max(maxconn, 4096), 65535)
+        settings = {
+            "net.core.somaxconn": backlog,
+            "net.ipv4.tcp_max_syn_backlog": backlog,
+            "net.ipv4.ip_local_port_range": "1024 65023",
+            # Keep connections to the backends off the ports haproxy binds
+            "net.ipv4.ip_local_reserved_ports": self._reserved_ports(
+                previous.get("net.ipv4.ip_local_reserved_ports")
+            ),
+            "net.ipv4.tcp_tw_reuse": "1",
+            # Room for the other processes of the unit
+            "fs.file-max": 2 * files,
+        }
+
+        for name, value in list(settings.items()):
+            current = previous.get(name)
+
+            if not value:
+                del settings[name]
+            elif isinstance(value, int) and current and current.isdigit() and int(current) >= value:
+                del settings[name]
+
+        return settings, files
+
+    def update_host_tuning(self):
+        """Tune the kernel and the haproxy open files limit, or roll it back.
+
+        The values the settings had before are kept to be restored when
+        tune-host is turned off. haproxy is restarted when its limit changes.
+        """
+        kv = unitdata.kv()
+        previous = kv.get("haproxy.sysctl.previous")
+
+        if self.charm_config.get("tune-host"):
+            if previous is None:
+                previous = {
+                    name: self._sysctl(name)
+
+                    for name in (
+                        "net.core.somaxconn",
+                        "net.ipv4.tcp_max_syn_backlog",
+                        "net.ipv4.ip_local_port_range",
+                        "net.ipv4.ip_local_reserved_ports",
+                        "net.ipv4.tcp_tw_reuse",
+                        "fs.file-max",
+                    )
+                }
+                kv.set("haproxy.sysctl.previous", previous)
+            settings, files = self.host_tuning(previous)
+            content = "".join(
+                "{} = {}\n".format(name, value) for name, value in sorted(settings.items())
+            ).encode("utf-8")
+            commands = []
+
+            try:
+                with open(self.sysctl_file, "rb") as sysctl_file:
+                    current = sysctl_file.read()
+            except FileNotFoundError:
+                current = None
+
+            # Also called on every config write, for the reserved ports
+            if current != content:
+                self._replace_file(self.sysctl_file, content)
+                commands.append(["sysctl", "-p", self.sysctl_file])
+            limits = "[Service]\nLimitNOFILE={}\n".format(files)
+        else:
+            if previous is None:
+                return
+            try:
+                os.unlink(self.sysctl_file)
+            except FileNotFoundError:
+                pass
+            commands = [
+                ["sysctl", "-w", "{}={}".format(name, value)]
+
+                for name, value in sorted(previous.items())
+
+                if value is not None
+            ]
+            kv.unset("haproxy.sysctl.previous")
+            limits = None
+
+        for command in commands:
+            try:
+                subprocess.check_call(command)
+            except (subprocess.CalledProcessError, OSError) as error:
+                # Containers can't change some of them
+                log("Could not apply sysctl settings: {}".format(error), "WARNING")
+
+        if self.write_service_dropin("limits", limits):
+            # Limits are only read when haproxy starts
+            self.flush()
+            self._reload_service(restart=True)
+
+    def update_hard_stop(self, save=True):
+        """Limit how long old workers serve their sessions after a reload."""
+        self._set_global("hard-stop-after", self.charm_config.get("hard-stop-after"))
+
+        if save:
+            self.save_config()
+
+    def update_server_state(self, save=True):
+        """Configure haproxy to load the server states saved before reloads."""
+        path = self.charm_config.get("server-state-file")
+        self._set_global("server-state-file", path)
+
+        for defaults in self.proxy_config.defaults:
+            for cfg in defaults.config_block.lookup(
+                "config", "load-server-state-from-file"
+            ):
+                defaults.config_block.remove(cfg)
+
+            if path:
+                defaults.add_config(
+                    haproxy_config.Config("load-server-state-from-file", "global")
+                )
+
+        if save:
+            self.save_config()
+
+    @property
+    def server_state_file(self):
+        """Return the server state file haproxy loads on start, if any."""
+        globall = self.proxy_config.globall
+
+        if globall is not None:
+            for config in globall.config_block.lookup("config", "server-state-file"):
+                return config.value.strip()
+
+        return None
+
+    def save_server_state(self):
+        """Save the state of the servers for the haproxy about to be reloaded.
+
+        Health, weights and drain or maintenance states are loaded back by
+        the new workers instead of starting over from the initial checks.
+        Server slots are left out, a released slot is in maintenance and
+        would stay so once the reload binds it to another unit.
+        """
+        import haproxy_runtime
+
+        path = self.server_state_file
+
+        if not path:
+            return False
+
+        try:
+            state = self.runtime.command("show servers state")
+            haproxy_runtime.parse_servers_state(state)
+        except haproxy_runtime.RuntimeAPIError as error:
+            log("Could not save the server state: {}".format(error), "DEBUG")
+
+            return False
+        lines = state.rstrip("\n").split("\n")
+        # The version and the header line, then one line per server
+        lines[2:] = [
+            line
+
+            for line in lines[2:]
+
+            if line.startswith("#")
+            or len(line.split()) < 4
+            or not SLOT_NAME.match(line.split()[3])
+        ]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._replace_file(path, "".join(line + "\n" for line in lines).encode("utf-8"))
+
+        return True
+
+    def _proc_status(self, pid):
+        """Return the fields of the status of a process, empty if it is gone."""
+        status = {}
+
+        try:
+            with open(os.path.join(self.proc_dir, str(pid), "status")) as status_file:
+                for line in status_file:
+                    name, _, value = line.partition(":")
+                    status[name] = value.strip()
+        except OSError:
+            pass
+
+        return status
+
+    def old_workers(self):
+        """Return the pid and RSS in kB of the old workers left by reloads.
+
+        Those are the haproxy processes besides the current worker and its
+        master, still serving their sessions. None if haproxy isn't running.
+        """
+        import haproxy_runtime
+
+        try:
+            current = int(self.runtime.show_info()["Pid"])
+        except (haproxy_runtime.RuntimeAPIError, KeyError, ValueError) as error:
+            log("Could not find the current haproxy worker: {}".format(error), "DEBUG")
+
+            return None
+        processes = {}
+
+        for entry in os.listdir(self.proc_dir):
+            if entry.isdigit():
+                status = self._proc_status(entry)
+
+                if status.get("Name") == "haproxy":
+                    processes[int(entry)] = status
+        master = processes.get(current, {}).get("PPid")
+
+        return [
+            (pid, int(status.get("VmRSS", "0 kB").split()[0]))
+
+            for pid, status in sorted(processes.items())
+
+            if pid != current and str(pid) != master
+        ]
+
+    def worker_status(self):
+        """Return a status message counting the old workers, empty if none."""
+        workers = self.old_workers()
+
+        if not workers:
+            return ""
+
+        return "{} old workers using {} MiB".format(
+            len(workers), sum(rss for _, rss in workers) // 1024
+        )
+
+    def check_config(self, configs, maps=None):
+        """Check a candidate config with haproxy -c before it is written.
+
+        configs and maps map the paths to their content, fragments are
+        checked together from a directory the way haproxy loads them and
+        the maps from a copy so the live ones are only replaced once the
+        check passed. Returns the haproxy output if the check failed.
+        """
+        directory = tempfile.mkdtemp(
+            prefix=".haproxy-check.", dir=os.path.dirname(self.proxy_config_file)
+        )
+        map_dir = os.path.join(directory, "maps")
+
+        try:
+            os.mkdir(map_dir)
+
+            for path, content in (maps or {}).items():
+                with open(os.path.join(map_dir, os.path.basename(path)), "wb") as map_file:
+                    map_file.write(content)
+
+            for path, content in configs.items():
+                with open(os.path.join(directory, os.path.basename(path)), "wb") as cfg_file:
+                    cfg_file.write(
+                        content.replace(
+                            (self.map_dir + "/").encode("utf-8"),
+                            (map_dir + "/").encode("utf-8"),
+                        )
+                    )
+
+            if self.fragments_active():
+                candidate = directory
+            else:
+                candidate = os.path.join(
+                    directory, os.path.basename(self.proxy_config_file)
+                )
+            subprocess.check_output(
+                ["haproxy", "-c", "-q", "-f", candidate], stderr=subprocess.STDOUT
+            )
+        except subprocess.CalledProcessError as error:
+            output = str(error.output or b"", "utf-8", "replace").strip()
+            log("Config check failed, keeping the running config: {}".format(output), "ERROR")
+
+            return output or "haproxy -c exited with {}".format(error.returncode)
+        except OSError as error:
+            log("Could not check the config: {}".format(error), "WARNING")
+        finally:
+            shutil.rmtree(directory)
+
+        return ""
+
+    @staticmethod
+    def config_error():
+        """Return the output of the last failed config check, if any."""
+        return unitdata.kv().get("haproxy.config.error", "")
+
+    def update_seamless_reload(self, save=True):
+        """Run haproxy as master-worker, passing listeners on to new workers.
+
+        With expose-fd listeners new workers take over the listening sockets
+        of the old ones, so no connection is refused during a reload.
+        """
+        globall = self.proxy_config.globall
+        seamless = self.charm_config.get("seamless-reload") and self.supports(
+            "master-worker"
+        )
+
+        for cfg in globall.config_block.lookup("config", "master-worker"):
+            globall.config_block.remove(cfg)
+
+        if seamless:
+            globall.add_config(haproxy_config.Config("master-worker", ""))
+
+        for cfg in globall.config_block.lookup("config", "stats"):
+            if cfg.value.startswith("socket "):
+                cfg.value = cfg.value.replace(" expose-fd listeners", "").rstrip()
+
+                if seamless:
+                    cfg.value += " expose-fd listeners"
+
+        if save:
+            self.save_config()
+
+    def _reload_wait(self):
+        """Return how long reloads have to wait for the reload window to pass."""
+        window = self.charm_config.get("reload-window") or 0
+        elapsed = time.time() - unitdata.kv().get("haproxy.reload.last", 0)
+
+        if 0 <= elapsed < window:
+            return window - elapsed
+
+        return 0
+
+    def _reload_service(self, restart=False):
+        """Save the server state and reload or restart haproxy."""
+        self.save_server_state()
+        action = "Restarting" if restart else "Reloading"
+        started = time.monotonic()
+
+        if restart:
+            applied = host.service_restart("haproxy.service")
+        else:
+            applied = host.service_reload("haproxy.service")
+
+        # The connection still goes to the old worker, the next command
+        # connects to the new one
+        if self._runtime is not None:
+            self._runtime.close()
+
+        if applied is False:
+            log(
+                "{} haproxy failed after {:.2f}s".format(action, time.monotonic() - started),
+                "ERROR",
+            )
+        else:
+            log(
+                "{} haproxy took {:.2f}s".format(action, time.monotonic() - started),
+                "INFO",
+            )
+            kv = unitdata.kv()
+            kv.set("haproxy.reload.last", time.time())
+            kv.unset("haproxy.reload.pending")
+
+        return applied
+
+    def get_config_names(self, configs, unit=None):
         """Get configuration names from relation data."""
         names = []
+        unit = unit or hookenv.remote_unit()
 
         for index, config in enumerate(configs):
-            remote_unit = hookenv.remote_unit().replace("/", "-") + "-{}".format(index)
+            remote_unit = unit.replace("/", "-") + "-{}".format(index)
             backend_name = config["group_id"] or remote_unit
             names.append((remote_unit, backend_name))
 
@@ -66,6 +1262,11 @@ class ProxyHelper:
 
     def process_configs(self, configs):
         """Process related unit configuration."""
+        self.store_routes(hookenv.remote_unit(), configs)
+
+        if self.charm_config["declarative-routing"]:
+            return self.reconcile_routes(hookenv.remote_unit())
+
         for names, config in zip(self.get_config_names(configs), configs):
             remote_unit = names[0]
             backend_name = names[1]
@@ -77,7 +1278,7 @@ class ProxyHelper:
             legacy = self.legacy_name(backend_name)
 
             if legacy != backend_name:
-                hookenv.log(
+                log(
                     "Cleaning any legacy configs for {} ({})".format(
                         remote_unit, legacy
                     ),
@@ -87,203 +1288,360 @@ class ProxyHelper:
 
             # Remove any prior configuration as it might have changed
             # do not write cfg file we still have edits to make
-            hookenv.log(
+            log(
                 "Cleaning configs for remote {}, backend {}".format(
                     remote_unit, backend_name
                 ),
                 "DEBUG",
             )
             self.clean_config(unit=remote_unit, backend_name=backend_name, save=False)
+            status = self.add_route(remote_unit, backend_name, config)
 
-            # Get the frontend, create if not present
-            frontend = self.get_frontend(config["external_port"])
+            if status is not None:
+                return status
 
-            # urlbase use to accept / now they are added automatically
-            # to avoid errors strip it from old configs
+        # Render new cfg file, now rather than at the end of the hook so
+        # the relation hears how it went
+        return self.config_status(self.apply_config())
 
-            if config["urlbase"]:
-                config["urlbase"] = config["urlbase"].rstrip("/")
+    def remove_configs(self, configs):
+        """Remove related unit configuration, after draining its servers."""
+        servers = []
 
-            hookenv.log("Checking frontend {}".format(str(frontend)), "DEBUG")
+        for unit_name, _ in self.get_config_names(configs):
+            servers.extend(self.unit_servers(unit_name))
 
-            if config["mode"] == "http":
-                if not self.available_for_http(frontend):
-                    return {
-                        "cfg_good": False,
-                        "msg": "Port not available for http routing",
-                    }
+        if self.charm_config.get("drain-timeout"):
+            self.drain_servers(servers)
+        self.forget_routes(hookenv.remote_unit())
 
-                # Add ACL's to the frontend
+        if self.charm_config["declarative-routing"]:
+            self.reconcile_routes()
 
-                if config["urlbase"]:
-                    acl = haproxy_config.Acl(
-                        name=remote_unit, value="path_beg {}/".format(config["urlbase"])
-                    )
-                    frontend.add_acl(acl)
-                    acl = haproxy_config.Acl(
-                        name=remote_unit, value="path {}".format(config["urlbase"])
-                    )
-                    frontend.add_acl(acl)
+            return
 
-                if config["subdomain"]:
-                    acl = haproxy_config.Acl(
-                        name=remote_unit,
-                        value="hdr_beg(host) -i {}".format(config["subdomain"]),
-                    )
-                    frontend.add_acl(acl)
+        for names in self.get_config_names(configs):
+            unit_name = names[0]
+            backend_name = names[1]
+            log(
+                "Cleaning on depart for {}, {}".format(unit_name, backend_name), "DEBUG"
+            )
+            self.clean_config(unit=unit_name, backend_name=backend_name)
+
+    def store_routes(self, unit, configs):
+        """Record the routes requested by a related unit."""
+        kv = unitdata.kv()
+        routes = kv.get("haproxy.routes", {})
+        routes[unit] = [dict(config) for config in configs]
+        kv.set("haproxy.routes", routes)
+
+    def forget_routes(self, unit):
+        """Drop the routes recorded for a related unit."""
+        kv = unitdata.kv()
+        routes = kv.get("haproxy.routes", {})
+
+        if routes.pop(unit, None) is not None:
+            kv.set("haproxy.routes", routes)
+
+    def reconcile_routes(self, unit=None):
+        """Rebuild every relation route from the recorded relation state.
+
+        Everything the recorded routes, and those applied by the previous
+        run, put in the config is removed and regenerated in one pass so
+        repeated changes can't leave stale or duplicated lines behind.
+        Returns the status of the routes for unit.
+        """
+        kv = unitdata.kv()
+        routes = kv.get("haproxy.routes", {})
+        wanted = []
+
+        for remote_unit, configs in sorted(routes.items()):
+            names = self.get_config_names(configs, remote_unit)
+            wanted.extend(
+                (remote_unit, unit_name, backend_name, config)
+                for (unit_name, backend_name), config in zip(names, configs)
+            )
 
-                # Add use_backend section to the frontend
-                use_backend = haproxy_config.UseBackend(
-                    backend_name=backend_name,
-                    operator="if",
-                    backend_condition=remote_unit,
-                    is_default=False,
-                )
-                frontend.add_usebackend(use_backend)
+        units = set()
+        backend_names = set()
+
+        for unit_name, backend_name in kv.get("haproxy.routes.applied", []) + [
+            names[1:3] for names in wanted
+        ]:
+            units.update((unit_name, self.legacy_name(unit_name)))
+            backend_names.update((backend_name, self.legacy_name(backend_name)))
+        log(
+            "Reconciling {} routes, replacing {} units".format(len(wanted), len(units)),
+            "INFO",
+        )
 
-            if config["mode"] == "tcp":
-                if not self.available_for_tcp(frontend, backend_name):
-                    return {
-                        "cfg_good": False,
-                        "msg": ("Frontend already in use " "can not setup tcp mode"),
-                    }
+        for unit_name in units:
+            self._remove_unit(unit_name)
 
-                mode_config = haproxy_config.Config("mode", "tcp")
-                frontend.add_config(mode_config)
+        # TCP routes to a group are only referenced by default_backend
+        for backend_name in backend_names:
+            for fe in self.proxy_index.owners("backend", backend_name, "frontend"):
+                for ub in fe.config_block.lookup("backend", backend_name):
+                    if ub.is_default:
+                        fe.config_block.remove(ub)
 
-                # clean use backends for tcp backends, in case there is
-                # any cruft left over from legacy configs
+        # Only keep servers of units the charm has no record of, the rest
+        # of the backend is regenerated from the recorded routes
+        for backend_name in backend_names:
+            for backend in self.proxy_config.backends.lookup(backend_name):
+                backend.config_block[:] = [
+                    line
 
-                for usebackend in frontend.usebackends():
-                    frontend.remove_usebackend(usebackend.backend_name)
+                    for line in backend.config_block
 
-                use_backend = haproxy_config.UseBackend(
-                    backend_name=backend_name,
-                    operator="",
-                    backend_condition="",
-                    is_default=True,
-                )
-                frontend.add_usebackend(use_backend)
+                    if self._is_slot_line(line)
+                    or isinstance(line, haproxy_config.Server)
+                    and line.name not in units
+                ]
+        self._prune_sections()
 
-            # Get the backend, create if not present
-            backend = self.get_backend(backend_name)
+        statuses = {}
+        applied = []
 
-            # Set sensible connection checking parameter
-            # by default. This will work for both TCP
-            # and HTTP backends, if a group-id is specified,
-            # nicer HTTP checks for HTTP backends will also
-            # be enabled to perform HTTP requests as part of
-            # checking backend health
-            attributes = []
+        for remote_unit, unit_name, backend_name, config in wanted:
+            status = self.add_route(unit_name, backend_name, config)
 
-            if config["check"]:
-                attributes = ["check fall 3 rise 2"]
+            if status is None:
+                applied.append((unit_name, backend_name))
+            else:
+                log(
+                    "Route {} not applied: {}".format(unit_name, status["msg"]),
+                    "WARNING",
+                )
+                statuses[remote_unit] = status
+        self._prune_sections()
+        kv.set("haproxy.routes.applied", applied)
+        status = self.config_status(self.apply_config())
+
+        return statuses.get(unit, status)
+
+    @staticmethod
+    def _has_line(section, kind, keyword, value):
+        """Return whether the section has a config or option line.
+
+        The lines are matched by keyword and value the way the parser
+        splits them, so a parsed config and a cached one give the same
+        answer.
+        """
+        return any(
+            line.value.strip() == value for line in section.config_block.lookup(kind, keyword)
+        )
 
-            # Add server to the backend
-            # Firstly, set the mode on the backedn to match
-            # the frontend
-            backend.add_config(haproxy_config.Config("mode", config["mode"]))
+    def add_route(self, remote_unit, backend_name, config):
+        """Add the frontend, backend and server lines for one route.
 
-            # Now, for HTTP specific configuration
+        Returns a failure status if the route conflicts with the current
+        config, None once it is added.
+        """
+        if config.get("bind_options") is not None:
+            try:
+                self.set_listener_options(config["external_port"], config["bind_options"])
+            except ValueError as error:
+                return {"cfg_good": False, "msg": str(error)}
 
-            if config["mode"] == "http":
-                # Add cookie config if not already present
-                cookie_found = False
-                cookie = "cookie SERVERID insert indirect nocache"
+        # Get the frontend, create if not present
+        frontend = self.get_frontend(config["external_port"])
+        self.update_binds(frontend)
 
-                for test_config in backend.configs():
-                    if cookie in test_config.keyword:
-                        cookie_found = True
+        # urlbase use to accept / now they are added automatically
+        # to avoid errors strip it from old configs
 
-                if not cookie_found:
-                    backend.add_config(haproxy_config.Config(cookie, ""))
-                attributes.append("cookie {}".format(remote_unit))
-                # Add httpchk option if not present
-
-                if config["group_id"]:
-                    httpchk_found = False
-                    httpchk = "httpchk GET {} HTTP/1.0".format(config["urlbase"] or "/")
-
-                    for test_option in backend.options():
-                        if httpchk in test_option.keyword:
-                            httpchk_found = True
-
-                    if not httpchk_found:
-                        backend.add_option(haproxy_config.Option(httpchk, ""))
-                    attributes.append("check")
-                # Add rewrite-path if requested and not present
-
-                if config["rewrite-path"] and config["urlbase"]:
-                    rewrite_found = False
-                    rewrite = (
-                        "http-request set-path " "%[path,regsub(^{}/?,/)]"
-                    ).format(config["urlbase"])
-
-                    for test_cfg in backend.configs():
-                        if rewrite in test_cfg.keyword:
-                            rewrite_found = True
-
-                    if not rewrite_found:
-                        backend.add_config(haproxy_config.Config(rewrite, ""))
-
-                if config["acl-local"]:
-                    if not backend.acl("local"):
-                        backend.add_acl(
-                            haproxy_config.Acl(
-                                "local",
-                                (
-                                    "src 10.0.0.0/8 "
-                                    "172.16.0.0/12 "
-                                    "192.168.0.0/16 "
-                                    "127.0.0.0/8 "
-                                    "fd00::/8 "
-                                    "fe80::/10 "
-                                    "::1/128"
-                                ),
-                            )
-                        )
-                        backend.add_config(
-                            haproxy_config.Config("http-request deny if !local", "")
-                        )
+        if config["urlbase"]:
+            config["urlbase"] = config["urlbase"].rstrip("/")
 
-                if config["proxypass"]:
-                    proxy_found = False
+        log("Checking frontend {}".format(str(frontend)), "DEBUG")
 
-                    for test_option in backend.options():
-                        if "forwardfor" in test_cfg.keyword:
-                            proxy_found = True
+        # Units of a group bound to server slots share the group's acls, so
+        # joining and leaving doesn't change the frontend
+        slots = 0
 
-                    if not proxy_found:
-                        backend.add_option(haproxy_config.Option("forwardfor", ""))
+        if config["group_id"]:
+            slots = self.server_slots()
+        condition = backend_name if slots else remote_unit
 
-                    if config["external_port"] == 443:
-                        forward_for = (
-                            "http-request set-header " "X-Forwarded-Proto https"
-                        )
-                    else:
-                        forward_for = (
-                            "http-request set-header " "X-Forwarded-Proto http"
-                        )
-                    backend.add_config(haproxy_config.Config(forward_for, ""))
-
-                if config["ssl"]:
-                    if config["ssl-verify"]:
-                        ssl_attrib = "ssl"
-                    else:
-                        ssl_attrib = "ssl verify none"
-                    attributes.append(ssl_attrib)
-            server = haproxy_config.Server(
-                name=remote_unit,
-                host=config["internal_host"],
-                port=config["internal_port"],
-                attributes=attributes,
-            )
-            backend.add_server(server)
+        if config["mode"] == "http":
+            if not self.available_for_http(frontend):
+                return {
+                    "cfg_good": False,
+                    "msg": "Port not available for http routing",
+                }
 
-        # Render new cfg file
-        self.save_config()
+            if self.charm_config.get("map-routing"):
+                self.add_map_entries(frontend, remote_unit, backend_name, config)
+            else:
+                # Add ACL's to the frontend
+                acls = []
 
-        return {"cfg_good": True, "msg": "configuration applied"}
+                if config["urlbase"]:
+                    acls.append("path_beg {}/".format(config["urlbase"]))
+                    acls.append("path {}".format(config["urlbase"]))
+
+                if config["subdomain"]:
+                    acls.append("hdr_beg(host) -i {}".format(config["subdomain"]))
+                existing = [
+                    acl.value.strip() for acl in frontend.config_block.lookup("acl", condition)
+                ]
+
+                for value in acls:
+                    if value not in existing:
+                        frontend.add_acl(haproxy_config.Acl(name=condition, value=value))
+
+                # Add use_backend section to the frontend
+                if not frontend.config_block.lookup("use_backend", condition):
+                    use_backend = haproxy_config.UseBackend(
+                        backend_name=backend_name,
+                        operator="if",
+                        backend_condition=condition,
+                        is_default=False,
+                    )
+                    frontend.add_usebackend(use_backend)
+
+        if config["mode"] == "tcp":
+            if not self.available_for_tcp(frontend, backend_name):
+                return {
+                    "cfg_good": False,
+                    "msg": ("Frontend already in use " "can not setup tcp mode"),
+                }
+
+            mode_config = haproxy_config.Config("mode", "tcp")
+            frontend.add_config(mode_config)
+
+            # clean use backends for tcp backends, in case there is
+            # any cruft left over from legacy configs
+
+            for usebackend in frontend.usebackends():
+                frontend.remove_usebackend(usebackend.backend_name)
+
+            use_backend = haproxy_config.UseBackend(
+                backend_name=backend_name,
+                operator="",
+                backend_condition="",
+                is_default=True,
+            )
+            frontend.add_usebackend(use_backend)
+
+        # Get the backend, create if not present
+        backend = self.get_backend(backend_name, slots=slots)
+
+        # Set sensible connection checking parameter
+        # by default. This will work for both TCP
+        # and HTTP backends, if a group-id is specified,
+        # nicer HTTP checks for HTTP backends will also
+        # be enabled to perform HTTP requests as part of
+        # checking backend health
+        attributes = []
+
+        if config["check"]:
+            attributes = ["check fall 3 rise 2"]
+
+        # Add server to the backend
+        # Firstly, set the mode on the backedn to match
+        # the frontend, once for all servers of a group
+        modes = backend.config_block.lookup("config", "mode")
+
+        if not any(mode.value.strip() == config["mode"] for mode in modes):
+            backend.add_config(haproxy_config.Config("mode", config["mode"]))
+
+        # Now, for HTTP specific configuration
+
+        if config["mode"] == "http":
+            # Add cookie config if not already present
+            cookie = "SERVERID insert indirect nocache"
+
+            # Slots change address at runtime, so their cookie is derived
+            # from it instead of being set on the server line
+            if slots:
+                cookie += " dynamic"
+
+                if not backend.config_block.first("config", "dynamic-cookie-key"):
+                    backend.add_config(
+                        haproxy_config.Config("dynamic-cookie-key", backend_name)
+                    )
+
+            if not self._has_line(backend, "config", "cookie", cookie):
+                backend.add_config(haproxy_config.Config("cookie", cookie))
+
+            if not slots:
+                attributes.append("cookie {}".format(remote_unit))
+            # Add httpchk option if not present
+
+            if config["group_id"]:
+                httpchk = "GET {} HTTP/1.0".format(config["urlbase"] or "/")
+
+                if not self._has_line(backend, "option", "httpchk", httpchk):
+                    backend.add_option(haproxy_config.Option("httpchk", httpchk))
+                attributes.append("check")
+            # Add rewrite-path if requested and not present
+
+            if config["rewrite-path"] and config["urlbase"]:
+                rewrite = "set-path %[path,regsub(^{}/?,/)]".format(config["urlbase"])
+
+                if not self._has_line(backend, "config", "http-request", rewrite):
+                    backend.add_config(haproxy_config.Config("http-request", rewrite))
+
+            if config["acl-local"]:
+                if not backend.acl("local"):
+                    backend.add_acl(
+                        haproxy_config.Acl(
+                            "local",
+                            (
+                                "src 10.0.0.0/8 "
+                                "172.16.0.0/12 "
+                                "192.168.0.0/16 "
+                                "127.0.0.0/8 "
+                                "fd00::/8 "
+                                "fe80::/10 "
+                                "::1/128"
+                            ),
+                        )
+                    )
+                    backend.add_config(
+                        haproxy_config.Config("http-request", "deny if !local")
+                    )
+
+            if config["proxypass"]:
+                if not backend.config_block.first("option", "forwardfor"):
+                    backend.add_option(haproxy_config.Option("forwardfor", ""))
+
+                if config["external_port"] == 443:
+                    forward_for = "set-header X-Forwarded-Proto https"
+                else:
+                    forward_for = "set-header X-Forwarded-Proto http"
+
+                if not self._has_line(backend, "config", "http-request", forward_for):
+                    backend.add_config(haproxy_config.Config("http-request", forward_for))
+
+            if config["ssl"]:
+                if config["ssl-verify"]:
+                    ssl_attrib = "ssl"
+                else:
+                    ssl_attrib = "ssl verify none"
+                attributes.append(ssl_attrib)
+        if slots:
+            self.bind_slot(
+                backend,
+                remote_unit,
+                config["internal_host"],
+                config["internal_port"],
+                attributes,
+                slots,
+            )
+
+            return None
+        server = haproxy_config.Server(
+            name=remote_unit,
+            host=config["internal_host"],
+            port=config["internal_port"],
+            attributes=attributes,
+        )
+        backend.add_server(server)
+
+        return None
 
     def available_for_http(self, frontend):
         """Check if backend should be configured for HTTP."""
@@ -312,314 +1670,1240 @@ class ProxyHelper:
 
     def available_for_tcp(self, frontend, backend_name):
         """Verify if related backend should be configured for TCP operation."""
-        if len(frontend.acls()):
+        if frontend.config_block.total("acl"):
+            return False
+
+        if frontend.config_block.total("use_backend"):
+            # also check for legacy backend name in
+            # case we've upgrades
+            valid_backend = frontend.config_block.first(
+                "backend", backend_name
+            ) or frontend.config_block.first("backend", self.legacy_name(backend_name))
+
+            if not valid_backend:
+                return False
+
+        return True
+
+    def enable_stats(self, save=True):
+        """Enable the stats enpoint."""
+        # Remove any previous stats
+        self.disable_stats(save=False)
+
+        # Check that no frontend exists with conflicting port
+
+        if (
+            self.get_frontend(port=self.charm_config["stats-port"], create=False)
+            is not None
+        ):
+            log(
+                "Stats port {} already in use".format(self.charm_config["stats-port"]),
+                "ERROR",
+            )
+
+            if save:
+                self.save_config()
+
+            return False
+
+        # Generate new front end for stats
+        user_string = "{}:{}".format(
+            self.charm_config["stats-user"], self.charm_config["stats-passwd"]
+        )
+        config_block = []
+        config_block.append(
+            haproxy_config.Bind("0.0.0.0", self.charm_config["stats-port"], None)
+        )
+        config_block.append(haproxy_config.Config("stats enable", ""))
+        config_block.append(
+            haproxy_config.Config("stats auth {}".format(user_string), "")
+        )
+        config_block.append(
+            haproxy_config.Config(
+                "stats uri {}".format(self.charm_config["stats-url"]), ""
+            )
+        )
+
+        if self.charm_config["stats-local"]:
+            config_block.append(
+                haproxy_config.Acl(
+                    "local",
+                    (
+                        "src 10.0.0.0/8 "
+                        "172.16.0.0/12 "
+                        "192.168.0.0/16 "
+                        "127.0.0.0/8 "
+                        "fd00::/8 "
+                        "fe80::/10 "
+                        "::1/128"
+                    ),
+                )
+            )
+            config_block.append(
+                haproxy_config.Config("http-request deny if !local", "")
+            )
+        frontend = haproxy_config.Frontend(
+            "stats", "0.0.0.0", str(self.charm_config["stats-port"]), config_block
+        )
+        self.proxy_config.frontends.append(frontend)
+        # The stats frontend gets a thread of its own
+        self.update_threads(save=False)
+
+        if save:
+            self.save_config()
+
+        return True
+
+    def disable_stats(self, save=True):
+        """Disable the stats endpoint."""
+        # Remove any previous stats frontend
+        self.proxy_config.frontends[:] = [
+            fe for fe in self.proxy_config.frontends if fe.name != "stats"
+        ]
+        self.update_threads(save=False)
+
+        if save:
+            self.save_config()
+
+    def enable_redirect(self, save=True):
+        """Enable the generic redirect to HTTPS."""
+        backend_name = "redirect"
+
+        # remove any prevoius configureation
+        self.disable_redirect(save=False)
+
+        # Get or create frontend 80
+        frontend = self.get_frontend(port=80)
+
+        # Add use_backend section to the frontend
+        use_backend = haproxy_config.UseBackend(
+            backend_name=backend_name,
+            operator="",
+            backend_condition="",
+            is_default=True,
+        )
+        frontend.add_usebackend(use_backend)
+
+        # Get the backend, create if not present
+        backend = self.get_backend(backend_name)
+
+        # Add redirect option to the backend
+        redirect_config = haproxy_config.Config("redirect scheme https", "")
+        backend.add_config(redirect_config)
+
+        # Add server so clean won't remove it
+        server = haproxy_config.Server(name=backend_name, host="127.0.0.1", port=0)
+        backend.add_server(server)
+
+        # Render new cfg file
+
+        if save:
+            self.save_config()
+
+    def disable_redirect(self, save=True):
+        """Disable the generic redirect to HTTPS."""
+        backend_name = "redirect"
+
+        # Remove the redirect backend
+
+        for fe in self.proxy_index.owners("backend", backend_name, "frontend"):
+            fe.remove_usebackend(backend_name)
+
+        # Clean the config
+        self.clean_config(unit=backend_name, backend_name=backend_name, save=save)
+
+    def get_frontend(self, port=None, create=True):
+        """Find the frontend for the requested port."""
+        port = str(port)
+        log("Checking frontend for port {}".format(port), "DEBUG")
+        frontend = self.proxy_index.frontend(port)
+
+        if frontend is not None:
+            log("Using previous frontend", "DEBUG")
+
+        if frontend is None and create:
+            log("Creating frontend for port {}".format(port), "INFO")
+            config_block = [haproxy_config.Bind("0.0.0.0", port, None)]
+            frontend = haproxy_config.Frontend(
+                "relation-{}".format(port), "0.0.0.0", port, config_block
+            )
+            self._set_frontend_maxconn(frontend)
+            self.proxy_config.frontends.append(frontend)
+            self.update_binds(frontend)
+
+        return frontend
+
+    def get_backend(self, name=None, create=True, slots=0):
+        """Find the confiured backend based on the provided name, creating as needed.
+
+        A backend created with slots reserves that many server slots for
+        units to be bound to, see bind_slot.
+        """
+        backend = self.proxy_index.backend(name)
+
+        if not backend and create:
+            log("Creating backend {}".format(name))
+            backend = haproxy_config.Backend(name=name, config_block=[])
+
+            if slots:
+                self._set_free_slots(backend, range(1, slots + 1), "0.0.0.0:0", "")
+            self.proxy_config.backends.append(backend)
+
+        return backend
+
+    @staticmethod
+    def slot_pool(backend):
+        """Return the server slots of a backend.
+
+        The dict returned holds the bound servers by slot number, the set
+        of free slot numbers, the pool size and the server attributes.
+        """
+        bound = {}
+        free = set()
+        attributes = set()
+
+        for server in backend.servers():
+            match = SLOT_NAME.match(server.name)
+
+            if match:
+                bound[int(match.group(1))] = server
+                attributes.add(" ".join(server.attributes).strip())
+
+        for config in backend.config_block.lookup("config", "server-template"):
+            match = SLOT_TEMPLATE.match(config.value.strip())
+
+            if match:
+                free.update(range(int(match.group(1)), int(match.group(2)) + 1))
+                attributes.add(match.group(4).strip())
+
+        return {
+            "bound": bound,
+            "free": free,
+            "size": max(set(bound) | free, default=0),
+            "attributes": sorted(attributes),
+        }
+
+    @staticmethod
+    def _is_slot_line(line):
+        if isinstance(line, haproxy_config.Server):
+            return SLOT_NAME.match(line.name) is not None
+
+        return (
+            isinstance(line, haproxy_config.Config)
+            and line.keyword == "server-template"
+            and SLOT_TEMPLATE.match(line.value.strip()) is not None
+        )
+
+    def _set_free_slots(self, backend, free, address, attributes):
+        """Replace the server-template lines of a backend to hold the free slots."""
+        for config in backend.config_block.lookup("config", "server-template"):
+            if self._is_slot_line(config):
+                backend.config_block.remove(config)
+        free = sorted(free)
+        runs = []
+
+        for slot in free:
+            if runs and slot == runs[-1][-1] + 1:
+                runs[-1].append(slot)
+            else:
+                runs.append([slot])
+
+        for run in runs:
+            backend.add_config(
+                haproxy_config.Config(
+                    "server-template",
+                    "slot {}-{} {} disabled {}".format(
+                        run[0], run[-1], address, attributes
+                    ).rstrip(),
+                )
+            )
+
+    def bind_slot(self, backend, unit, host, port, attributes, slots):
+        """Bind a unit to a free server slot of a backend.
+
+        A unit is given back the slot it last had if it is still free.
+        When the pool is full it is doubled, or grown to slots if larger.
+        """
+        pool = self.slot_pool(backend)
+        free = pool["free"]
+        kv = unitdata.kv()
+        assigned = kv.get("haproxy.slots", {})
+        units = assigned.setdefault(backend.name, {})
+        slot = units.get(unit)
+
+        if slot in pool["bound"]:
+            backend.config_block.remove(pool["bound"].pop(slot))
+            free.add(slot)
+
+        if slot not in free:
+            if not free:
+                size = max(pool["size"] * 2, slots)
+                log(
+                    "Growing the server slots of {} to {}".format(backend.name, size),
+                    "INFO",
+                )
+                free.update(range(pool["size"] + 1, size + 1))
+            slot = min(free)
+        free.discard(slot)
+
+        for other in [other for other, number in units.items() if number == slot]:
+            del units[other]
+        units[unit] = slot
+        kv.set("haproxy.slots", assigned)
+        log("Binding {} to {}/slot{}".format(unit, backend.name, slot), "DEBUG")
+
+        # The slots of a backend share their attributes, a change of them
+        # is only applied by a reload
+        for server in pool["bound"].values():
+            server.attributes = list(attributes)
+        self._set_free_slots(
+            backend, free, "0.0.0.0:{}".format(port), " ".join(attributes)
+        )
+        backend.add_server(
+            haproxy_config.Server(
+                name="slot{}".format(slot), host=host, port=port, attributes=attributes
+            )
+        )
+
+    def release_slots(self, unit):
+        """Free the server slots bound to a unit."""
+        assigned = unitdata.kv().get("haproxy.slots", {})
+
+        for backend_name, units in assigned.items():
+            backend = self.proxy_index.backend(backend_name)
+
+            if unit not in units or backend is None:
+                continue
+            pool = self.slot_pool(backend)
+            server = pool["bound"].get(units[unit])
+
+            if server is None:
+                continue
+            log("Releasing {}/slot{}".format(backend_name, units[unit]), "DEBUG")
+            backend.config_block.remove(server)
+            self._set_free_slots(
+                backend,
+                pool["free"] | {units[unit]},
+                "0.0.0.0:{}".format(server.port),
+                " ".join(server.attributes),
+            )
+
+    def unit_servers(self, unit):
+        """Return the backend and server names of a relation unit's servers."""
+        servers = [
+            (be.name, unit) for be in self.proxy_index.owners("server", unit, "backend")
+        ]
+
+        for backend_name, units in unitdata.kv().get("haproxy.slots", {}).items():
+            backend = self.proxy_index.backend(backend_name)
+
+            if unit in units and backend is not None:
+                if units[unit] in self.slot_pool(backend)["bound"]:
+                    servers.append((backend_name, "slot{}".format(units[unit])))
+
+        return servers
+
+    def find_servers(self, name):
+        """Return the servers named backend/server, or those of a juju unit."""
+        backend_name, _, server_name = name.partition("/")
+        backend = self.proxy_index.backend(backend_name)
+
+        if backend is not None and backend.config_block.first("server", server_name):
+            return [(backend_name, server_name)]
+        routes = unitdata.kv().get("haproxy.routes", {})
+        servers = []
+
+        for unit_name, _ in self.get_config_names(routes.get(name, []), name):
+            servers.extend(self.unit_servers(unit_name))
+
+        return servers
+
+    def server_sessions(self, servers):
+        """Return the current sessions of servers that have any, by name."""
+        wanted = set(servers)
+
+        return {
+            "{}/{}".format(stat["pxname"], stat["svname"]): stat["scur"]
+
+            for stat in self.runtime.show_stat("-1 4 -1")
+
+            if (stat["pxname"], stat["svname"]) in wanted and stat["scur"]
+        }
+
+    def drain_servers(self, servers, timeout=None):
+        """Put servers in drain and wait for their sessions to end.
+
+        Waits up to timeout seconds, the drain-timeout config by default.
+        Returns the sessions still open by server name, or None if the
+        runtime API couldn't be used.
+        """
+        import haproxy_runtime
+
+        if not servers:
+            return {}
+
+        if timeout is None:
+            timeout = self.charm_config.get("drain-timeout") or 0
+        names = ["{}/{}".format(*server) for server in servers]
+        log("Draining {} for up to {}s".format(", ".join(names), timeout), "INFO")
+        deadline = time.monotonic() + timeout
+
+        try:
+            self.runtime.run(*["set server {} state drain".format(name) for name in names])
+            sessions = self.server_sessions(servers)
+
+            while sessions and time.monotonic() < deadline:
+                time.sleep(1)
+                sessions = self.server_sessions(servers)
+        except haproxy_runtime.RuntimeAPIError as error:
+            log("Could not drain {}: {}".format(", ".join(names), error), "WARNING")
+
+            return None
+
+        if sessions:
+            log("Sessions left after draining: {}".format(sessions), "WARNING")
+
+        return sessions
+
+    def ready_servers(self, servers):
+        """Put servers back in service, returning False if it failed."""
+        import haproxy_runtime
+
+        try:
+            self.runtime.run(
+                *["set server {}/{} state ready".format(*server) for server in servers]
+            )
+        except haproxy_runtime.RuntimeAPIError as error:
+            log("Could not set servers ready: {}".format(error), "WARNING")
+
             return False
 
-        if len(frontend.usebackends()):
-            valid_backend = False
+        return True
+
+    def map_path(self, frontend, kind):
+        """Return the path of a frontend's host or path routing map."""
+        return os.path.join(self.map_dir, "{}-{}.map".format(frontend.name, kind))
+
+    def add_map_entries(self, frontend, unit, backend_name, config):
+        """Route the subdomain and urlbase of a unit through map files.
+
+        The frontend gets one use_backend rule per map, looking the backend
+        up in it, so the rules don't grow with the number of routes.
+        """
+        entries = []
+
+        if config["subdomain"]:
+            entries.append(("host", config["subdomain"].lower()))
+
+        if config["urlbase"]:
+            entries.append(("exact", config["urlbase"]))
+            entries.append(("path", config["urlbase"] + "/"))
+        kv = unitdata.kv()
+        maps = kv.get("haproxy.maps", {})
+
+        for kind, key in entries:
+            path = self.map_path(frontend, kind)
+            maps.setdefault(path, {}).setdefault(unit, []).append([key, backend_name])
+            self._add_map_rule(frontend, kind)
+        kv.set("haproxy.maps", maps)
+
+    def _add_map_rule(self, frontend, kind):
+        """Add the use_backend rule looking a request up in a frontend map.
+
+        Hosts are matched before paths, as when both are acls, and a bare
+        urlbase before the prefixes, so the rules are kept in MAP_ORDER.
+        """
+        path = self.map_path(frontend, kind)
+        fetch = MAP_FETCHES[kind].format(path)
+
+        if frontend.config_block.first("backend", "%[{}]".format(fetch)):
+            return
+        log("Routing {} through {}".format(frontend.name, path), "INFO")
+        frontend.add_usebackend(
+            haproxy_config.UseBackend(
+                backend_name="%[{}]".format(fetch),
+                operator="if",
+                backend_condition="{{ {} -m found }}".format(fetch),
+            )
+        )
+
+        for later in MAP_ORDER[MAP_ORDER.index(kind) + 1:]:
+            rule = frontend.config_block.first(
+                "backend",
+                "%[{}]".format(MAP_FETCHES[later].format(self.map_path(frontend, later))),
+            )
+
+            if rule is not None:
+                frontend.config_block.remove(rule)
+                frontend.add_usebackend(rule)
+
+    def upgrade_path_maps(self, save=True):
+        """Move path routes from map_dir lookups to anchored prefix maps.
+
+        map_dir matched the urlbase anywhere in the path, the entries and
+        rules written for it by earlier versions of the charm are replaced.
+        """
+        kv = unitdata.kv()
+        maps = kv.get("haproxy.maps", {})
+        upgraded = False
+
+        for frontend in self.proxy_config.frontends:
+            old = "%[path,map_dir({})]".format(self.map_path(frontend, "path"))
+            rules = frontend.config_block.lookup("backend", old)
+
+            if not rules:
+                continue
+            log("Moving the path routes of {} to prefix maps".format(frontend.name), "INFO")
+
+            for rule in list(rules):
+                frontend.config_block.remove(rule)
+            units = maps.get(self.map_path(frontend, "path"), {})
+
+            for unit, unit_entries in units.items():
+                maps.setdefault(self.map_path(frontend, "exact"), {})[unit] = [
+                    [key, value] for key, value in unit_entries
+                ]
+                units[unit] = [[key + "/", value] for key, value in unit_entries]
+
+            for kind in ("exact", "path"):
+                if units:
+                    self._add_map_rule(frontend, kind)
+            upgraded = True
+        kv.set("haproxy.maps", maps)
+
+        if upgraded and save:
+            self.save_config()
+
+    def remove_map_entries(self, unit):
+        """Drop the map entries of a unit, and the rules of maps left empty."""
+        kv = unitdata.kv()
+        maps = kv.get("haproxy.maps", {})
+        emptied = [
+            path
+
+            for path, units in maps.items()
+
+            if units.pop(unit, None) is not None and not units
+        ]
+
+        for path in emptied:
+            del maps[path]
+
+            for fetch in MAP_FETCHES.values():
+                name = "%[{}]".format(fetch.format(path))
+
+                for fe in self.proxy_index.owners("backend", name, "frontend"):
+                    for ub in fe.config_block.lookup("backend", name):
+                        fe.config_block.remove(ub)
+        kv.set("haproxy.maps", maps)
+
+    def map_entries(self):
+        """Return the entries of every routing map, by path.
+
+        Longer keys go first, so the most specific prefix matches.
+        """
+        entries = {}
+
+        for path, units in unitdata.kv().get("haproxy.maps", {}).items():
+            keys = {}
+
+            for unit_entries in units.values():
+                for key, value in unit_entries:
+                    keys.setdefault(key, value)
+            entries[path] = [
+                [key, keys[key]] for key in sorted(keys, key=lambda key: (-len(key), key))
+            ]
+
+        return entries
+
+    def render_maps(self):
+        """Render the routing map files, by path."""
+        return {
+            path: "".join("{} {}\n".format(key, value) for key, value in entries).encode(
+                "utf-8"
+            )
+
+            for path, entries in self.map_entries().items()
+        }
+
+    def clean_config(self, unit, backend_name, save=True):
+        """Clean the configuration of uneeded sections."""
+        # HAProxy units can't have / character
+        # replace it so it doesn't fail on a common error
+        # from passing in the juju unit
+        unit = unit.replace("/", "-")
+        backend_name = backend_name.replace("/", "-")
+        log("Cleaning unit,backend: {},{}".format(unit, backend_name), "DEBUG")
+
+        self._remove_unit(unit)
+        self._prune_sections()
+
+        if save:
+            self.save_config()
+
+    def _remove_unit(self, unit):
+        """Remove a unit's frontend and server lines."""
+        index = self.proxy_index
+
+        # Remove acls and use_backend statements from frontends
+        # Match on name or condition, name is needed for TCP
+        # frontends which use 'default_backend'
+
+        for kind in ("use_backend", "backend"):
+            for fe in index.owners(kind, unit, "frontend"):
+                for ub in fe.config_block.lookup(kind, unit):
+                    # Direct removal from config_block b/c the name will
+                    # match others in a group since it isn't unique
+                    fe.config_block.remove(ub)
+
+        for fe in index.owners("acl", unit, "frontend"):
+            for acl in fe.config_block.lookup("acl", unit):
+                fe.config_block.remove(acl)
+
+        # Remove server statements from backends
+
+        for be in index.owners("server", unit, "backend"):
+            for server in be.config_block.lookup("server", unit):
+                be.config_block.remove(server)
+        self.release_slots(unit)
+        self.remove_map_entries(unit)
+
+    def _prune_sections(self):
+        """Remove relation frontends and backends left with nothing to route."""
+        # Remove any backend with no server, and the lines routing to it
+        backends = [
+            be for be in self.proxy_config.backends if be.config_block.total("server")
+        ]
+
+        if len(backends) != len(self.proxy_config.backends):
+            removed = [
+                be.name
+
+                for be in self.proxy_config.backends
+
+                if not be.config_block.total("server")
+            ]
+            self.proxy_config.backends[:] = backends
+
+            for name in removed:
+                for fe in self.proxy_index.owners("backend", name, "frontend"):
+                    for ub in fe.config_block.lookup("backend", name):
+                        fe.config_block.remove(ub)
+
+                    if not fe.config_block.lookup("use_backend", name):
+                        for acl in fe.config_block.lookup("acl", name):
+                            fe.config_block.remove(acl)
+
+        # Remove any relation frontend if it doesn't have use_backend
+        frontends = [
+            fe
+
+            for fe in self.proxy_config.frontends
+
+            if fe.config_block.total("use_backend") > 0
+            or not fe.name.startswith("relation")
+        ]
+
+        if len(frontends) != len(self.proxy_config.frontends):
+            self.proxy_config.frontends[:] = frontends
+
+    @contextmanager
+    def transaction(self):
+        """Defer saving and reloading until the outermost transaction exits.
+
+        Nested transactions join the outermost one. Pending changes are
+        dropped if the outermost transaction exits with an exception.
+        """
+        self.begin()
+        try:
+            yield self
+        except Exception:
+            self.abort()
+            raise
+        self.commit()
+
+    @contextmanager
+    def action(self):
+        """Run an action as a transaction and keep the unit state it changed.
+
+        Hooks commit the unit state when they exit, actions don't, so it is
+        flushed here once the action succeeded.
+        """
+        with self.transaction():
+            yield self
+        unitdata.kv().flush()
+
+    def begin(self):
+        """Open a transaction, see transaction()."""
+        self._transaction_depth += 1
+
+    def commit(self):
+        """Close a transaction, applying pending changes if it is the outermost."""
+        self._transaction_depth -= 1
+
+        if not self._transaction_depth:
+            self.flush()
+
+    def abort(self):
+        """Close a transaction, dropping pending changes if it is the outermost."""
+        self._transaction_depth -= 1
+
+        if not self._transaction_depth:
+            self._pending_save = False
+            self._pending_reload = False
+
+    def begin_hook_transaction(self):
+        """Open a transaction that is committed when the hook completes."""
+        self.begin()
+        hookenv.atexit(self.commit)
+
+    def flush(self):
+        """Apply pending changes now, even inside a transaction.
+
+        Returns the outcome of writing the config, see _write_config, None
+        if nothing was pending.
+        """
+        if self._pending_save:
+            self._pending_save = False
+            self._pending_reload = False
+
+            return self._write_config()
+        elif self._pending_reload:
+            self._pending_reload = False
+
+            return "failed" if self._reload_service() is False else "applied"
+        elif unitdata.kv().get("haproxy.reload.pending") and not self._reload_wait():
+            log("Applying the deferred reload", "INFO")
+
+            return self._write_config()
+
+        return None
+
+    def save_config(self):
+        """Save the updated configuration.
+
+        Returns the outcome, see _write_config, None if deferred to the end
+        of a transaction.
+        """
+        if self._transaction_depth:
+            log("Deferring config save to end of transaction", "DEBUG")
+            self._pending_save = True
+
+            return None
+
+        return self._write_config()
+
+    def apply_config(self):
+        """Save the configuration now, even inside a transaction.
+
+        Returns the outcome, see _write_config.
+        """
+        self._pending_save = True
+
+        return self.flush()
+
+    def config_status(self, outcome):
+        """Return the relation status for the outcome of applying the config."""
+        if outcome == "failed":
+            error = self.config_error()
+
+            if error:
+                return {"cfg_good": False, "msg": "config check failed: {}".format(error)}
+
+            return {"cfg_good": False, "msg": "reload failed"}
+
+        if outcome == "pending":
+            return {"cfg_good": True, "msg": "reload pending"}
+
+        return {"cfg_good": True, "msg": "configuration applied"}
 
-            for ub in frontend.usebackends():
-                if ub.backend_name == backend_name:
-                    valid_backend = True
-                # also check for legacy backend name in
-                # case we've upgrades
+    def reload_haproxy(self):
+        """Reload haproxy, deferred to the end of any open transaction."""
+        if self._transaction_depth:
+            self._pending_reload = True
 
-                if ub.backend_name == self.legacy_name(backend_name):
-                    valid_backend = True
+            return
+        self._reload_service()
 
-            if not valid_backend:
-                return False
+    def _write_config(self, restart=False):
+        """Write the changed config files and reload haproxy to apply them.
 
-        return True
+        Returns "unchanged", "applied", "pending" if the reload waits for
+        the reload window or "failed" if haproxy couldn't load the config.
+        """
+        kv = unitdata.kv()
 
-    def enable_stats(self, save=True):
-        """Enable the stats enpoint."""
-        # Remove any previous stats
-        self.disable_stats(save=False)
+        if self.fragments_active() and not self.fragments_supported():
+            # A local edit added defaults, splitting it would change which
+            # defaults apply to which proxy
+            error = "config-fragments needs a single defaults section"
+            log(error, "ERROR")
+            kv.set("haproxy.config.error", error)
+            self._rollback_state()
 
-        # Check that no frontend exists with conflicting port
+            return "failed"
 
-        if (
-            self.get_frontend(port=self.charm_config["stats-port"], create=False)
-            is not None
-        ):
-            hookenv.log(
-                "Stats port {} already in use".format(self.charm_config["stats-port"]),
-                "ERROR",
-            )
+        if self.fragments_active():
+            files = self.render_fragments()
+            stale = [
+                path
 
-            if save:
-                self.save_config()
+                for path in glob.glob(os.path.join(self.proxy_config_dir, "*.cfg"))
 
-            return False
+                if path not in files
+            ]
+        else:
+            files = {
+                self.proxy_config_file: haproxy_config.render(self.proxy_config).encode(
+                    "utf-8"
+                )
+            }
+            stale = []
+        config_paths = list(files)
+        maps = self.render_maps()
+        files.update(maps)
+        stale.extend(
+            path
 
-        # Generate new front end for stats
-        user_string = "{}:{}".format(
-            self.charm_config["stats-user"], self.charm_config["stats-passwd"]
-        )
-        config_block = []
-        config_block.append(
-            haproxy_config.Bind("0.0.0.0", self.charm_config["stats-port"], None)
-        )
-        config_block.append(haproxy_config.Config("stats enable", ""))
-        config_block.append(
-            haproxy_config.Config("stats auth {}".format(user_string), "")
-        )
-        config_block.append(
-            haproxy_config.Config(
-                "stats uri {}".format(self.charm_config["stats-url"]), ""
-            )
+            for path in glob.glob(os.path.join(self.map_dir, "*.map"))
+
+            if path not in maps
         )
+        fingerprints = {
+            path: hashlib.sha256(content).hexdigest() for path, content in files.items()
+        }
+        fingerprint = hashlib.sha256(
+            "".join(sorted(fingerprints.values())).encode("utf-8")
+        ).hexdigest()
+        applied = kv.get("haproxy.applied_config")
+
+        if not isinstance(applied, dict):
+            applied = {}
+        changed = [
+            path
+
+            for path in sorted(files)
+
+            if applied.get(path, False) != self._file_state(path, fingerprints[path])
+        ]
 
-        if self.charm_config["stats-local"]:
-            config_block.append(
-                haproxy_config.Acl(
-                    "local",
-                    (
-                        "src 10.0.0.0/8 "
-                        "172.16.0.0/12 "
-                        "192.168.0.0/16 "
-                        "127.0.0.0/8 "
-                        "fd00::/8 "
-                        "fe80::/10 "
-                        "::1/128"
-                    ),
-                )
+        if not changed and not stale:
+            log(
+                "Config unchanged ({}), skipping write and reload".format(
+                    fingerprint[:12]
+                ),
+                "INFO",
             )
-            config_block.append(
-                haproxy_config.Config("http-request deny if !local", "")
+            outcome = "unchanged"
+            kv.unset("haproxy.config.error")
+            self._commit_state()
+        else:
+            log(
+                "Config changed ({}), writing {} and removing {} files".format(
+                    fingerprint[:12], len(changed), len(stale)
+                ),
+                "INFO",
             )
-        frontend = haproxy_config.Frontend(
-            "stats", "0.0.0.0", str(self.charm_config["stats-port"]), config_block
-        )
-        self.proxy_config.frontends.append(frontend)
 
-        if save:
-            self.save_config()
+            state = self._runtime_state()
+            commands = None
 
-        return True
+            if not restart and not stale:
+                commands = self._runtime_commands(applied, changed, state)
 
-    def disable_stats(self, save=True):
-        """Disable the stats endpoint."""
-        # Remove any previous stats frontend
-        self.proxy_config.frontends[:] = [
-            fe for fe in self.proxy_config.frontends if fe.name != "stats"
-        ]
+            if changed:
+                error = self.check_config(
+                    {path: files[path] for path in config_paths}, maps
+                )
 
-        if save:
-            self.save_config()
+                if error:
+                    kv.set("haproxy.config.error", error)
+                    self._rollback_state()
+                    self.update_ports()
 
-    def enable_redirect(self, save=True):
-        """Enable the generic redirect to HTTPS."""
-        backend_name = "redirect"
+                    return "failed"
+            kv.unset("haproxy.config.error")
+            self._commit_state()
 
-        # remove any prevoius configureation
-        self.disable_redirect(save=False)
+            if maps:
+                os.makedirs(self.map_dir, exist_ok=True)
 
-        # Get or create frontend 80
-        frontend = self.get_frontend(port=80)
+            for path in changed:
+                self._replace_file(path, files[path])
 
-        # Add use_backend section to the frontend
-        use_backend = haproxy_config.UseBackend(
-            backend_name=backend_name,
-            operator="",
-            backend_condition="",
-            is_default=True,
-        )
-        frontend.add_usebackend(use_backend)
+            for path in stale:
+                os.unlink(path)
+            self._save_cache(
+                self._cache_key({path: fingerprints[path] for path in config_paths}),
+                self.proxy_config,
+            )
 
-        # Get the backend, create if not present
-        backend = self.get_backend(backend_name)
+            # Only remember the config once haproxy has loaded it so a
+            # failed reload is retried on the next save
+            kv.unset("haproxy.applied_config")
+
+            outcome = "applied"
+
+            if commands is not None and self._run_runtime_commands(commands):
+                applied = True
+            elif not restart and self._reload_wait():
+                # Applied by the first hook after the window, at the latest
+                # on update-status
+                kv.set("haproxy.reload.pending", True)
+                log(
+                    "Deferring reload for {:.0f}s of the reload window".format(
+                        self._reload_wait()
+                    ),
+                    "INFO",
+                )
+                applied = False
+                outcome = "pending"
+            else:
+                applied = self._reload_service(restart)
 
-        # Add redirect option to the backend
-        redirect_config = haproxy_config.Config("redirect scheme https", "")
-        backend.add_config(redirect_config)
+                if applied is False:
+                    outcome = "failed"
 
-        # Add server so clean won't remove it
-        server = haproxy_config.Server(name=backend_name, host="127.0.0.1", port=0)
-        backend.add_server(server)
+            if applied is not False:
+                kv.set(
+                    "haproxy.applied_config",
+                    {
+                        path: self._file_state(path, fingerprints[path])
 
-        # Render new cfg file
+                        for path in files
+                    },
+                )
+                kv.set("haproxy.runtime.applied", state)
 
-        if save:
-            self.save_config()
+        # Check the juju ports match the config
+        self.update_ports()
 
-    def disable_redirect(self, save=True):
-        """Disable the generic redirect to HTTPS."""
-        backend_name = "redirect"
+        if self.charm_config.get("tune-host"):
+            self.update_host_tuning()
 
-        # Remove the redirect backend
+        return outcome
 
-        for fe in self.proxy_config.frontends:
-            fe.remove_usebackend(backend_name)
+    @staticmethod
+    def _commit_state():
+        """Record the unit state of the config being written."""
+        kv = unitdata.kv()
+        kv.set("haproxy.config.state", {key: kv.get(key) for key in CONFIG_STATE})
 
-        # Clean the config
-        self.clean_config(unit=backend_name, backend_name=backend_name, save=save)
+    def _rollback_state(self):
+        """Go back to the config and unit state last written.
 
-    def get_frontend(self, port=None, create=True):
-        """Find the frontend for the requested port."""
-        port = str(port)
-        frontend = None
+        The rejected changes are dropped, so map entries, slots and listener
+        options of a config haproxy never loaded aren't written later.
+        """
+        kv = unitdata.kv()
+        state = kv.get("haproxy.config.state", {})
 
-        for fe in self.proxy_config.frontends:
-            hookenv.log("Checking frontend for port {}".format(port), "DEBUG")
-            hookenv.log("Port is: {}".format(fe.port), "DEBUG")
+        for key in CONFIG_STATE:
+            if state.get(key) is None:
+                kv.unset(key)
+            else:
+                kv.set(key, state[key])
+        self._proxy_config = None
 
-            if fe.port == port:
-                hookenv.log("Using previous frontend", "DEBUG")
-                frontend = fe
+    def _runtime_state(self):
+        """Return what the runtime API can change and a fingerprint of the rest.
 
-                break
+        That is the units bound to server slots and the map entries, so
+        configs with the same fingerprint only differ in those.
+        """
+        parts = []
+        proxies = []
+        servers = {}
 
-        if frontend is None and create:
-            hookenv.log("Creating frontend for port {}".format(port), "INFO")
-            config_block = [haproxy_config.Bind("0.0.0.0", port, None)]
-            frontend = haproxy_config.Frontend(
-                "relation-{}".format(port), "0.0.0.0", port, config_block
-            )
-            self.proxy_config.frontends.append(frontend)
+        for section in self.proxy_config.sections():
+            lines = section.config_block
+            slots = ""
 
-        return frontend
+            if isinstance(section, haproxy_config.Backend):
+                pool = self.slot_pool(section)
 
-    def get_backend(self, name=None, create=True):
-        """Find the confiured backend based on the provided name, creating as needed."""
-        backend = None
+                if pool["size"]:
+                    servers[section.name] = {
+                        str(slot): [server.host, str(server.port)]
 
-        for be in self.proxy_config.backends:
-            if be.name == name:
-                backend = be
+                        for slot, server in pool["bound"].items()
+                    }
+                    lines = [line for line in lines if not self._is_slot_line(line)]
+                    slots = "slots {} {}\n".format(pool["size"], pool["attributes"])
+            text = section.header() + "".join(line.render() for line in lines) + slots
+
+            # Proxies are referred to by name, so only the defaults section
+            # they follow matters and not their order, which changes when
+            # one is removed and added back
+            if isinstance(section, (haproxy_config.Listen, haproxy_config.Backend)):
+                proxies.append(text)
+            else:
+                parts.extend(sorted(proxies))
+                parts.append(text)
+                proxies = []
+        parts.extend(sorted(proxies))
+        digest = hashlib.sha256("".join(parts).encode("utf-8"))
+
+        return {
+            "fingerprint": digest.hexdigest(),
+            "servers": servers,
+            "maps": self.map_entries(),
+        }
+
+    def _runtime_commands(self, applied, changed, state):
+        """Return the runtime API commands applying the slot and map changes.
+
+        None is returned if anything else changed, or if haproxy may not be
+        running the files as they were last written.
+        """
+        import ipaddress
+
+        previous = unitdata.kv().get("haproxy.runtime.applied")
+
+        if not previous or previous["fingerprint"] != state["fingerprint"]:
+            return None
+
+        for path in changed:
+            recorded = applied.get(path)
+
+            if not recorded or recorded != self._file_state(path, recorded[0]):
+                return None
+        commands = []
+
+        for backend_name, servers in sorted(state["servers"].items()):
+            old = previous["servers"].get(backend_name, {})
+
+            for slot in sorted(set(old) | set(servers), key=int):
+                server = "{}/slot{}".format(backend_name, slot)
+
+                if slot not in servers:
+                    commands.append("set server {} state maint".format(server))
+                elif servers[slot] != old.get(slot):
+                    host, port = servers[slot]
+
+                    # Only addresses can be set without resolvers
+                    try:
+                        ipaddress.ip_address(host)
+                    except ValueError:
+                        return None
+                    commands.append(
+                        "set server {} addr {} port {}".format(server, host, port)
+                    )
+                    commands.append("set server {} state ready".format(server))
+
+        for path, entries in sorted(state["maps"].items()):
+            old = dict(previous["maps"].get(path, []))
+            new = dict(entries)
+
+            for key in sorted(set(old) - set(new)):
+                commands.append("del map {} {}".format(path, key))
+
+            for key, value in entries:
+                if key not in old:
+                    # Added entries go last, which is only the same as the
+                    # longest first order of the file if no prefix overlaps
+                    if any(
+                        other != key and (other.startswith(key) or key.startswith(other))
+                        for other in new
+                    ):
+                        return None
+                    commands.append("add map {} {} {}".format(path, key, value))
+                elif old[key] != value:
+                    commands.append("set map {} {} {}".format(path, key, value))
+
+        return commands
+
+    def _run_runtime_commands(self, commands):
+        """Apply changes through the runtime API, returning if it worked."""
+        import haproxy_runtime
+
+        if not commands:
+            return True
 
-        if not backend and create:
-            hookenv.log("Creating backend {}".format(name))
-            backend = haproxy_config.Backend(name=name, config_block=[])
-            self.proxy_config.backends.append(backend)
+        try:
+            self.runtime.run(*commands)
+        except haproxy_runtime.RuntimeAPIError as error:
+            log("Runtime API update failed, reloading: {}".format(error), "WARNING")
 
-        return backend
+            return False
+        log("Applied {} runtime API commands without a reload".format(len(commands)))
 
-    def clean_config(self, unit, backend_name, save=True):
-        """Clean the configuration of uneeded sections."""
-        # HAProxy units can't have / character
-        # replace it so it doesn't fail on a common error
-        # from passing in the juju unit
-        unit = unit.replace("/", "-")
-        backend_name = backend_name.replace("/", "-")
-        hookenv.log("Cleaning unit,backend: {},{}".format(unit, backend_name), "DEBUG")
+        return True
 
-        # Remove acls and use_backend statements from frontends
+    @staticmethod
+    def _file_state(path, fingerprint):
+        """Return what is recorded to tell if a written file was changed since."""
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        return [fingerprint, stat.st_size, stat.st_mtime_ns]
+
+    @staticmethod
+    def _replace_file(path, content, mode=None):
+        """Atomically replace path with content, keeping its mode by default."""
+        directory, name = os.path.split(path)
+
+        if mode is None:
+            try:
+                mode = os.stat(path).st_mode & 0o777
+            except FileNotFoundError:
+                mode = 0o644
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".{}.".format(name))
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                tmp_file.write(content)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.chmod(tmp_path, mode)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def opened_ports(self):
+        """Return the ports juju has opened, mapped to the range holding them.
+
+        opened-ports is only run once, later changes are tracked so the
+        snapshot can be used for the rest of the hook.
+        """
+        if self._opened_ports is None:
+            self._opened_ports = {}
+            output = str(subprocess.check_output(["opened-ports"]), "utf-8")
+
+            for entry in output.split():
+                ports, _, protocol = entry.partition("/")
+
+                if protocol.lower() != "tcp":
+                    continue
+                start, _, end = ports.partition("-")
+
+                for port in range(int(start), int(end or start) + 1):
+                    self._opened_ports[str(port)] = ports
+            log("Opened ports {}".format(sorted(self._opened_ports, key=int)), "DEBUG")
+
+        return self._opened_ports
+
+    def listener_ports(self):
+        """Return the ports haproxy listens on, stats included, in order."""
+        ports = set()
 
-        for fe in self.proxy_config.frontends:
-            for ub in fe.usebackends():
-                # Match on name or condition, name is needed for TCP
-                # frontends which use 'default_backend'
+        for frontend in self.proxy_config.frontends:
+            port = str(frontend.port)
 
-                if ub.backend_condition == unit or ub.backend_name == unit:
-                    # Direct removal from config_block b/c the name will
-                    # match others in a group since it isn't unique
-                    fe.config_block.remove(ub)
+            if port.isdigit() and int(port):
+                ports.add(port)
 
-            for acl in fe.acls():
-                if acl.name == unit:
-                    fe.remove_acl(acl.name)
+        return sorted(ports, key=int)
 
-        # Remove server statements from backends
+    def wanted_ports(self):
+        """Return the ports the frontends need opened."""
+        ports = set()
 
-        for be in self.proxy_config.backends:
-            for server in be.servers():
-                if server.name == unit:
-                    be.remove_server(server.name)
-                    # be.config_block.remove(server)
+        for frontend in self.proxy_config.frontends:
+            port = str(frontend.port)
 
-        # Remove any relation frontend if it doesn't have use_backend
-        self.proxy_config.frontends[:] = [
-            fe
+            if not port.isdigit() or not int(port):
+                continue
 
-            for fe in self.proxy_config.frontends
+            if (
+                self.charm_config["enable-stats"]
+                and self.charm_config["stats-local"]
+                and self.charm_config["stats-port"] == int(port)
+            ):
+                log("Not opening stats port {}".format(port), "DEBUG")
 
-            if len(fe.usebackends()) > 0 or not fe.name.startswith("relation")
-        ]
+                continue
+            ports.add(port)
 
-        # Remove any backend with no server
-        self.proxy_config.backends[:] = [
-            be for be in self.proxy_config.backends if len(be.servers()) > 0
-        ]
+        return ports
 
-        if save:
-            self.save_config()
+    def _close_ports(self, ranges):
+        """Close port ranges, given as juju lists them, and drop their ports."""
+        opened = self.opened_ports()
 
-    def save_config(self):
-        """Save the updated configuration."""
-        # Render new cfg file
-        Render(self.proxy_config).dumps_to(self.proxy_config_file)
-        host.service_reload("haproxy.service")
+        for ports in sorted(ranges):
+            log("Closing port {}".format(ports), "DEBUG")
+            start, _, end = ports.partition("-")
 
-        # Check the juju ports match the config
-        self.update_ports()
+            if end:
+                hookenv.close_ports(start, end)
+            else:
+                hookenv.close_port(start)
 
-    def update_ports(self):
-        """Update open ports based on configuration so that Juju can expose them."""
-        opened_ports = str(subprocess.check_output(["opened-ports"]), "utf-8").split(
-            "/tcp\n"
+            for port in [port for port, held in opened.items() if held == ports]:
+                del opened[port]
+
+    def update_ports(self, refresh=False):
+        """Update open ports based on configuration so that Juju can expose them.
+
+        Only the difference to the opened ports is applied. With refresh,
+        every wanted port is opened again so UPnP forwards are renewed.
+        """
+        opened = self.opened_ports()
+        wanted = self.wanted_ports()
+
+        # A range is closed whole, its ports that are still wanted are
+        # opened again below
+        self._close_ports(
+            {ports for port, ports in opened.items() if port not in wanted}
         )
-        hookenv.log("Opened ports {}".format(opened_ports), "DEBUG")
 
-        for frontend in self.proxy_config.frontends:
-            if frontend.port in opened_ports:
-                if (
-                    self.charm_config["enable-stats"]
-                    and self.charm_config["stats-local"]
-                    and self.charm_config["stats-port"] == int(frontend.port)
-                ):
-                    hookenv.log(
-                        "Stats port set to be closed {}".format(frontend.port), "DEBUG"
-                    )
+        if refresh:
+            missing = sorted(wanted, key=int)
+        else:
+            missing = sorted(wanted.difference(opened), key=int)
+
+        if not missing:
+            return
+
+        # UPnP forwards are requested per port, otherwise adjacent ports
+        # are opened with one call
+        if refresh or self.charm_config.get("enable-upnp"):
+            runs = [[port] for port in missing]
+        else:
+            runs = [[missing[0]]]
+
+            for port in missing[1:]:
+                if int(port) == int(runs[-1][-1]) + 1:
+                    runs[-1].append(port)
                 else:
-                    hookenv.log("Port already open {}".format(frontend.port), "DEBUG")
-                    opened_ports.remove(frontend.port)
+                    runs.append([port])
+
+        for run in runs:
+            if len(run) == 1:
+                log("Opening {}".format(run[0]), "DEBUG")
+                hookenv.open_port(run[0])
+                ports = run[0]
             else:
-                if (
-                    self.charm_config["enable-stats"]
-                    and self.charm_config["stats-local"]
-                    and self.charm_config["stats-port"] == int(frontend.port)
-                ):
-                    hookenv.log(
-                        "Not opening stats port {}".format(frontend.port), "DEBUG"
-                    )
-                else:
-                    hookenv.log("Opening {}".format(frontend.port), "DEBUG")
-                    hookenv.open_port(frontend.port)
+                ports = "{}-{}".format(run[0], run[-1])
+                log("Opening {}".format(ports), "DEBUG")
+                hookenv.open_ports(run[0], run[-1])
 
-        for port in opened_ports:
-            if port:
-                hookenv.log("Closing port {}".format(port), "DEBUG")
-                hookenv.close_port(port)
+            for port in run:
+                opened[port] = ports
 
     def supports_http2(self):
         """Check if HTTP/2 is enabled and supported."""
-        if StrictVersion(self.charm_config.get("version")) >= StrictVersion("1.9"):
-            return True
-
-        return False
+        return self.supports("http2")
 
     def enable_letsencrypt(self):
         """Enable certbot for TLS certificate generation."""
-        hookenv.log("Enabling letsencrypt", "DEBUG")
+        log("Enabling letsencrypt", "DEBUG")
         unit_name = "letsencrypt"
         backend_name = "letsencrypt-backend"
 
         frontend = self.get_frontend(80)
 
         if not self.available_for_http(frontend):
-            hookenv.log("Port 80 not available for http use by letsencrypt", "ERROR")
+            log("Port 80 not available for http use by letsencrypt", "ERROR")
 
             return  # TODO: Should I error here, or is returning a log ok?
 
         # Only configure the rest if we haven't already done so to avoid
         # checking every change for already existing
-        first_run = True
-
-        for acl in frontend.acls():
-            if acl.name == unit_name:
-                first_run = False
+        first_run = not frontend.config_block.first("acl", unit_name)
 
         if first_run:
             # Add ACL to the frontend
@@ -649,20 +2933,25 @@ class ProxyHelper:
             )
             backend.add_server(server)
 
-            # Render new cfg file
+            # Render new cfg file, certbot needs the challenge routed
+            # before registering so apply it even inside a transaction
             self.save_config()
+            self.flush()
 
         # Call the register function from the letsencrypt layer
-        hookenv.log(
+        log(
             "Letsencrypt port: {}".format(self.letsencrypt_config["port"]), "DEBUG"
         )
-        hookenv.log(
+        log(
             "Letsencrypt domains: {}".format(self.charm_config["letsencrypt-domains"]),
             "DEBUG",
         )
 
+        # Imported on use, the letsencrypt layer loads charms.reactive
+        from reactive import letsencrypt
+
         if letsencrypt.register_domains() > 0:
-            hookenv.log(
+            log(
                 (
                     "Failed letsencrypt registration see "
                     "/var/log/letsencrypt/letsencrypt.log"
@@ -678,35 +2967,53 @@ class ProxyHelper:
         # Configure the frontend 443
         frontend = self.get_frontend(443)
 
-        if not len(frontend.binds()[0].attributes):
-            frontend.binds()[0].attributes.append("ssl crt {}".format(self.cert_file))
+        attributes = frontend.binds()[0].attributes
 
-        if self.supports_http2():
-            frontend.binds()[0].attributes.append("alpn h2,http/1.1")
+        if "ssl " not in " ".join(attributes):
+            attributes.insert(0, "ssl crt {}".format(self.cert_file))
+
+        if self.supports_http2() and "alpn h2,http/1.1" not in " ".join(attributes):
+            attributes.insert(1, "alpn h2,http/1.1")
+        self.update_binds(frontend)
 
         if first_run:
             frontend.add_acl(acl)
             frontend.add_usebackend(use_backend)
 
             if self.charm_config["destination-https-rewrite"]:
-                frontend.add_config(
-                    haproxy_config.Config(
-                        "reqirep", "Destination:\\ https(.*) Destination:\\ http\\\\1 "
+                if self.supports("reqrep"):
+                    frontend.add_config(
+                        haproxy_config.Config(
+                            "reqirep", "Destination:\\ https(.*) Destination:\\ http\\\\1 "
+                        )
+                    )
+                else:
+                    frontend.add_config(
+                        haproxy_config.Config(
+                            "http-request", "replace-header Destination ^https(.*) http\\1"
+                        )
                     )
-                )
             self.save_config()
 
         # Add cron for renew
         self.add_cert_cron()
 
+        if self.charm_config.get("enable-ocsp-stapling"):
+            self.renew_ocsp()
+            self.add_ocsp_cron()
+
     def disable_letsencrypt(self, save=True):
         """Disable certbot usage."""
         # Remove non-standard frontend configs
         frontend = self.get_frontend(443)
         frontend.binds()[0].attributes[:] = []  # Remove ssl cert attribute
+        self.update_binds(frontend)
         frontend.remove_config(
             "reqirep", "Destination:\\ https(.*) Destination:\\ http\\\\1 "
         )
+        frontend.remove_config(
+            "http-request", "replace-header Destination ^https(.*) http\\1"
+        )
 
         # Remove any standard config
         self.clean_config(
@@ -714,6 +3021,15 @@ class ProxyHelper:
         )
         self.remove_cert_cron()
 
+        if self.charm_config.get("enable-ocsp-stapling"):
+            self.remove_ocsp_cron()
+
+        # A response for a cert that may be replaced would be stale
+        try:
+            os.unlink(self.ocsp_file)
+        except FileNotFoundError:
+            pass
+
     def merge_letsencrypt_cert(self):
         """Convert certbot certificate into the format needed for haproxy."""
         letsencrypt_live_folder = "/etc/letsencrypt/live/{}/".format(self.domain_name)
@@ -725,53 +3041,183 @@ class ProxyHelper:
 
     def renew_cert(self, full=True):
         """Renew certificates."""
-        hookenv.log("Renewing cert", "INFO")
+        log("Renewing cert", "INFO")
 
         if full:
             # Calling a full disable/enable to clean and re-write the config
             # to catch domain changes in the charm config
-            hookenv.log("Performing full domain register", "INFO")
+            log("Performing full domain register", "INFO")
             self.disable_letsencrypt()
             self.enable_letsencrypt()
         else:
-            hookenv.log("Performing renew only", "INFO")
+            log("Performing renew only", "INFO")
+            from reactive import letsencrypt
+
             letsencrypt.renew()
             # create the merged .pem for HAProxy
             self.merge_letsencrypt_cert()
-            host.service_reload("haproxy.service")
+
+            if not self.update_cert():
+                self.reload_haproxy()
+
+            # The response is for the previous cert
+            if self.charm_config.get("enable-ocsp-stapling"):
+                self.renew_ocsp()
+
+    def update_cert(self):
+        """Load the cert file into the running haproxy, without a reload.
+
+        Returns False if that isn't possible, it needs haproxy 2.2.
+        """
+        import haproxy_runtime
+
+        try:
+            # The running haproxy, which may be older than the installed one
+            version = ".".join(str(part) for part in self.runtime.version())
+
+            if not self.supports("ssl-cert-update", version):
+                log("HAProxy {} can't update certs at runtime".format(version), "DEBUG")
+
+                return False
+            with open(self.cert_file) as cert_file:
+                self.runtime.set_ssl_cert(self.cert_file, cert_file.read())
+        except (haproxy_runtime.RuntimeAPIError, OSError) as error:
+            log("Could not update the cert at runtime: {}".format(error), "WARNING")
+
+            return False
+        log("Updated {} without a reload".format(self.cert_file), "INFO")
+
+        return True
+
+    @property
+    def ocsp_file(self):
+        """Return the OCSP response file haproxy loads along with the cert."""
+        return self.cert_file + ".ocsp"
+
+    def fetch_ocsp(self):
+        """Fetch an OCSP response for the letsencrypt cert into ocsp_file.
+
+        The responder is the ocsp-responder config, or else the one named
+        in the cert. Returns the response, None if it couldn't be fetched.
+        """
+        live_folder = "/etc/letsencrypt/live/{}/".format(self.domain_name)
+        responder = self.charm_config.get("ocsp-responder")
+        fd, response_path = tempfile.mkstemp(prefix=".ocsp.")
+        os.close(fd)
+
+        try:
+            if not responder:
+                responder = str(
+                    subprocess.check_output(
+                        [
+                            "openssl",
+                            "x509",
+                            "-noout",
+                            "-ocsp_uri",
+                            "-in",
+                            live_folder + "cert.pem",
+                        ]
+                    ),
+                    "utf-8",
+                ).strip()
+            output = str(
+                subprocess.check_output(
+                    [
+                        "openssl",
+                        "ocsp",
+                        "-no_nonce",
+                        "-issuer",
+                        live_folder + "chain.pem",
+                        "-VAfile",
+                        live_folder + "chain.pem",
+                        "-cert",
+                        live_folder + "cert.pem",
+                        "-url",
+                        responder,
+                        "-respout",
+                        response_path,
+                    ],
+                    stderr=subprocess.STDOUT,
+                ),
+                "utf-8",
+            )
+            with open(response_path, "rb") as response_file:
+                response = response_file.read()
+        except (subprocess.CalledProcessError, OSError) as error:
+            log("Could not fetch an OCSP response: {}".format(error), "WARNING")
+
+            return None
+        finally:
+            os.unlink(response_path)
+
+        if ": good" not in output or not response:
+            log(
+                "OCSP responder {} didn't confirm the cert: {}".format(
+                    responder, output.strip()
+                ),
+                "WARNING",
+            )
+
+            return None
+        self._replace_file(self.ocsp_file, response)
+
+        return response
+
+    def renew_ocsp(self):
+        """Refresh the OCSP response haproxy staples to the letsencrypt cert.
+
+        The response is pushed through the runtime API, haproxy is reloaded
+        to load it if that fails, as it does when haproxy had no response
+        for the cert yet. Returns False if no response was fetched.
+        """
+        import haproxy_runtime
+
+        log("Renewing the OCSP response", "INFO")
+        response = self.fetch_ocsp()
+
+        if response is None:
+            return False
+
+        try:
+            self.runtime.set_ocsp_response(response)
+        except haproxy_runtime.RuntimeAPIError as error:
+            log("Could not update the OCSP response, reloading: {}".format(error), "INFO")
+            self.reload_haproxy()
+
+        return True
+
+    def disable_ocsp(self):
+        """Stop stapling OCSP responses to the letsencrypt cert.
+
+        The response file is removed along with its cron job, as haproxy
+        would otherwise keep stapling it after it expired.
+        """
+        self.remove_ocsp_cron()
+
+        try:
+            os.unlink(self.ocsp_file)
+        except FileNotFoundError:
+            return
+        log("Removed the OCSP response, reloading to stop stapling it", "INFO")
+        self.reload_haproxy()
 
     def renew_upnp(self):
         """Renew upnp port forward."""
-        hookenv.log("Renewing upnp port requests", "INFO")
-        # check that open ports is accurate
-        self.update_ports()
+        log("Renewing upnp port requests", "INFO")
         # send upnp for ports even if they were already open
-        opened_ports = str(subprocess.check_output(["opened-ports"]), "utf-8").split(
-            "/tcp\n"
-        )
-        opened_ports.remove("")
-
-        for port in opened_ports:
-            hookenv.log("Opening port {}".format(port), "INFO")
-            hookenv.open_port(port)
+        self.update_ports(refresh=True)
 
     def release_upnp(self):
         """Release upnp port forward."""
-        hookenv.log("Releaseing all upnp port requests", "INFO")
+        log("Releaseing all upnp port requests", "INFO")
         # check that open ports is accurate
         self.update_ports()
-        # send upnp for ports even if they were already open
-        opened_ports = str(subprocess.check_output(["opened-ports"]), "utf-8").split(
-            "/tcp\n"
-        )
-        opened_ports.remove("")
-
-        for port in opened_ports:
-            hookenv.log("Closing port {}".format(port), "INFO")
-            hookenv.close_port(port)
+        self._close_ports(set(self.opened_ports().values()))
 
     def add_cron(self, action, interval):
         """Add a cron job for the provided action to run at the provided interval."""
+        from crontab import CronTab
+
         root_cron = CronTab(user="root")
         unit = hookenv.local_unit()
         directory = hookenv.charm_dir()
@@ -780,19 +3226,21 @@ class ProxyHelper:
         job = root_cron.new(command=command, comment="Charm cron for {}".format(action))
         job.setall(interval)
         root_cron.write()
-        hookenv.log("Cron added: {}".format(action), "INFO")
+        log("Cron added: {}".format(action), "INFO")
 
     def remove_cron(self, action):
         """Remove cron job for provided action."""
+        from crontab import CronTab
+
         root_cron = CronTab(user="root")
         try:
             job = next(root_cron.find_comment("Charm cron for {}".format(action)))
             root_cron.remove(job)
             root_cron.write()
         except StopIteration:
-            hookenv.log("Cron was not present to remove", "WARN")
+            log("Cron was not present to remove", "WARN")
             pass
-        hookenv.log("Cron removed: {}".format(action), "INFO")
+        log("Cron removed: {}".format(action), "INFO")
 
     def add_cert_cron(self):
         """Add cron job for renewing certificates."""
@@ -802,6 +3250,14 @@ class ProxyHelper:
         """Remove cron job for renewing certificates."""
         self.remove_cron("renew-cert")
 
+    def add_ocsp_cron(self):
+        """Add cron job for refreshing the OCSP response."""
+        self.add_cron("renew-ocsp", self.charm_config["ocsp-renew-interval"])
+
+    def remove_ocsp_cron(self):
+        """Remove cron job for refreshing the OCSP response."""
+        self.remove_cron("renew-ocsp")
+
     def add_upnp_cron(self):
         """Add a cron job for refreshing upnp port forwards."""
         self.add_cron("renew-upnp", self.charm_config["upnp-renew-interval"])
@@ -812,27 +3268,17 @@ class ProxyHelper:
 
     def check_version(self):
         """Chcek version for upgrade support."""
-        if host.get_distrib_codename() == "xenial":
-            supported_versions = ("1.7",)
-
-            if self.charm_config["version"] not in supported_versions:
-                msg = "Version {} must be in {} for xenial".format(
-                    self.charm_config["version"], supported_versions
-                )
+        series = host.get_distrib_codename()
+        supported_versions = SUPPORTED_VERSIONS.get(series)
 
-                return (False, msg, supported_versions[0])
-            else:
-                return (True, "Version supported", None)
-        elif host.get_distrib_codename() == "bionic":
-            supported_versions = ("1.8", "1.9")
+        if supported_versions is None:
+            return (False, "No HAProxy version supported on {}".format(series), None)
 
-            if self.charm_config["version"] not in supported_versions:
-                msg = "Version {} must be in {} for bionic".format(
-                    self.charm_config["version"], supported_versions
-                )
+        if self.charm_config["version"] not in supported_versions:
+            msg = "Version {} must be in {} for {}".format(
+                self.charm_config["version"], supported_versions, series
+            )
 
-                return (False, msg, supported_versions[0])
-            else:
-                return (True, "Version supported", None)
+            return (False, msg, supported_versions[0])
 
-        return (False, "Version check failed")
+        return (True, "Version supported", None)
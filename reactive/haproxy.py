@@ -17,15 +17,30 @@ from charms.reactive import (
 from libhaproxy import ProxyHelper
 
 ph = ProxyHelper()
+# Render and reload haproxy once per hook no matter how many handlers run
+ph.begin_hook_transaction()
 
 
 @when_not("haproxy.installed")
 def install_haproxy():
     """Install haproxy when the haproxy.installed flag is not set."""
+    valid, msg, version = ph.check_version()
+
+    if not valid:
+        if version is None:
+            hookenv.log(msg, "ERROR")
+            hookenv.status_set("blocked", "{}, not installing HAProxy".format(msg))
+
+            return
+        hookenv.log(
+            "{}, installing the series default {} instead.".format(msg, version), "WARNING"
+        )
+        ph.charm_config["version"] = version
     hookenv.status_set("maintenance", "Installing HAProxy")
     fetch.add_source(ph.ppa)
     fetch.apt_update()
     fetch.install("haproxy")
+    ph.reset_version()
     set_state("haproxy.installed")
 
 
@@ -62,7 +77,16 @@ def configure_haproxy():
     if ph.charm_config["enable-https-redirect"]:
         ph.enable_redirect()
     ph.add_timeout_tunnel()
-    hookenv.status_set("active", "")
+    ph.update_server_state()
+    ph.update_hard_stop()
+    ph.update_seamless_reload()
+    ph.update_threads()
+    ph.update_sizing()
+    ph.update_host_tuning()
+
+    if ph.charm_config["config-fragments"]:
+        ph.enable_fragments()
+    ph.active_status()
     set_state("haproxy.configured")
 
 
@@ -80,7 +104,7 @@ def configure_relation(reverseproxy, *args):
         configs = reverseproxy.config
     status = ph.process_configs(configs)
     reverseproxy.set_cfg_status(**status)
-    hookenv.status_set("active", "")
+    ph.active_status()
 
 
 @when_all("reverseproxy.triggered", "reverseproxy.departed")
@@ -88,21 +112,107 @@ def remove_relation(reverseproxy, *args):
     """Remove related backend and clean config."""
     hookenv.log("Removing config for: {}".format(hookenv.remote_unit()))
     # Process either dict or list of dicts to support legacy relations
-    # TODO: This doesn't seem to clean up frontends and close ports
     configs = []
 
     if isinstance(reverseproxy.config, dict):
         configs.append(reverseproxy.config)
     else:
         configs = reverseproxy.config
+    ph.remove_configs(configs)
+    ph.active_status()
+
+
+@when("config.changed.declarative-routing")
+def routing_changed():
+    """Rebuild the relation routes when declarative routing is enabled."""
+    if hookenv.hook_name() == "install":
+        return
+
+    if ph.charm_config["declarative-routing"]:
+        ph.reconcile_routes()
+
+
+@when("config.changed.map-routing")
+def map_routing_changed():
+    """Move the relation routes between acls and map files."""
+    if hookenv.hook_name() == "install":
+        return
+    ph.reconcile_routes()
+
+
+@when("config.changed.server-state-file")
+def server_state_changed():
+    """Update the server state file when configuration changes."""
+    if hookenv.hook_name() == "install":
+        return
+    ph.update_server_state()
+
+
+@when("config.changed.hard-stop-after")
+def hard_stop_changed():
+    """Update how long old workers are kept when configuration changes."""
+    if hookenv.hook_name() == "install":
+        return
+    ph.update_hard_stop()
+
+
+@when("config.changed.seamless-reload")
+def seamless_reload_changed():
+    """Switch master-worker mode when configuration changes."""
+    if hookenv.hook_name() == "install":
+        return
+    ph.update_seamless_reload()
+
+
+@when("config.changed.threads")
+def threads_changed():
+    """Resize the threads when configuration changes."""
+    if hookenv.hook_name() == "install":
+        return
+    ph.update_threads()
+
+
+@when_any(
+    "config.changed.maxconn",
+    "config.changed.frontend-maxconn",
+    "config.changed.tune-bufsize",
+    "config.changed.tune-maxrewrite",
+)
+def sizing_changed():
+    """Resize the connection limits when configuration changes."""
+    if hookenv.hook_name() == "install":
+        return
+    ph.update_sizing()
+    ph.update_host_tuning()
+    ph.active_status()
+
+
+@when("config.changed.bind-options")
+def bind_options_changed():
+    """Update the listener options when configuration changes."""
+    if hookenv.hook_name() == "install":
+        return
+    ph.update_bind_options()
+
+
+@when("config.changed.tune-host")
+def tune_host_changed():
+    """Apply or roll back the host tuning when configuration changes."""
+    if hookenv.hook_name() == "install":
+        return
+    ph.update_host_tuning()
 
-    for names in ph.get_config_names(configs):
-        unit_name = names[0]
-        backend_name = names[1]
-        hookenv.log(
-            "Cleaning on depart for {}, {}".format(unit_name, backend_name), "DEBUG"
-        )
-        ph.clean_config(unit=unit_name, backend_name=backend_name)
+
+@when("config.changed.config-fragments")
+def config_fragments_changed():
+    """Move the config between one file and a fragment directory."""
+    if hookenv.hook_name() == "install":
+        return
+
+    if ph.charm_config["config-fragments"]:
+        ph.enable_fragments()
+    else:
+        ph.disable_fragments()
 
 
 @when("config.changed.version")
@@ -114,39 +224,40 @@ def version_changed():
 
     if valid:
         install_haproxy()
+        ph.update_seamless_reload()
+        ph.update_threads()
 
-        if (
-            ph.charm_config["version"] == "1.9"
-            and ph.charm_config["enable-letsencrypt"]
-        ):
-            # Starting with 1.9 HTTP2 will be setup during install, disable letsencrypt if we
-            # have just upgraded so intsall will reenable with HTTP2 support
+        if ph.charm_config["enable-letsencrypt"]:
+            # HTTP2 and the header rewrite depend on the version, disable letsencrypt
+            # if we have just upgraded so enable will set them up for it
             ph.disable_letsencrypt()
             ph.enable_letsencrypt()
-        hookenv.status_set("active", "")
     else:
         hookenv.log(msg, "WARNING")
-        hookenv.status_set(
-            "active", msg,
-        )
+    ph.active_status()
+
+
+@hook("update-status")
+def update_status():
+    """Report the connection limits and old workers still running after reloads."""
+    # Apply a reload deferred by the reload window before reporting on it
+    ph.flush()
+    ph.active_status()
+
+
+@hook("upgrade-charm")
+def upgrade_charm():
+    """Update the config written by earlier versions of the charm."""
+    ph.upgrade_path_maps()
 
 
 @hook("post-series-upgrade")
 def post_series_upgrade():
     """Run post upgrade steps."""
-    valid, msg, version = ph.check_version()
-
-    if not valid:
-        hookenv.log(
-            "Version not supported after upgrade, installing minimum supported version {}.".format(
-                version
-            ),
-            "WARNING",
-        )
-        ph.charm_config["version"] = version
+    # Falls back to the default of the new series if the version isn't supported
     install_haproxy()
     remove_state("letsencrypt.installed")
-    hookenv.status_set("active", "")
+    ph.active_status()
 
 
 @when_any(
@@ -226,6 +337,24 @@ def cert_interval_changed():
         ph.add_cert_cron()
 
 
+@when_any(
+    "config.changed.enable-letsencrypt",
+    "config.changed.enable-ocsp-stapling",
+    "config.changed.ocsp-renew-interval",
+    "config.changed.ocsp-responder",
+)
+def ocsp_changed():
+    """Reconfigure OCSP stapling when configuration changes."""
+    if hookenv.hook_name() == "install":
+        return
+    if ph.charm_config["enable-letsencrypt"] and ph.charm_config["enable-ocsp-stapling"]:
+        ph.remove_ocsp_cron()
+        ph.add_ocsp_cron()
+        ph.renew_ocsp()
+    else:
+        ph.disable_ocsp()
+
+
 @when("config.changed.enable-https-redirect")
 def redirect_changed():
     """Reconfigure the HTTPS redirect behaviour when configuration changes."""
@@ -2,7 +2,12 @@
 """Fixtures for unit testing the charm."""
 import pytest
 import mock
+import shutil
+import socket
+import socketserver
 import sys
+import tempfile
+import threading
 
 from collections import defaultdict
 sys.modules['charms.layer'] = mock.Mock()
@@ -32,7 +37,7 @@ def config():
 def mock_crontab(monkeypatch):
     """Mock the crontab helper."""
     mock_cron = mock.MagicMock()
-    monkeypatch.setattr("libhaproxy.CronTab", mock_cron)
+    monkeypatch.setattr("crontab.CronTab", mock_cron)
     monkeypatch.setattr("libhaproxy.hookenv.local_unit", lambda: "mock-local/0")
     # monkeypatch.setattr('libhaproxy.hookenv.charm_dir', lambda: '/mock/charm/dir')
     return mock_cron
@@ -71,8 +76,8 @@ def mock_layers(monkeypatch):
     sys.modules["charms.layer"] = mock.Mock()
     sys.modules["reactive"] = mock.Mock()
     sys.modules["reactive.letsencrypt"] = mock.Mock()
-    monkeypatch.setattr("libhaproxy.letsencrypt.register_domains", lambda: 0)
-    monkeypatch.setattr("libhaproxy.letsencrypt.renew", mock.Mock())
+    monkeypatch.setattr("reactive.letsencrypt.register_domains", lambda: 0)
+    monkeypatch.setattr("reactive.letsencrypt.renew", mock.Mock())
 
     def options(layer):
         if layer == "letsencrypt":
@@ -150,6 +155,21 @@ def mock_charm_dir(monkeypatch):
     monkeypatch.setattr("libhaproxy.hookenv.charm_dir", lambda: "/mock/charm/dir")
 
 
+@pytest.fixture
+def mock_series(monkeypatch):
+    """Mock the series of the unit."""
+    monkeypatch.setattr("libhaproxy.host.get_distrib_codename", lambda: "bionic")
+
+
+@pytest.fixture
+def mock_unitdata(tmpdir, monkeypatch):
+    """Keep unit state in a tmpfile."""
+    from charmhelpers.core import unitdata
+
+    monkeypatch.setenv("UNIT_STATE_DB", tmpdir.join(".unit-state.db").strpath)
+    monkeypatch.setattr(unitdata, "_KV", None)
+
+
 @pytest.fixture
 # def ph(pyhaproxy, tmpdir, mock_ports, mock_service_reload, mock_charm_dir, monkeypatch):
 def ph(
@@ -159,6 +179,8 @@ def ph(
     mock_ports,
     mock_service_reload,
     mock_charm_dir,
+    mock_unitdata,
+    mock_series,
     monkeypatch,
 ):
     """Mock the ProxyHelper instance used by the charm."""
@@ -171,6 +193,10 @@ def ph(
     with open("./tests/unit/haproxy.cfg", "r") as src_file:
         cfg_file.write(src_file.read())
     ph.proxy_config_file = cfg_file.strpath
+    ph.proxy_config_dir = tmpdir.join("conf.d").strpath
+    ph.service_dropin_dir = tmpdir.join("haproxy.service.d").strpath
+    ph.map_dir = tmpdir.join("maps").strpath
+    ph.config_cache_file = tmpdir.join(".haproxy-config.cache").strpath
 
     # Patch the combined cert file to a tmpfile
     crt_file = tmpdir.join("mock.pem")
@@ -180,3 +206,112 @@ def ph(
     monkeypatch.setattr("libhaproxy.ProxyHelper", lambda: ph)
 
     return ph
+
+
+SHOW_INFO = """Name: HAProxy
+Version: 1.8.8-1ubuntu0.11
+Nbproc: 1
+Pid: 1234
+Uptime_sec: 3600
+CurrConns: 3
+"""
+
+SHOW_STAT = """# pxname,svname,qcur,scur,smax,stot,status,weight,check_status,
+stats,FRONTEND,,0,1,5,OPEN,,,
+unit-mock-0,unit-mock-0,0,2,4,100,UP,1,L4OK,
+unit-mock-0,BACKEND,0,2,4,100,UP,1,,
+"""
+
+SHOW_SERVERS_STATE = (
+    "1\n"
+    "# be_id be_name srv_id srv_name srv_addr srv_op_state srv_admin_state srv_uweight"
+    " srv_iweight srv_time_since_last_change srv_check_status srv_check_result"
+    " srv_check_health srv_check_state srv_agent_state bk_f_forced_id srv_f_forced_id"
+    " srv_fqdn srv_port\n"
+    "3 unit-mock-0 1 unit-mock-0 10.0.0.2 2 0 1 1 120 6 3 4 6 0 0 0 - 8000\n"
+)
+
+
+class FakeRuntime(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Stand in for the haproxy admin socket speaking the runtime API.
+
+    Answers are looked up in responses by the longest command prefix, and
+    may be callables taking the command. Commands received are recorded.
+    """
+
+    daemon_threads = True
+
+    class Handler(socketserver.StreamRequestHandler):
+        """Answer the commands of one connection."""
+
+        def handle(self):
+            """Read commands a line at a time as haproxy does."""
+            self.server.connections += 1
+            self.server.requests.append(self.request)
+            prompt = False
+
+            for line in self.rfile:
+                command = line.decode().rstrip("\n")
+
+                # The payload goes up to an empty line
+                if command.endswith("<<"):
+                    for line in self.rfile:
+                        if line == b"\n":
+                            break
+                        command += "\n" + line.decode().rstrip("\n")
+
+                if command == "quit":
+                    break
+
+                if command == "prompt":
+                    prompt = True
+                    answer = ""
+                else:
+                    self.server.commands.append(command)
+                    answer = self.server.answer(command)
+                self.wfile.write((answer + ("\n> " if prompt else "\n")).encode())
+
+                if not prompt:
+                    break
+
+    def __init__(self, path):
+        """Listen on path."""
+        super().__init__(path, self.Handler)
+        self.path = path
+        self.commands = []
+        self.connections = 0
+        self.requests = []
+        self.responses = {
+            "show info": SHOW_INFO,
+            "show stat": SHOW_STAT,
+            "show servers state": SHOW_SERVERS_STATE,
+        }
+
+    def drop(self):
+        """Close the open connections, as haproxy does on a timeout."""
+        for request in self.requests:
+            request.shutdown(socket.SHUT_RDWR)
+
+    def answer(self, command):
+        """Return the answer to command."""
+        for prefix in sorted(self.responses, key=len, reverse=True):
+            if command.startswith(prefix):
+                response = self.responses[prefix]
+
+                return response(command) if callable(response) else response
+
+        return "Unknown command.\n"
+
+
+@pytest.fixture
+def fake_runtime():
+    """Serve a fake runtime API on a unix socket."""
+    # Unix socket paths are short, so tmpdir may be too deep
+    directory = tempfile.mkdtemp()
+    server = FakeRuntime(directory + "/admin.sock")
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(directory)
@@ -13,7 +13,7 @@ def test_renew_cert(ph, monkeypatch):
     }
     monkeypatch.setattr(ph, "disable_letsencrypt", mocks["disable"])
     monkeypatch.setattr(ph, "enable_letsencrypt", mocks["enable"])
-    monkeypatch.setattr("libhaproxy.letsencrypt.renew", mocks["renew"])
+    monkeypatch.setattr("reactive.letsencrypt.renew", mocks["renew"])
     monkeypatch.setattr(ph, "merge_letsencrypt_cert", mocks["merge"])
     # Verify call counts
     assert mocks["disable"].call_count == 0
@@ -50,3 +50,49 @@ def test_renew_upnp(ph, monkeypatch):
     assert mock_renew.call_count == 0
     imp.load_source("renew_upnp", "./actions/renew-upnp")
     assert mock_renew.call_count == 1
+
+
+def test_renew_ocsp(ph, monkeypatch):
+    """Test the OCSP renewal action."""
+    mock_renew = mock.Mock()
+    monkeypatch.setattr(ph, "renew_ocsp", mock_renew)
+    imp.load_source("renew_ocsp", "./actions/renew-ocsp")
+    assert mock_renew.call_count == 1
+
+
+def test_action_keeps_unit_state(ph, monkeypatch):
+    """Test the unit state changed by an action is flushed, as hooks do."""
+    from charmhelpers.core import unitdata
+
+    def renew():
+        unitdata.kv().set("haproxy.reload.last", 1000.0)
+
+    monkeypatch.setattr(ph, "renew_ocsp", renew)
+    imp.load_source("renew_ocsp", "./actions/renew-ocsp")
+    monkeypatch.setattr(unitdata, "_KV", None)
+    assert unitdata.kv().get("haproxy.reload.last") == 1000.0
+
+
+def test_drain_server(ph, monkeypatch):
+    """Test the drain-server action."""
+    params = {"server": "app/0", "timeout": None, "ready": False}
+    monkeypatch.setattr("libhaproxy.hookenv.action_get", params.get)
+    action_set = mock.Mock()
+    action_fail = mock.Mock()
+    monkeypatch.setattr("libhaproxy.hookenv.action_set", action_set)
+    monkeypatch.setattr("libhaproxy.hookenv.action_fail", action_fail)
+    monkeypatch.setattr(ph, "find_servers", lambda name: [("app-0-0", "app-0-0")])
+    monkeypatch.setattr(ph, "drain_servers", mock.Mock(return_value={}))
+    monkeypatch.setattr(ph, "ready_servers", mock.Mock(return_value=True))
+    imp.load_source("drain_server", "./actions/drain-server")
+    ph.drain_servers.assert_called_once_with([("app-0-0", "app-0-0")], None)
+    action_set.assert_called_once_with({"drained": "app-0-0/app-0-0", "sessions": 0})
+    # Putting the server back in service
+    params["ready"] = True
+    imp.load_source("drain_server", "./actions/drain-server")
+    ph.ready_servers.assert_called_once_with([("app-0-0", "app-0-0")])
+    assert action_set.call_args[0][0] == {"ready": "app-0-0/app-0-0"}
+    # Unknown servers fail the action
+    monkeypatch.setattr(ph, "find_servers", lambda name: [])
+    imp.load_source("drain_server", "./actions/drain-server")
+    assert action_fail.call_count == 1
@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+"""Test the haproxy configuration model, parser and writer."""
+import pickle
+import timeit
+
+import haproxy_config
+import pytest
+
+CFG_FILE = "./tests/unit/haproxy.cfg"
+# The test configuration as pyhaproxy rendered it
+RENDERED = (
+    "\n"
+    "global\n"
+    "    group haproxy \n"
+    "    log /dev/log\tlocal0\n"
+    "    log /dev/log\tlocal1 notice\n"
+    "    chroot /var/lib/haproxy\n"
+    "    stats socket /run/haproxy/admin.sock mode 660 level admin\n"
+    "    stats timeout 30s\n"
+    "    user haproxy\n"
+    "    daemon \n"
+    "    ca-base /etc/ssl/certs\n"
+    "    crt-base /etc/ssl/private\n"
+    "    ssl-default-bind-ciphers ECDH+AESGCM:DH+AESGCM:ECDH+AES256:DH+AES256:"
+    "ECDH+AES128:DH+AES:RSA+AESGCM:RSA+AES:!aNULL:!MD5:!DSS\n"
+    "    ssl-default-bind-options no-sslv3\n"
+    "\n"
+    "\n"
+    "defaults \n"
+    "    option httplog \n"
+    "    option dontlognull \n"
+    "    log global\n"
+    "    mode http\n"
+    "    timeout connect 5000\n"
+    "    timeout client 50000\n"
+    "    timeout server 50000\n"
+    "    errorfile 400 /etc/haproxy/errors/400.http\n"
+    "    errorfile 403 /etc/haproxy/errors/403.http\n"
+    "    errorfile 408 /etc/haproxy/errors/408.http\n"
+    "    errorfile 500 /etc/haproxy/errors/500.http\n"
+    "    errorfile 502 /etc/haproxy/errors/502.http\n"
+    "    errorfile 503 /etc/haproxy/errors/503.http\n"
+    "    errorfile 504 /etc/haproxy/errors/504.http\n"
+    "\n"
+)
+
+
+def large_config():
+    """Return the unit test configuration with many relation backends."""
+    with open(CFG_FILE) as cfg_file:
+        lines = [cfg_file.read(), "\nfrontend relation-80 \n    bind 0.0.0.0:80 \n"]
+    for unit in range(300):
+        lines.append("    acl unit-{0} path_beg /unit-{0}/\n".format(unit))
+        lines.append("    acl unit-{0} path /unit-{0}\n".format(unit))
+        lines.append("    use_backend unit-{0} if unit-{0}\n".format(unit))
+    for unit in range(300):
+        lines.append(
+            "\nbackend unit-{0}\n"
+            "    mode http \n"
+            "    cookie SERVERID insert indirect nocache \n"
+            "    server unit-{0} 10.0.0.{1}:8000 check fall 3 rise 2 cookie unit-{0}\n".format(
+                unit, unit % 250
+            )
+        )
+    return "".join(lines)
+
+
+def test_round_trip():
+    """Check rendering a parsed config matches pyhaproxy and is stable."""
+    rendered = haproxy_config.render(haproxy_config.parse(CFG_FILE))
+    assert rendered == RENDERED
+    assert haproxy_config.render(haproxy_config.parse_string(rendered)) == rendered
+
+
+def test_parse_lines():
+    """Test lines are split into the expected fields."""
+    configuration = haproxy_config.parse_string(
+        "frontend fe \n"
+        "    bind 0.0.0.0:80 \n"
+        "    bind 10.0.0.1:443 ssl crt /x.pem\n"
+        "    acl a1 path_beg /x/ # inline comment\n"
+        "    use_backend b1 if a1\n"
+        "    default_backend b2  \n"
+        "    use_backend %[path,map_dir(/x.map)] if { path,map_dir(/x.map) -m found }\n"
+        "    timeout  client 5000\n"
+        "backend b1\n"
+        "    option httpchk GET / HTTP/1.0\n"
+        "    server-template srv 1-3 host:80 check\n"
+        "    server s1 10.0.0.2:80 check fall 3 rise 2\n"
+        "    server s2 host.example:8080\n"
+    )
+    frontend = configuration.frontends[0]
+    assert (frontend.name, frontend.host, frontend.port) == ("fe", "0.0.0.0", "80")
+    assert [bind.attributes for bind in frontend.binds()] == [[""], ["ssl crt /x.pem"]]
+    assert frontend.acl("a1").value == "path_beg /x/ "
+    use_backend, default_backend, map_backend = frontend.usebackends()
+    assert (use_backend.operator, use_backend.backend_condition) == ("if", "a1")
+    assert default_backend.is_default
+    assert default_backend.backend_condition == ""
+    # Backend names can be looked up at runtime
+    assert map_backend.backend_name == "%[path,map_dir(/x.map)]"
+    assert map_backend.backend_condition == "{ path,map_dir(/x.map) -m found }"
+    assert frontend.config("timeout  client", "5000")
+    backend = configuration.backends[0]
+    assert backend.option("httpchk", "GET / HTTP/1.0")
+    assert backend.config("server-template", "srv 1-3 host:80 check")
+    assert backend.server("s1").attributes == ["check fall 3 rise 2"]
+    assert (backend.server("s2").host, backend.server("s2").port) == (
+        "host.example",
+        "8080",
+    )
+
+
+def test_keep_order_and_comments():
+    """Test section order and comment lines survive a round trip."""
+    text = (
+        "# managed by juju\n"
+        "\n"
+        "defaults \n"
+        "    mode http \n"
+        "\n"
+        "backend b1\n"
+        "    # first server\n"
+        "    server s1 10.0.0.2:80 \n"
+        "\n"
+        "defaults \n"
+        "    mode tcp \n"
+        "\n"
+        "frontend fe \n"
+        "    bind 0.0.0.0:90 \n"
+        "    default_backend b1  \n"
+    )
+    configuration = haproxy_config.parse_string(text)
+    rendered = haproxy_config.render(configuration)
+    assert rendered.startswith("# managed by juju\n")
+    assert "    # first server\n" in rendered
+    assert rendered.index("mode http") < rendered.index("backend b1")
+    assert rendered.index("backend b1") < rendered.index("mode tcp")
+    assert rendered.index("mode tcp") < rendered.index("frontend fe")
+    # New sections are placed after the others of their type
+    configuration.backends.append(haproxy_config.Backend("b2", []))
+    configuration.frontends.append(
+        haproxy_config.Frontend("fe2", "0.0.0.0", "91", [])
+    )
+    rendered = haproxy_config.render(configuration)
+    assert rendered.index("backend b1") < rendered.index("backend b2")
+    assert rendered.index("backend b2") < rendered.index("mode tcp")
+    assert rendered.index("frontend fe ") < rendered.index("frontend fe2 0.0.0.0:91")
+
+
+def test_frontend_needs_address():
+    """Test a frontend without any address is rejected."""
+    with pytest.raises(ValueError):
+        haproxy_config.parse_string("frontend fe \n    mode http \n")
+
+
+def test_missing_file(tmpdir):
+    """Test a missing file parses as an empty configuration."""
+    configuration = haproxy_config.parse(tmpdir.join("missing.cfg").strpath)
+    assert configuration.globall is None
+    assert haproxy_config.render(configuration) == ""
+
+
+def test_pickle():
+    """Test a pickled configuration loads with its lookups working."""
+    configuration = pickle.loads(
+        pickle.dumps(haproxy_config.parse_string(large_config()), 2)
+    )
+    assert haproxy_config.render(configuration) == haproxy_config.render(
+        haproxy_config.parse_string(large_config())
+    )
+    assert configuration.index.backend("unit-3").server("unit-3").port == "8000"
+    assert configuration.index.owners("acl", "unit-3") == [
+        configuration.index.frontend("80")
+    ]
+    configuration.backends.append(haproxy_config.Backend("new", []))
+    assert configuration.index.backend("new") is not None
+
+
+def test_large_config():
+    """Check a large config round trips, well within a loose time bound."""
+    text = large_config()
+
+    def native():
+        return haproxy_config.render(haproxy_config.parse_string(text))
+
+    # The native parser takes a few tens of milliseconds here, the bound is
+    # kept far above that so a loaded machine doesn't fail it
+    assert min(timeit.repeat(native, number=1, repeat=3)) < 1.0
+    rendered = native()
+    assert len(haproxy_config.parse_string(rendered).backends) == 300
+    assert haproxy_config.render(haproxy_config.parse_string(rendered)) == rendered
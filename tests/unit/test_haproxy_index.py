@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+"""Test the lookup index over the parsed configuration."""
+import haproxy_config
+from haproxy_index import ConfigBlock
+
+
+def parse():
+    """Parse the unit test configuration."""
+    return haproxy_config.parse("./tests/unit/haproxy.cfg")
+
+
+def test_block_lookup():
+    """Test looking up lines in a config block."""
+    acl = haproxy_config.Acl("unit-0", "path_beg /test/")
+    acl_exact = haproxy_config.Acl("unit-0", "path /test")
+    server = haproxy_config.Server("unit-0", "test-host", 8000)
+    block = ConfigBlock([acl, server])
+    block.append(acl_exact)
+    assert block.lookup("acl", "unit-0") == [acl, acl_exact]
+    assert block.first("server", "unit-0") is server
+    assert block.total("acl") == 2
+    block.remove(acl)
+    assert block.lookup("acl", "unit-0") == [acl_exact]
+    block[:] = [line for line in block if line is not server]
+    assert block.first("server", "unit-0") is None
+    assert block.total("server") == 0
+    assert block.total("acl") == 1
+
+
+def test_frontend_by_port():
+    """Test frontends are found by port through list changes."""
+    configuration = parse()
+    index = configuration.index
+    assert index.frontend("80") is None
+    fe80 = haproxy_config.Frontend("relation-80", "0.0.0.0", "80", [])
+    configuration.frontends.append(fe80)
+    assert index.frontend("80") is fe80
+    # Ports changed in place are picked up
+    fe80.port = "8080"
+    assert index.frontend("80") is None
+    assert index.frontend("8080") is fe80
+    configuration.frontends[:] = []
+    assert index.frontend("8080") is None
+
+
+def test_owners():
+    """Test finding the sections holding a line."""
+    configuration = parse()
+    index = configuration.index
+    fe80 = haproxy_config.Frontend("relation-80", "0.0.0.0", "80", [])
+    fe443 = haproxy_config.Frontend("relation-443", "0.0.0.0", "443", [])
+    backend = haproxy_config.Backend("unit-0", [])
+    configuration.frontends.extend([fe80, fe443])
+    configuration.backends.append(backend)
+    fe80.add_acl(haproxy_config.Acl("unit-0", "path_beg /test/"))
+    fe443.add_acl(haproxy_config.Acl("unit-0", "path_beg /test/"))
+    backend.add_server(haproxy_config.Server("unit-0", "test-host", 8000))
+    assert index.owners("acl", "unit-0") == [fe80, fe443]
+    assert index.owners("server", "unit-0", "frontend") == []
+    assert index.owners("server", "unit-0", "backend") == [backend]
+    fe80.remove_acl("unit-0")
+    assert index.owners("acl", "unit-0") == [fe443]
+    # Removed sections are no longer reported
+    configuration.frontends.remove(fe443)
+    assert index.owners("acl", "unit-0") == []
+    assert index.backend("unit-0") is backend
+    configuration.backends.pop()
+    assert index.owners("server", "unit-0") == []
+    assert index.backend("unit-0") is None
+
+
+def test_defaults_by_keyword():
+    """Test the defaults section is indexed by keyword."""
+    configuration = parse()
+    defaults = configuration.defaults[0]
+    assert len(defaults.config_block.lookup("config", "timeout connect")) == 1
+    assert defaults.config_block.first("option", "httplog") is not None
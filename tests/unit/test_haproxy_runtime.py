@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+"""Test the runtime API client against a fake admin socket."""
+import haproxy_runtime
+import pytest
+
+
+def test_show_commands(fake_runtime):
+    """Test the show commands are parsed into records."""
+    with haproxy_runtime.RuntimeAPI(fake_runtime.path) as runtime:
+        info = runtime.show_info()
+        assert info["Version"] == "1.8.8-1ubuntu0.11"
+        assert info["CurrConns"] == 3
+        stat = runtime.show_stat()
+        assert [(line["pxname"], line["svname"]) for line in stat] == [
+            ("stats", "FRONTEND"),
+            ("unit-mock-0", "unit-mock-0"),
+            ("unit-mock-0", "BACKEND"),
+        ]
+        assert stat[1]["status"] == "UP"
+        assert stat[1]["scur"] == 2
+        assert stat[0]["qcur"] == ""
+        (server,) = runtime.show_servers_state("unit-mock-0")
+        assert server["srv_name"] == "unit-mock-0"
+        assert server["srv_addr"] == "10.0.0.2"
+        assert server["srv_op_state"] == 2
+        assert server["srv_port"] == 8000
+    assert fake_runtime.commands == [
+        "show info",
+        "show stat",
+        "show servers state unit-mock-0",
+    ]
+    assert fake_runtime.connections == 1
+
+
+def test_pipeline(fake_runtime):
+    """Test several commands are answered in order on one connection."""
+    fake_runtime.responses["set server"] = ""
+    fake_runtime.responses["get weight"] = lambda command: "1 (initial 1)\n"
+    with haproxy_runtime.RuntimeAPI(fake_runtime.path) as runtime:
+        assert runtime.execute(
+            "set server unit-mock-0/unit-mock-0 state drain",
+            "get weight unit-mock-0/unit-mock-0",
+            "show foo",
+        ) == ["", "1 (initial 1)\n", "Unknown command.\n"]
+        assert runtime.command("show info").startswith("Name: HAProxy\n")
+    assert fake_runtime.connections == 1
+    with pytest.raises(ValueError):
+        runtime.execute("show info\nshow stat")
+
+
+def test_reconnect(fake_runtime):
+    """Test a connection dropped by haproxy is opened again."""
+    runtime = haproxy_runtime.RuntimeAPI(fake_runtime.path)
+    runtime.command("show info")
+    fake_runtime.drop()
+    assert runtime.command("show info").startswith("Name: HAProxy\n")
+    assert fake_runtime.connections == 2
+    runtime.close()
+
+
+def test_errors(fake_runtime, tmpdir):
+    """Test failures are reported as RuntimeAPIError."""
+    with pytest.raises(haproxy_runtime.RuntimeAPIError):
+        haproxy_runtime.RuntimeAPI(tmpdir.join("missing.sock").strpath).command("show info")
+    fake_runtime.responses["show stat"] = "Permission denied\n"
+    with haproxy_runtime.RuntimeAPI(fake_runtime.path) as runtime:
+        with pytest.raises(haproxy_runtime.RuntimeAPIError):
+            runtime.show_stat()
+
+
+def test_payload(fake_runtime):
+    """Test a command with a payload is answered once."""
+    fake_runtime.responses["set ssl cert"] = "Transaction created for certificate /x.pem!\n"
+    with haproxy_runtime.RuntimeAPI(fake_runtime.path) as runtime:
+        assert runtime.version() == (1, 8)
+        assert runtime.execute("set ssl cert /x.pem <<\nline 1\nline 2", "show foo") == [
+            "Transaction created for certificate /x.pem!\n",
+            "Unknown command.\n",
+        ]
+        with pytest.raises(ValueError):
+            runtime.execute("set ssl cert /x.pem <<\nline 1\n\nline 2")
+    assert fake_runtime.commands[-2:] == ["set ssl cert /x.pem <<\nline 1\nline 2", "show foo"]
@@ -36,6 +36,323 @@ def test_add_timeout_tunnel(ph):
     assert tunnel_found
 
 
+def test_server_state(ph, monkeypatch, tmpdir, fake_runtime):
+    """Test the server states are saved before reloads and loaded back."""
+    import haproxy_runtime
+    import mock
+
+    reload = mock.Mock()
+    monkeypatch.setattr("libhaproxy.host.service_reload", reload)
+    ph._runtime = haproxy_runtime.RuntimeAPI(fake_runtime.path)
+    state_file = tmpdir.join("state", "servers").strpath
+    ph.charm_config["server-state-file"] = state_file
+    ph.update_server_state()
+    assert ph.proxy_config.globall.config("server-state-file", state_file)
+    assert ph.proxy_config.defaults[0].config("load-server-state-from-file", "global")
+    assert reload.call_count == 1
+    assert fake_runtime.commands == ["show servers state"]
+    with open(state_file) as servers:
+        assert servers.read() == fake_runtime.responses["show servers state"].rstrip("\n") + "\n"
+
+    # Reloads deferred to the end of a transaction save it too
+    with ph.transaction():
+        ph.reload_haproxy()
+        assert reload.call_count == 1
+    assert reload.call_count == 2
+    assert fake_runtime.commands.count("show servers state") == 2
+
+    # Reloading goes ahead when haproxy isn't running
+    fake_runtime.responses["show servers state"] = "Unknown command.\n"
+    ph.reload_haproxy()
+    assert reload.call_count == 3
+
+    ph.charm_config["server-state-file"] = ""
+    ph.update_server_state()
+    assert ph.server_state_file is None
+    assert not ph.proxy_config.defaults[0].config("load-server-state-from-file", "global")
+    assert fake_runtime.commands.count("show servers state") == 3
+
+
+def test_server_state_slots(ph, monkeypatch, tmpdir, config, fake_runtime):
+    """Test released server slots don't come back in maintenance after a reload."""
+    import haproxy_runtime
+    import mock
+
+    reload = mock.Mock()
+    monkeypatch.setattr("libhaproxy.host.service_reload", reload)
+    ph._runtime = haproxy_runtime.RuntimeAPI(fake_runtime.path)
+    fake_runtime.responses["set server"] = ""
+    state_file = tmpdir.join("state", "servers").strpath
+    ph.charm_config["server-state-file"] = state_file
+    ph.charm_config["server-slots"] = 4
+    ph.update_server_state()
+    config["group_id"] = "unit-mock"
+
+    def join(number):
+        monkeypatch.setattr(
+            "libhaproxy.hookenv.remote_unit", lambda: "unit-mock/{}".format(number)
+        )
+        config["internal_host"] = "10.0.0.{}".format(number)
+        ph.process_configs([config])
+
+    join(0)
+    join(1)
+    # Release a slot, haproxy then reports it in maintenance
+    ph.remove_configs([config])
+    assert fake_runtime.commands[-1] == "set server unit-mock/slot2 state maint"
+    fake_runtime.responses["show servers state"] += (
+        "4 unit-mock 2 slot2 10.0.0.1 0 1 1 1 5 6 3 4 6 0 0 0 - 8000\n"
+        "4 unit-mock 3 slot3 10.0.0.0 2 0 1 1 120 6 3 4 6 0 0 0 - 8000\n"
+    )
+    reloads = reload.call_count
+    ph.reload_haproxy()
+    assert reload.call_count == reloads + 1
+    with open(state_file) as servers:
+        saved = servers.read()
+    assert "unit-mock-0 10.0.0.2" in saved
+    assert " slot" not in saved
+    haproxy_runtime.parse_servers_state(saved)
+    # The slot is rebound ready
+    join(2)
+    assert fake_runtime.commands[-1] == "set server unit-mock/slot2 state ready"
+
+
+def test_hard_stop(ph):
+    """Test setting how long old workers are kept."""
+    ph.charm_config["hard-stop-after"] = "15m"
+    ph.update_hard_stop()
+    assert ph.proxy_config.globall.config("hard-stop-after", "15m")
+    ph.charm_config["hard-stop-after"] = ""
+    ph.update_hard_stop()
+    assert all(cfg.keyword != "hard-stop-after" for cfg in ph.proxy_config.globall.configs())
+
+
+def test_old_workers(ph, tmpdir, fake_runtime):
+    """Test old workers are told apart from the current one and its master."""
+    import haproxy_runtime
+
+    ph.proc_dir = tmpdir.mkdir("proc").strpath
+    processes = {1: "systemd", 1000: "haproxy", 1001: "haproxy", 1234: "haproxy", 4321: "haproxy"}
+    for pid, name in processes.items():
+        tmpdir.join("proc", str(pid), "status").write(
+            "Name:\t{}\nPPid:\t{}\nVmRSS:\t  {} kB\n".format(name, 1 if pid == 1000 else 1000, pid * 100),
+            ensure=True,
+        )
+    tmpdir.join("proc", "self").mkdir()
+    ph._runtime = haproxy_runtime.RuntimeAPI(fake_runtime.path)
+    assert ph.old_workers() == [(1001, 100100), (4321, 432100)]
+    assert ph.worker_status() == "2 old workers using 519 MiB"
+
+    # Nothing is reported if haproxy isn't running
+    fake_runtime.responses["show info"] = "Unknown command.\n"
+    assert ph.old_workers() is None
+    assert ph.worker_status() == ""
+
+
+def test_update_threads(ph, monkeypatch, tmpdir):
+    """Test threads follow the CPUs and keep the stats frontend apart."""
+    monkeypatch.setattr("libhaproxy.os.sched_getaffinity", lambda pid: {0, 1, 2, 3, 4, 5})
+    ph.cgroup_dir = tmpdir.mkdir("cgroup").strpath
+    globall = ph.proxy_config.globall
+    # A single thread by default
+    ph.update_threads()
+    assert not globall.config_block.lookup("config", "nbthread")
+    ph.charm_config["threads"] = "auto"
+    ph.update_threads()
+    assert globall.config("nbthread", "6")
+    assert [cfg.value for cfg in globall.config_block.lookup("config", "cpu-map")] == [
+        "1/{} {}".format(thread, thread - 1) for thread in range(1, 7)
+    ]
+    # Each thread accepts from a socket of its own
+    assert [bind.attributes for bind in ph.get_frontend(80).binds()] == [
+        ["process 1/{}".format(thread)] for thread in range(1, 7)
+    ]
+
+    # A CFS quota limits the CPUs, the stats frontend gets the last one
+    tmpdir.join("cgroup", "cpu.max").write("250000 100000\n")
+    ph.enable_stats(save=False)
+    assert globall.config("nbthread", "3")
+    assert [cfg.value for cfg in globall.config_block.lookup("config", "cpu-map")] == [
+        "1/1 0",
+        "1/2 1",
+        "1/3 2",
+    ]
+    assert [bind.attributes for bind in ph.get_frontend(80).binds()] == [
+        ["process 1/1"],
+        ["process 1/2"],
+    ]
+    assert len(ph.get_frontend(81).binds()) == 2
+    stats = [fe for fe in ph.proxy_config.frontends if fe.name == "stats"][0]
+    assert stats.binds()[0].attributes == ["process 1/3"]
+
+    # Other bind options are kept
+    ph.get_frontend(443).binds()[0].attributes.insert(0, "ssl crt /x.pem")
+    ph.charm_config["threads"] = "2"
+    tmpdir.join("cgroup", "cpu.max").write("max 100000\n")
+    ph.update_threads()
+    assert [cfg.value for cfg in globall.config_block.lookup("config", "cpu-map")] == [
+        "1/1 0",
+        "1/2 5",
+    ]
+    assert [bind.attributes for bind in ph.get_frontend(443).binds()] == [
+        ["ssl crt /x.pem", "process 1/1"]
+    ]
+
+    # Versions before 1.8 have no threads
+    ph.charm_config["version"] = "1.7"
+    ph.update_threads()
+    assert not globall.config_block.lookup("config", "nbthread")
+    assert [bind.attributes for bind in ph.get_frontend(443).binds()] == [["ssl crt /x.pem"]]
+
+    # 2.4 places bind lines on threads with the thread keyword
+    ph.charm_config["version"] = "2.4"
+    ph.update_threads()
+    assert [bind.attributes for bind in ph.get_frontend(443).binds()] == [["ssl crt /x.pem", "thread 1"]]
+
+
+def test_host_tuning(ph, monkeypatch, tmpdir):
+    """Test the kernel and limits follow maxconn and are rolled back."""
+    import mock
+
+    commands = []
+    restart = mock.Mock()
+    monkeypatch.setattr("libhaproxy.subprocess.check_call", commands.append)
+    monkeypatch.setattr("libhaproxy.host.service_restart", restart)
+    ph.proc_dir = tmpdir.mkdir("proc").strpath
+    ph.sysctl_file = tmpdir.join("60-haproxy-charm.conf").strpath
+    for name, value in (
+        ("net/core/somaxconn", "128"),
+        ("net/ipv4/tcp_max_syn_backlog", "512"),
+        ("net/ipv4/ip_local_port_range", "32768\t60999"),
+        ("net/ipv4/ip_local_reserved_ports", ""),
+        ("net/ipv4/tcp_tw_reuse", "2"),
+        ("fs/file-max", "9223372036854775807"),
+    ):
+        tmpdir.join("proc", "sys", *name.split("/")).write(value + "\n", ensure=True)
+    ph.charm_config["maxconn"] = 20000
+    ph.update_sizing(save=False)
+    ph.charm_config["tune-host"] = True
+    ph.update_host_tuning()
+    with open(ph.sysctl_file) as sysctl_file:
+        assert sysctl_file.read() == (
+            "net.core.somaxconn = 20000\n"
+            "net.ipv4.ip_local_port_range = 1024 65023\n"
+            "net.ipv4.tcp_max_syn_backlog = 20000\n"
+            "net.ipv4.tcp_tw_reuse = 1\n"
+        )
+    assert ["sysctl", "-p", ph.sysctl_file] in commands
+    with open(ph._service_dropin_path("limits")) as dropin:
+        assert dropin.read() == "[Service]\nLimitNOFILE=41000\n"
+    assert restart.call_count == 1
+    # Unchanged limits don't restart haproxy
+    commands.clear()
+    ph.update_host_tuning()
+    assert restart.call_count == 1
+    assert commands == []
+
+    # Listener ports are kept out of the ephemeral range on every write
+    ph.enable_stats()
+    ph.get_frontend(8080)
+    ph.save_config()
+    with open(ph.sysctl_file) as sysctl_file:
+        assert "net.ipv4.ip_local_reserved_ports = 8080,9000\n" in sysctl_file.read()
+    assert ["sysctl", "-p", ph.sysctl_file] in commands
+    # Ports reserved before are kept
+    assert ph._reserved_ports("8000-8100,443") == "8000-8100,443,9000"
+
+    # Turning it off restores the previous values
+    commands.clear()
+    ph.charm_config["tune-host"] = False
+    ph.update_host_tuning()
+    assert not os.path.exists(ph.sysctl_file)
+    assert not os.path.exists(ph._service_dropin_path("limits"))
+    assert ["sysctl", "-w", "net.core.somaxconn=128"] in commands
+    assert ["sysctl", "-w", "net.ipv4.ip_local_port_range=32768 60999"] in commands
+    assert ["sysctl", "-w", "net.ipv4.ip_local_reserved_ports="] in commands
+    assert restart.call_count == 2
+    commands.clear()
+    ph.update_host_tuning()
+    assert commands == []
+
+
+def test_bind_options(ph, monkeypatch, config):
+    """Test listener options come from the config or relation data."""
+    import haproxy_config
+
+    monkeypatch.setattr("libhaproxy.hookenv.remote_unit", lambda: "unit-mock/0")
+    ph.charm_config["threads"] = "2"
+    ph.charm_config["bind-options"] = "tfo backlog 4096"
+    ph.update_threads(save=False)
+    assert [bind.attributes for bind in ph.get_frontend(80).binds()] == [
+        ["tfo backlog 4096", "process 1/1"],
+        ["tfo backlog 4096", "process 1/2"],
+    ]
+    # Relation data sets them for its port
+    config["bind_options"] = "defer-accept"
+    assert ph.process_configs([config])["cfg_good"] is True
+    assert [bind.attributes for bind in ph.get_frontend(80).binds()] == [
+        ["defer-accept", "process 1/1"],
+        ["defer-accept", "process 1/2"],
+    ]
+    assert ph.listener_options(81) == "tfo backlog 4096"
+    config["bind_options"] = "tfo mss 1400"
+    status = ph.process_configs([config])
+    assert status["cfg_good"] is False
+    assert "mss" in status["msg"]
+    config["bind_options"] = "defer-accept"
+    assert ph.process_configs([config])["cfg_good"] is True
+
+    # Options survive writing and parsing the config
+    rendered = haproxy_config.render(ph.proxy_config)
+    assert "    bind 0.0.0.0:80 defer-accept process 1/2\n" in rendered
+    ph._proxy_config = haproxy_config.parse_string(rendered)
+    ph.charm_config["bind-options"] = "bad"
+    ph.update_bind_options(save=False)
+    assert [bind.attributes for bind in ph.get_frontend(81).binds()] == [
+        ["process 1/1"],
+        ["process 1/2"],
+    ]
+    assert len(ph.get_frontend(80).binds()) == 2
+
+
+def test_update_sizing(ph, tmpdir, fake_runtime):
+    """Test maxconn is sized to the memory and files of the unit."""
+    import haproxy_runtime
+
+    ph.proc_dir = tmpdir.mkdir("proc").strpath
+    ph.cgroup_dir = tmpdir.mkdir("cgroup").strpath
+    tmpdir.join("proc", "meminfo").write("MemTotal:        4194304 kB\nMemFree:  1024 kB\n")
+    tmpdir.join("proc", "sys", "fs", "nr_open").write("1048576\n", ensure=True)
+    tmpdir.join("proc", "sys", "fs", "file-max").write("20000\n")
+    tmpdir.join("cgroup", "memory.max").write("2147483648\n")
+    globall = ph.proxy_config.globall
+    # Limited by the open files
+    ph.update_sizing()
+    assert globall.config("maxconn", "9500")
+    assert globall.config("tune.bufsize", "16384")
+    assert globall.config("tune.maxrewrite", "1024")
+    assert ph.get_frontend(80).config("maxconn", "9500")
+
+    # Limited by half the memory of the cgroup
+    tmpdir.join("proc", "sys", "fs", "file-max").write("9223372036854775807\n")
+    ph.charm_config["frontend-maxconn"] = 500
+    ph.update_sizing()
+    assert globall.config("maxconn", "15420")
+    assert ph.get_frontend(80).config("maxconn", "500")
+    assert not ph.get_frontend(80).config("maxconn", "9500")
+    assert ph.get_frontend(81).config("maxconn", "500")
+    ph._runtime = haproxy_runtime.RuntimeAPI(fake_runtime.path)
+    assert ph.status_message() == "maxconn 15420 using up to 1023 MiB"
+
+    # Configured values win, a too large maxrewrite is capped
+    ph.charm_config["maxconn"] = 2000
+    ph.charm_config["tune-bufsize"] = 8192
+    ph.charm_config["tune-maxrewrite"] = 8192
+    ph.update_sizing()
+    assert globall.config("maxconn", "2000")
+    assert globall.config("tune.maxrewrite", "4096")
+
+
 def test_get_config_names(ph, mock_remote_unit, config):
     """Test fetching backend names for related units."""
     config["group_id"] = "test_group"
@@ -104,7 +421,7 @@ def test_process_configs(ph, monkeypatch, config):
     backend = ph.get_backend("rewrite-group", create=False)
     rewrite_found = False
     for cfg in backend.configs():
-        if cfg.keyword.startswith("http-request set-path"):
+        if cfg.keyword == "http-request" and cfg.value.startswith("set-path"):
             rewrite_found = True
     assert rewrite_found
     assert backend.acl("local")
@@ -136,7 +453,7 @@ def test_process_configs(ph, monkeypatch, config):
     assert forward_for_found
     forward_proto_found = False
     for cfg in backend.configs():
-        if "X-Forwarded-Proto https" in cfg.keyword:
+        if "X-Forwarded-Proto https" in cfg.value:
             forward_proto_found = True
     assert forward_proto_found
     ssl_found = False
@@ -159,12 +476,12 @@ def test_process_configs(ph, monkeypatch, config):
 
 def test_get_frontend(ph):
     """Test fetching the frontend."""
-    import pyhaproxy
+    import haproxy_config
 
     assert ph.get_frontend(80, create=False) is None
-    assert not isinstance(ph.get_frontend(80, create=False), pyhaproxy.config.Frontend)
-    assert isinstance(ph.get_frontend(80), pyhaproxy.config.Frontend)
-    assert isinstance(ph.get_frontend(80, create=False), pyhaproxy.config.Frontend)
+    assert not isinstance(ph.get_frontend(80, create=False), haproxy_config.Frontend)
+    assert isinstance(ph.get_frontend(80), haproxy_config.Frontend)
+    assert isinstance(ph.get_frontend(80, create=False), haproxy_config.Frontend)
     assert ph.get_frontend(70).port == "70"
     assert ph.get_frontend(80).port == "80"
     assert ph.get_frontend(90).port == "90"
@@ -172,11 +489,11 @@ def test_get_frontend(ph):
 
 def test_get_backend(ph, monkeypatch, config):
     """Test getting backends."""
-    import pyhaproxy
+    import haproxy_config
 
     # Create and return a new backend
     new_be = ph.get_backend("test-backend")
-    assert isinstance(new_be, pyhaproxy.config.Backend)
+    assert isinstance(new_be, haproxy_config.Backend)
     assert new_be.name == "test-backend"
     assert new_be.configs() == []
     # Retrieve existing backend
@@ -365,6 +682,77 @@ def test_clean_config(ph, monkeypatch, config):
     assert ph.get_backend(backend_3, create=False) is None
 
 
+def test_remove_configs(ph, monkeypatch, config):
+    """Test removing a departed unit's routes."""
+    from charmhelpers.core import unitdata
+
+    monkeypatch.setattr("libhaproxy.hookenv.remote_unit", lambda: "unit-mock/0")
+    ph.process_configs([config])
+    assert "unit-mock/0" in unitdata.kv().get("haproxy.routes")
+    ph.remove_configs([config])
+    assert unitdata.kv().get("haproxy.routes") == {}
+    assert ph.get_frontend(80, create=False) is None
+    assert ph.get_backend("unit-mock-0-0", create=False) is None
+
+
+def test_reconcile_routes(ph, monkeypatch, config):
+    """Test rebuilding the routes from the recorded relation state."""
+    import haproxy_config
+
+    config.update({"proxypass": None, "ssl": None})
+    # Routes added before switching mode are recorded and replaced
+    monkeypatch.setattr("libhaproxy.hookenv.remote_unit", lambda: "unit-mock/0")
+    config["group_id"] = "test-group"
+    assert ph.process_configs([config])["cfg_good"] is True
+    # Servers the charm has no record of are kept
+    ph.get_backend("test-group").add_server(
+        haproxy_config.Server("legacy-unit", "legacy-host", 8000)
+    )
+    ph.charm_config["declarative-routing"] = True
+    monkeypatch.setattr("libhaproxy.hookenv.remote_unit", lambda: "unit-mock/1")
+    assert ph.process_configs([config])["cfg_good"] is True
+    assert ph.process_configs([config])["cfg_good"] is True
+    fe80 = ph.get_frontend(80, create=False)
+    assert len(fe80.usebackends()) == 2
+    assert len(fe80.acls()) == 4
+    backend = ph.get_backend("test-group", create=False)
+    assert [server.name for server in backend.servers()] == [
+        "legacy-unit",
+        "unit-mock-0-0",
+        "unit-mock-1-0",
+    ]
+    # Backend settings aren't duplicated by repeated changes
+    assert len(backend.config_block.lookup("config", "mode")) == 1
+
+    # A conflicting route is reported without dropping the others
+    monkeypatch.setattr("libhaproxy.hookenv.remote_unit", lambda: "unit-mock/2")
+    config["group_id"] = None
+    config["mode"] = "tcp"
+    assert ph.process_configs([config])["cfg_good"] is False
+    assert ph.get_backend("unit-mock-2-0", create=False) is None
+    assert len(ph.get_frontend(80, create=False).usebackends()) == 2
+
+    # Moving a tcp route rebuilds its frontend
+    config["external_port"] = 90
+    assert ph.process_configs([config])["cfg_good"] is True
+    assert ph.process_configs([config])["cfg_good"] is True
+    fe90 = ph.get_frontend(90, create=False)
+    assert len(fe90.config_block.lookup("config", "mode")) == 1
+    config["external_port"] = 91
+    assert ph.process_configs([config])["cfg_good"] is True
+    assert ph.get_frontend(90, create=False) is None
+    assert ph.get_frontend(91, create=False) is not None
+
+    # Departed units are removed with their frontends
+    for unit in ("unit-mock/0", "unit-mock/1", "unit-mock/2"):
+        monkeypatch.setattr("libhaproxy.hookenv.remote_unit", lambda: unit)
+        ph.remove_configs([config])
+    assert ph.get_frontend(80, create=False) is None
+    assert ph.get_frontend(91, create=False) is None
+    backend = ph.get_backend("test-group", create=False)
+    assert [server.name for server in backend.servers()] == ["legacy-unit"]
+
+
 def test_save_config(ph, monkeypatch, config):
     """Test saving the config."""
     import os
@@ -377,6 +765,611 @@ def test_save_config(ph, monkeypatch, config):
     assert initial_time != time2
 
 
+def test_save_config_unchanged(ph, monkeypatch):
+    """Test an unchanged config isn't rewritten or reloaded."""
+    import mock
+
+    reload = mock.Mock()
+    monkeypatch.setattr("libhaproxy.host.service_reload", reload)
+    ph.enable_stats()
+    assert reload.call_count == 1
+    # Same stats config renders the same file
+    mtime = os.stat(ph.proxy_config_file).st_mtime_ns
+    ph.enable_stats()
+    assert reload.call_count == 1
+    assert os.stat(ph.proxy_config_file).st_mtime_ns == mtime
+    # Edits made outside the charm are replaced
+    with open(ph.proxy_config_file, "a") as cfg_file:
+        cfg_file.write("# local edit\n")
+    ph.enable_stats()
+    assert reload.call_count == 2
+    with open(ph.proxy_config_file) as cfg_file:
+        assert "# local edit" not in cfg_file.read()
+
+
+def test_check_config(ph, monkeypatch, config):
+    """Test a config failing haproxy -c isn't written or reloaded."""
+    import mock
+    import subprocess
+
+    checked = []
+    maps = []
+    valid = {"config": False}
+    ports = subprocess.check_output
+
+    def haproxy(command, **kwargs):
+        if command[0] != "haproxy":
+            return ports(command, **kwargs)
+        with open(command[-1]) as candidate:
+            checked.append(candidate.read())
+        maps.append(os.listdir(os.path.join(os.path.dirname(command[-1]), "maps")))
+        if not valid["config"]:
+            raise subprocess.CalledProcessError(1, command, b"[ALERT] parsing error\n")
+
+    reload = mock.Mock()
+    monkeypatch.setattr("libhaproxy.host.service_reload", reload)
+    monkeypatch.setattr("libhaproxy.subprocess.check_output", haproxy)
+    with open(ph.proxy_config_file) as cfg_file:
+        current = cfg_file.read()
+    ph.enable_stats()
+    assert checked[0] != current
+    assert reload.call_count == 0
+    with open(ph.proxy_config_file) as cfg_file:
+        assert cfg_file.read() == current
+    # The candidate is cleaned up and the save retried
+    assert not [
+        name for name in os.listdir(os.path.dirname(ph.proxy_config_file)) if name.startswith(".haproxy-check")
+    ]
+    assert ph.config_error() == "[ALERT] parsing error"
+    valid["config"] = True
+    ph.enable_stats()
+    assert reload.call_count == 1
+    assert ph.config_error() == ""
+    with open(ph.proxy_config_file) as cfg_file:
+        assert cfg_file.read() == checked[-1]
+
+    # Maps are checked from a copy and only replaced once the check passed
+    valid["config"] = False
+    ph.charm_config["map-routing"] = True
+    monkeypatch.setattr("libhaproxy.hookenv.remote_unit", lambda: "unit-mock/0")
+    config["urlbase"] = "/app0"
+    status = ph.process_configs([config])
+    assert status == {"cfg_good": False, "msg": "config check failed: [ALERT] parsing error"}
+    assert sorted(maps[-1]) == ["relation-80-exact.map", "relation-80-path.map"]
+    assert "map_dir({}/".format(ph.map_dir) not in checked[-1]
+    assert not os.path.exists(os.path.join(ph.map_dir, "relation-80-path.map"))
+    assert reload.call_count == 1
+    # The rejected route is dropped along with its map entries
+    assert ph.render_maps() == {}
+    assert ph.get_frontend(80, create=False) is None
+    assert ph.save_config() == "unchanged"
+    valid["config"] = True
+    assert ph.process_configs([config])["cfg_good"] is True
+    assert os.path.exists(os.path.join(ph.map_dir, "relation-80-path.map"))
+    assert ph.config_error() == ""
+
+
+def test_check_config_rollback(ph, monkeypatch, config):
+    """Test the unit state of a rejected config is rolled back with it."""
+    from charmhelpers.core import unitdata
+    import subprocess
+
+    ports = subprocess.check_output
+
+    def haproxy(command, **kwargs):
+        if command[0] != "haproxy":
+            return ports(command, **kwargs)
+        raise subprocess.CalledProcessError(1, command, b"[ALERT] parsing error\n")
+
+    kv = unitdata.kv()
+    ph.charm_config["bind-options"] = "tfo"
+    ph.charm_config["server-slots"] = 4
+    monkeypatch.setattr("libhaproxy.hookenv.remote_unit", lambda: "unit-mock/0")
+    assert ph.process_configs([config])["cfg_good"] is True
+    before = {key: kv.get(key) for key in ("haproxy.slots", "haproxy.bind_options")}
+    monkeypatch.setattr("libhaproxy.subprocess.check_output", haproxy)
+    config["group_id"] = "unit-mock"
+    config["external_port"] = 90
+    config["bind_options"] = "defer-accept"
+    assert ph.process_configs([config])["cfg_good"] is False
+    assert {key: kv.get(key) for key in before} == before
+    assert ph.get_frontend(90, create=False) is None
+
+
+def test_update_seamless_reload(ph):
+    """Test master-worker mode and listener passing follow the version."""
+    # Off by default
+    ph.update_seamless_reload()
+    globall = ph.proxy_config.globall
+    assert not globall.config_block.lookup("config", "master-worker")
+    assert globall.config("stats", "socket /run/haproxy/admin.sock mode 660 level admin")
+    ph.charm_config["seamless-reload"] = True
+    ph.update_seamless_reload()
+    assert globall.config("master-worker", "")
+    assert globall.config(
+        "stats", "socket /run/haproxy/admin.sock mode 660 level admin expose-fd listeners"
+    )
+    assert ph.runtime_socket == "/run/haproxy/admin.sock"
+    # Set only once
+    ph.update_seamless_reload()
+    assert len(globall.config_block.lookup("config", "master-worker")) == 1
+    ph.charm_config["version"] = "1.7"
+    ph.update_seamless_reload()
+    assert not globall.config_block.lookup("config", "master-worker")
+    assert globall.config("stats", "socket /run/haproxy/admin.sock mode 660 level admin")
+
+
+def test_group_after_cache_miss(ph, monkeypatch, config):
+    """Test a group renders the same whether its config was parsed or cached."""
+    def join(unit):
+        monkeypatch.setattr("libhaproxy.hookenv.remote_unit", lambda: unit)
+        assert ph.process_configs([config])["cfg_good"] is True
+
+    config["group_id"] = "test-group"
+    config["rewrite-path"] = True
+    config["urlbase"] = "/mock"
+    join("unit-mock/0")
+    # Force the next unit to be added to a freshly parsed config
+    os.unlink(ph.config_cache_file)
+    ph._proxy_config = None
+    join("unit-mock/1")
+    backend = ph.get_backend("test-group", create=False)
+    assert len(backend.servers()) == 2
+    assert len(backend.config_block.lookup("config", "cookie")) == 1
+    assert len(backend.config_block.lookup("option", "httpchk")) == 1
+    assert len(backend.config_block.lookup("config", "http-request")) == 1
+    with open(ph.proxy_config_file) as cfg_file:
+        parsed = cfg_file.read()
+    # The same units added with the cache in place render the same config
+    ph.remove_configs([config])
+    monkeypatch.setattr("libhaproxy.hookenv.remote_unit", lambda: "unit-mock/0")
+    ph.remove_configs([config])
+    join("unit-mock/0")
+    join("unit-mock/1")
+    with open(ph.proxy_config_file) as cfg_file:
+        assert cfg_file.read() == parsed
+
+
+def test_config_cache(ph, monkeypatch):
+    """Test an unchanged config is loaded from the cache."""
+    import haproxy_config
+    import mock
+
+    ph.proxy_config
+    assert os.stat(ph.config_cache_file).st_mode & 0o777 == 0o600
+    parse = mock.Mock(wraps=haproxy_config.parse)
+    monkeypatch.setattr("libhaproxy.haproxy_config.parse", parse)
+    ph._proxy_config = None
+    assert ph.proxy_config.defaults[0].config_block.first("option", "httplog")
+    # Saving refreshes the cache
+    ph.enable_stats()
+    ph._proxy_config = None
+    assert ph.get_frontend(9000, create=False).name == "stats"
+    assert parse.call_count == 0
+
+    # Edits made outside the charm are parsed
+    with open(ph.proxy_config_file, "a") as cfg_file:
+        cfg_file.write("\nbackend local-edit\n    server local 10.0.0.1:80\n")
+    ph._proxy_config = None
+    assert ph.get_backend("local-edit", create=False) is not None
+    assert parse.call_count == 1
+    # A broken cache is ignored
+    with open(ph.config_cache_file, "wb") as cache_file:
+        cache_file.write(b"broken")
+    ph._proxy_config = None
+    assert ph.get_backend("local-edit", create=False) is not None
+    assert parse.call_count == 2
+
+
+def test_active_status(ph, monkeypatch):
+    """Test the unit status follows the config check, version and reloads."""
+    from charmhelpers.core import unitdata
+    import mock
+
+    status_set = mock.Mock()
+    monkeypatch.setattr("libhaproxy.hookenv.status_set", status_set)
+    monkeypatch.setattr(ph, "sizing_status", lambda: "maxconn 100 using up to 10 MiB")
+    ph.active_status()
+    status_set.assert_called_with("active", "maxconn 100 using up to 10 MiB")
+    unitdata.kv().set("haproxy.reload.pending", True)
+    ph.charm_config["version"] = "1.7"
+    ph.active_status()
+    valid, msg, _ = ph.check_version()
+    status_set.assert_called_with(
+        "active", "{}, reload pending, maxconn 100 using up to 10 MiB".format(msg)
+    )
+    unitdata.kv().set("haproxy.config.error", "[ALERT] parsing error\n[ALERT] fatal")
+    ph.active_status()
+    status_set.assert_called_with("blocked", "Config check failed: [ALERT] parsing error")
+
+
+def test_reload_window(ph, monkeypatch, config):
+    """Test reloads within the reload window are deferred and applied later."""
+    import mock
+
+    now = {"time": 1000.0}
+    reload = mock.Mock()
+    monkeypatch.setattr("libhaproxy.host.service_reload", reload)
+    monkeypatch.setattr("libhaproxy.time.time", lambda: now["time"])
+    ph.charm_config["reload-window"] = 60
+    ph.enable_stats()
+    assert reload.call_count == 1
+    # Changes in the window are written but not loaded
+    for timeout in ("2h", "3h"):
+        now["time"] += 10
+        ph.add_timeout_tunnel(timeout)
+        with open(ph.proxy_config_file) as cfg_file:
+            assert "timeout tunnel {}".format(timeout) in cfg_file.read()
+    assert reload.call_count == 1
+    ph.flush()
+    assert reload.call_count == 1
+    # The relation and the unit hear the reload is still to come
+    monkeypatch.setattr("libhaproxy.hookenv.remote_unit", lambda: "unit-mock/0")
+    assert ph.process_configs([config]) == {"cfg_good": True, "msg": "reload pending"}
+    assert ph.status_message().startswith("reload pending")
+
+    # The first hook after the window applies them
+    now["time"] += 45
+    with ph.transaction():
+        pass
+    assert reload.call_count == 2
+    assert not ph.status_message().startswith("reload pending")
+    with ph.transaction():
+        pass
+    assert reload.call_count == 2
+
+
+def test_save_config_failed_reload(ph, monkeypatch):
+    """Test a failed reload is retried on the next save."""
+    import mock
+
+    reload = mock.Mock(return_value=False)
+    monkeypatch.setattr("libhaproxy.host.service_reload", reload)
+    ph.enable_stats()
+    assert reload.call_count == 1
+    reload.return_value = True
+    ph.enable_stats()
+    assert reload.call_count == 2
+    ph.enable_stats()
+    assert reload.call_count == 2
+
+
+def test_server_slots(ph, monkeypatch, config, fake_runtime):
+    """Test units of a group are bound to server slots without reloading."""
+    import haproxy_runtime
+    import mock
+
+    reload = mock.Mock()
+    monkeypatch.setattr("libhaproxy.host.service_reload", reload)
+    ph.charm_config["server-slots"] = 32
+    ph._runtime = haproxy_runtime.RuntimeAPI(fake_runtime.path)
+    fake_runtime.responses["set server"] = ""
+    config["group_id"] = "unit-mock"
+
+    def join(number):
+        monkeypatch.setattr(
+            "libhaproxy.hookenv.remote_unit", lambda: "unit-mock/{}".format(number)
+        )
+        config["internal_host"] = "10.0.0.{}".format(number)
+        ph.process_configs([config])
+
+    for number in range(5):
+        join(number)
+    assert reload.call_count == 1
+    backend = ph.get_backend("unit-mock", create=False)
+    pool = ph.slot_pool(backend)
+    assert sorted(pool["bound"]) == [1, 2, 3, 4, 5]
+    assert pool["size"] == 32
+    assert fake_runtime.commands[:2] == [
+        "set server unit-mock/slot2 addr 10.0.0.1 port 8000",
+        "set server unit-mock/slot2 state ready",
+    ]
+    frontend = ph.get_frontend(80)
+    assert [acl.name for acl in frontend.acls()] == ["unit-mock", "unit-mock"]
+    assert len(frontend.usebackends()) == 1
+
+    # Growing the pool past 32 units reloads once
+    for number in range(5, 50):
+        join(number)
+    assert reload.call_count == 2
+    assert ph.slot_pool(backend)["size"] == 64
+
+    # Leaving puts a slot in maintenance, rejoining gets it back
+    monkeypatch.setattr("libhaproxy.hookenv.remote_unit", lambda: "unit-mock/3")
+    ph.remove_configs([config])
+    assert fake_runtime.commands[-1] == "set server unit-mock/slot4 state maint"
+    assert 4 in ph.slot_pool(backend)["free"]
+    join(3)
+    assert fake_runtime.commands[-2:] == [
+        "set server unit-mock/slot4 addr 10.0.0.3 port 8000",
+        "set server unit-mock/slot4 state ready",
+    ]
+    assert reload.call_count == 2
+    # One connection to the workers of each reload
+    assert fake_runtime.connections == 2
+
+    # Errors from the runtime API fall back to a reload
+    fake_runtime.responses["set server"] = "No such server.\n"
+    monkeypatch.setattr("libhaproxy.hookenv.remote_unit", lambda: "unit-mock/3")
+    ph.remove_configs([config])
+    assert reload.call_count == 3
+
+    # The last unit leaving removes the backend and its routing
+    for number in range(50):
+        monkeypatch.setattr(
+            "libhaproxy.hookenv.remote_unit", lambda: "unit-mock/{}".format(number)
+        )
+        ph.remove_configs([config])
+    assert ph.get_backend("unit-mock", create=False) is None
+    assert ph.get_frontend(80, create=False) is None
+    ph._proxy_config = None
+    assert ph.get_backend("unit-mock", create=False) is None
+
+
+def test_map_routing(ph, monkeypatch, config, fake_runtime):
+    """Test routes are looked up in map files updated without reloading."""
+    import haproxy_runtime
+    import mock
+
+    reload = mock.Mock()
+    monkeypatch.setattr("libhaproxy.host.service_reload", reload)
+    ph.charm_config["map-routing"] = True
+    ph._runtime = haproxy_runtime.RuntimeAPI(fake_runtime.path)
+    fake_runtime.responses["add map"] = ""
+    fake_runtime.responses["del map"] = ""
+
+    def join(unit, **changes):
+        monkeypatch.setattr("libhaproxy.hookenv.remote_unit", lambda: unit)
+        config.update(changes)
+        ph.process_configs([config])
+
+    join("unit-mock/0", urlbase="/app0")
+    join("unit-mock/1", urlbase="/app1", subdomain="App1")
+    assert reload.call_count == 2
+    frontend = ph.get_frontend(80)
+    assert frontend.acls() == []
+    host_map = os.path.join(ph.map_dir, "relation-80-host.map")
+    exact_map = os.path.join(ph.map_dir, "relation-80-exact.map")
+    path_map = os.path.join(ph.map_dir, "relation-80-path.map")
+    assert [ub.backend_name for ub in frontend.usebackends()] == [
+        "%[req.hdr(host),lower,map_beg({})]".format(host_map),
+        "%[path,map({})]".format(exact_map),
+        "%[path,map_beg({})]".format(path_map),
+    ]
+    with open(exact_map) as map_file:
+        assert map_file.read() == "/app0 unit-mock-0-0\n/app1 unit-mock-1-0\n"
+    with open(path_map) as map_file:
+        assert map_file.read() == "/app0/ unit-mock-0-0\n/app1/ unit-mock-1-0\n"
+    with open(host_map) as map_file:
+        assert map_file.read() == "app1 unit-mock-1-0\n"
+
+    # Changing a route only updates the maps
+    join("unit-mock/0", urlbase="/zero", subdomain=None)
+    assert reload.call_count == 2
+    assert sorted(fake_runtime.commands) == [
+        "add map {} /zero unit-mock-0-0".format(exact_map),
+        "add map {} /zero/ unit-mock-0-0".format(path_map),
+        "del map {} /app0".format(exact_map),
+        "del map {} /app0/".format(path_map),
+    ]
+    with open(path_map) as map_file:
+        assert map_file.read() == "/app1/ unit-mock-1-0\n/zero/ unit-mock-0-0\n"
+
+    # A prefix of another route has to be loaded in order
+    join("unit-mock/0", urlbase="/app1/admin")
+    assert reload.call_count == 3
+    with open(path_map) as map_file:
+        assert map_file.read().startswith("/app1/admin/ unit-mock-0-0\n")
+
+    # Rules of maps left empty are removed with them
+    monkeypatch.setattr("libhaproxy.hookenv.remote_unit", lambda: "unit-mock/1")
+    ph.remove_configs([config])
+    assert [ub.backend_name for ub in frontend.usebackends()] == [
+        "%[path,map({})]".format(exact_map),
+        "%[path,map_beg({})]".format(path_map),
+    ]
+    assert not os.path.exists(host_map)
+    monkeypatch.setattr("libhaproxy.hookenv.remote_unit", lambda: "unit-mock/0")
+    ph.remove_configs([config])
+    assert ph.get_frontend(80, create=False) is None
+    assert not os.path.exists(path_map)
+
+
+def test_map_routing_anchored(ph, monkeypatch, config):
+    """Test a path is only routed by a urlbase it starts with."""
+    ph.charm_config["map-routing"] = True
+
+    def join(unit, urlbase):
+        monkeypatch.setattr("libhaproxy.hookenv.remote_unit", lambda: unit)
+        config["urlbase"] = urlbase
+        ph.process_configs([config])
+
+    join("unit-mock/0", "/admin")
+    join("unit-mock/1", "/appB")
+    frontend = ph.get_frontend(80)
+    maps = {
+        path: [line.split() for line in content.decode("utf-8").splitlines()]
+        for path, content in ph.render_maps().items()
+    }
+
+    def route(request):
+        """Look up the backend like the use_backend rules of the frontend."""
+        for rule in frontend.usebackends():
+            kind, path = rule.backend_name[2:-2].split("(")
+            for key, backend in maps[path]:
+                if kind.endswith("map_beg") and request.startswith(key) or request == key:
+                    return backend
+
+    assert route("/appB/admin/x") == "unit-mock-1-0"
+    assert route("/appB") == "unit-mock-1-0"
+    assert route("/admin/appB") == "unit-mock-0-0"
+    assert route("/administration") is None
+    assert route("/x/admin") is None
+
+
+def test_upgrade_path_maps(ph, monkeypatch, config):
+    """Test map_dir path routes of earlier versions are moved to prefix maps."""
+    from charmhelpers.core import unitdata
+    import haproxy_config
+
+    ph.charm_config["map-routing"] = True
+    monkeypatch.setattr("libhaproxy.hookenv.remote_unit", lambda: "unit-mock/0")
+    config["urlbase"] = "/app0"
+    ph.process_configs([config])
+    frontend = ph.get_frontend(80)
+    path_map = ph.map_path(frontend, "path")
+    for rule in list(frontend.usebackends()):
+        frontend.config_block.remove(rule)
+    fetch = "path,map_dir({})".format(path_map)
+    frontend.add_usebackend(
+        haproxy_config.UseBackend("%[{}]".format(fetch), "if", "{{ {} -m found }}".format(fetch))
+    )
+    unitdata.kv().set("haproxy.maps", {path_map: {"unit-mock-0-0": [["/app0", "unit-mock-0-0"]]}})
+    ph.upgrade_path_maps()
+    assert [ub.backend_name for ub in frontend.usebackends()] == [
+        "%[path,map({})]".format(ph.map_path(frontend, "exact")),
+        "%[path,map_beg({})]".format(path_map),
+    ]
+    with open(path_map) as map_file:
+        assert map_file.read() == "/app0/ unit-mock-0-0\n"
+    # Only once
+    ph.upgrade_path_maps()
+    assert len(frontend.usebackends()) == 2
+
+
+def test_drain_servers(ph, monkeypatch, config, fake_runtime):
+    """Test departing servers are drained before they are removed."""
+    import haproxy_runtime
+    import mock
+
+    ph._runtime = haproxy_runtime.RuntimeAPI(fake_runtime.path)
+    monkeypatch.setattr("libhaproxy.time.sleep", mock.Mock())
+    monkeypatch.setattr("libhaproxy.hookenv.remote_unit", lambda: "unit-mock/0")
+    ph.process_configs([config])
+    fake_runtime.responses["set server"] = ""
+    # Sessions seen by each show stat, from last to first
+    sessions = [0, 2]
+
+    def show_stat(command):
+        count = sessions.pop()
+
+        return (
+            "# pxname,svname,scur,\n"
+            "unit-mock-0-0,unit-mock-0-0,{},\n"
+            "unit-mock-0-0,BACKEND,{},\n".format(count, count)
+        )
+
+    fake_runtime.responses["show stat"] = show_stat
+    assert ph.find_servers("unit-mock/0") == [("unit-mock-0-0", "unit-mock-0-0")]
+    ph.remove_configs([config])
+    assert fake_runtime.commands == [
+        "set server unit-mock-0-0/unit-mock-0-0 state drain",
+        "show stat -1 4 -1",
+        "show stat -1 4 -1",
+    ]
+    assert ph.get_backend("unit-mock-0-0", create=False) is None
+
+    # Servers are removed anyway once the timeout expires
+    ph.process_configs([config])
+    sessions[:] = [3]
+    assert ph.drain_servers(
+        ph.find_servers("unit-mock-0-0/unit-mock-0-0"), timeout=0
+    ) == {"unit-mock-0-0/unit-mock-0-0": 3}
+    assert ph.ready_servers([("unit-mock-0-0", "unit-mock-0-0")])
+    assert fake_runtime.commands[-1] == "set server unit-mock-0-0/unit-mock-0-0 state ready"
+
+    # Without the runtime API servers are removed straight away
+    fake_runtime.server_close()
+    ph._runtime.close()
+    ph.remove_configs([config])
+    assert ph.get_backend("unit-mock-0-0", create=False) is None
+
+
+def test_config_fragments(ph, monkeypatch, config):
+    """Test moving the config to fragment files and back."""
+    import mock
+
+    restart = mock.Mock()
+    monkeypatch.setattr("libhaproxy.host.service_restart", restart)
+    ph.enable_stats()
+    monkeypatch.setattr("libhaproxy.hookenv.remote_unit", lambda: "unit-mock/0")
+    ph.process_configs([config])
+    ph.enable_fragments()
+    assert ph.fragments_active()
+    assert restart.call_count == 1
+    with open(os.path.join(ph.service_dropin_dir, "config-fragments.conf")) as dropin:
+        assert "CONFIG={}".format(ph.proxy_config_dir) in dropin.read()
+    assert sorted(os.listdir(ph.proxy_config_dir)) == [
+        "00-base.cfg",
+        "10-frontends.cfg",
+        "20-stats.cfg",
+        "40-backend-unit-mock-0-0.cfg",
+    ]
+
+    # A relation change only writes the files it touches
+    def mtimes():
+        return {
+            name: os.stat(os.path.join(ph.proxy_config_dir, name)).st_mtime_ns
+            for name in os.listdir(ph.proxy_config_dir)
+        }
+
+    ph._proxy_config = None
+    before = mtimes()
+    monkeypatch.setattr("libhaproxy.hookenv.remote_unit", lambda: "unit-mock/1")
+    ph.process_configs([config])
+    after = mtimes()
+    assert after["00-base.cfg"] == before["00-base.cfg"]
+    assert after["20-stats.cfg"] == before["20-stats.cfg"]
+    assert after["40-backend-unit-mock-0-0.cfg"] == before[
+        "40-backend-unit-mock-0-0.cfg"
+    ]
+    assert after["10-frontends.cfg"] != before["10-frontends.cfg"]
+    assert "40-backend-unit-mock-1-0.cfg" in after
+    ph.clean_config("unit-mock-1-0", "unit-mock-1-0")
+    assert "40-backend-unit-mock-1-0.cfg" not in os.listdir(ph.proxy_config_dir)
+
+    # Merging back gives one file with everything in it
+    ph._proxy_config = None
+    ph.disable_fragments()
+    assert not ph.fragments_active()
+    assert restart.call_count == 2
+    assert os.listdir(ph.proxy_config_dir) == []
+    ph._proxy_config = None
+    assert ph.get_frontend(9000, create=False).name == "stats"
+    assert ph.get_backend("unit-mock-0-0", create=False) is not None
+    assert ph.proxy_config.globall is not None
+
+
+def test_config_fragments_defaults(ph, monkeypatch):
+    """Test a config with several defaults sections stays in one file."""
+    import mock
+
+    restart = mock.Mock()
+    monkeypatch.setattr("libhaproxy.host.service_restart", restart)
+    with open(ph.proxy_config_file) as cfg_file:
+        single = cfg_file.read()
+    with open(ph.proxy_config_file, "a") as cfg_file:
+        cfg_file.write("\ndefaults tcp\n    mode tcp\n\nlisten local 127.0.0.1:6000\n")
+    ph.charm_config["config-fragments"] = True
+    ph.enable_fragments()
+    assert not ph.fragments_active()
+    assert restart.call_count == 0
+    assert "config-fragments needs a single defaults section" in ph.status_message()
+
+    # Defaults added by hand to the fragments block the unit
+    with open(ph.proxy_config_file, "w") as cfg_file:
+        cfg_file.write(single)
+    ph._proxy_config = None
+    ph.enable_fragments()
+    assert ph.fragments_active()
+    with open(os.path.join(ph.proxy_config_dir, "50-local.cfg"), "w") as cfg_file:
+        cfg_file.write("defaults tcp\n    mode tcp\n\nlisten local 127.0.0.1:6000\n")
+    ph._proxy_config = None
+    assert ph.save_config() == "failed"
+    assert ph.config_error() == "config-fragments needs a single defaults section"
+    assert os.path.exists(os.path.join(ph.proxy_config_dir, "50-local.cfg"))
+
+
 def test_update_ports(ph, monkeypatch, config):
     """Test updating opened ports."""
     import sys
@@ -396,9 +1389,12 @@ def test_update_ports(ph, monkeypatch, config):
     ph.get_frontend(80)
     ph.update_ports()
     assert mports.open_ports == "80/tcp\n"
-    # If ports are removed, they get added back
+    # If ports are removed, the next hook adds them back
     mports.open_ports = ""
     ph.update_ports()
+    assert mports.open_ports == ""
+    ph._opened_ports = None
+    ph.update_ports()
     assert mports.open_ports == "80/tcp\n"
     # If a frontend is removed, so is the port
     ph.clean_config(unit_0, backend_0)
@@ -413,6 +1409,42 @@ def test_update_ports(ph, monkeypatch, config):
     assert mports.open_ports == ""
 
 
+def test_update_ports_ranges(ph, monkeypatch):
+    """Test adjacent ports are opened as a range and only changes applied."""
+    import mock
+    import sys
+
+    mports = sys.modules["libhaproxy"].subprocess.check_output
+    mports.open_ports = "90/tcp\n"
+    for port in (8001, 8002, 8003, 90):
+        ph.get_frontend(port)
+    with mock.patch("libhaproxy.subprocess.check_call", wraps=mports) as calls:
+        ph.update_ports()
+        assert [call[0][0] for call in calls.call_args_list] == [
+            ["open-port", "8001-8003/TCP"]
+        ]
+        # Nothing to do, opened-ports isn't run again
+        ph.update_ports()
+        assert calls.call_count == 1
+    # Removing a port from a range reopens the rest of it
+    ph.proxy_config.frontends.remove(ph.get_frontend(8002))
+    with mock.patch("libhaproxy.subprocess.check_call", wraps=mports) as calls:
+        ph.update_ports()
+        assert [call[0][0] for call in calls.call_args_list] == [
+            ["close-port", "8001-8003/TCP"],
+            ["open-port", "8001/TCP"],
+            ["open-port", "8003/TCP"],
+        ]
+    # UPnP forwards are requested per port
+    ph.get_frontend(8002)
+    ph.charm_config["enable-upnp"] = True
+    with mock.patch("libhaproxy.subprocess.check_call", wraps=mports) as calls:
+        ph.update_ports()
+        assert [call[0][0] for call in calls.call_args_list] == [
+            ["open-port", "8002/TCP"]
+        ]
+
+
 def test_merge_letsencrypt_cert(ph, cert):
     """Test merging certbot scripts."""
     assert not os.path.isfile(ph.cert_file)
@@ -492,6 +1524,78 @@ def test_enable_letsencrypt(ph, cert, mock_crontab):
     # assert 'reqirep' in fe443.config_block['configs'][0][0]
 
 
+def test_enable_letsencrypt_2x(ph, cert, mock_crontab):
+    """Test certbot is set up for the 2.x series."""
+    ph.charm_config["version"] = "2.2"
+    ph.enable_letsencrypt()
+    fe443 = ph.get_frontend(443, create=False)
+    assert fe443.binds()[0].attributes == ["ssl crt {} alpn h2,http/1.1".format(ph.cert_file)]
+    # reqirep was removed in 2.1
+    assert not fe443.config_block.lookup("config", "reqirep")
+    assert fe443.config("http-request", "replace-header Destination ^https(.*) http\\1")
+    ph.disable_letsencrypt()
+    assert ph.get_frontend(443, create=False) is None
+
+
+def test_capabilities(ph, monkeypatch):
+    """Test capabilities follow the installed version, or the version config."""
+    import mock
+    import subprocess
+
+    version = mock.Mock(return_value=b"HAProxy version 2.4.22-0ubuntu0.22.04.1 2023/08/14\n")
+    monkeypatch.setattr("libhaproxy.subprocess.check_output", version)
+    assert ph.haproxy_version() == "2.4"
+    assert ph.supports("http2")
+    assert ph.supports("bind-thread")
+    assert not ph.supports("reqrep")
+    assert not ph.supports("ssl-cert-update", "2.0")
+    assert version.call_count == 1
+
+    # Until haproxy is installed
+    version.side_effect = subprocess.CalledProcessError(127, "haproxy")
+    ph.reset_version()
+    ph.charm_config["version"] = "1.8"
+    assert ph.haproxy_version() == "1.8"
+    assert ph.supports("threads")
+    assert ph.supports("reqrep")
+    assert not ph.supports("http2")
+    assert not ph.supports("master-worker", "1.7")
+
+
+def test_server_slots_unsupported(ph, monkeypatch, config):
+    """Test groups get plain servers where haproxy has no server-template."""
+    ph.charm_config["version"] = "1.7"
+    ph.charm_config["server-slots"] = 32
+    assert ph.server_slots() == 0
+    assert "server-slots needs HAProxy 1.8" in ph.status_message()
+    monkeypatch.setattr("libhaproxy.hookenv.remote_unit", lambda: "unit-mock/0")
+    config["group_id"] = "unit-mock"
+    assert ph.process_configs([config])["cfg_good"] is True
+    backend = ph.get_backend("unit-mock", create=False)
+    assert [server.name for server in backend.servers()] == ["unit-mock-0-0"]
+    assert not backend.config_block.lookup("config", "server-template")
+    assert not backend.config_block.lookup("config", "dynamic-cookie-key")
+    ph.charm_config["version"] = "1.8"
+    assert ph.server_slots() == 32
+
+
+def test_check_version(ph, monkeypatch):
+    """Test the versions supported on each series."""
+    series = {"name": "bionic"}
+    monkeypatch.setattr("libhaproxy.host.get_distrib_codename", lambda: series["name"])
+    for version in ("1.8", "1.9", "2.0", "2.2", "2.4"):
+        ph.charm_config["version"] = version
+        assert ph.check_version() == (True, "Version supported", None)
+    series["name"] = "focal"
+    ph.charm_config["version"] = "1.8"
+    valid, msg, fallback = ph.check_version()
+    assert not valid
+    assert "focal" in msg
+    assert fallback == "2.0"
+    series["name"] = "trusty"
+    assert ph.check_version()[0] is False
+
+
 def test_disable_letsencrypt(ph, cert, mock_crontab, monkeypatch, config):
     """Test disabling certbot."""
     # Remove letsencrypt and all unused sections
@@ -535,7 +1639,7 @@ def test_renew_cert(ph, monkeypatch):
     }
     monkeypatch.setattr(ph, "disable_letsencrypt", mocks["disable"])
     monkeypatch.setattr(ph, "enable_letsencrypt", mocks["enable"])
-    monkeypatch.setattr("libhaproxy.letsencrypt.renew", mocks["renew"])
+    monkeypatch.setattr("reactive.letsencrypt.renew", mocks["renew"])
     monkeypatch.setattr(ph, "merge_letsencrypt_cert", mocks["merge"])
     assert mocks["disable"].call_count == 0
     assert mocks["enable"].call_count == 0
@@ -553,6 +1657,108 @@ def test_renew_cert(ph, monkeypatch):
     assert mocks["merge"].call_count == 1
 
 
+def test_update_cert(ph, monkeypatch, fake_runtime):
+    """Test a renewed cert is loaded at runtime, or by a reload."""
+    import haproxy_runtime
+    import mock
+
+    reload = mock.Mock()
+    monkeypatch.setattr("libhaproxy.host.service_reload", reload)
+    monkeypatch.setattr("reactive.letsencrypt.renew", mock.Mock())
+    monkeypatch.setattr(ph, "merge_letsencrypt_cert", mock.Mock())
+    ph._runtime = haproxy_runtime.RuntimeAPI(fake_runtime.path)
+    with open(ph.cert_file, "w") as cert_file:
+        cert_file.write("-----BEGIN CERTIFICATE-----\nMIIB\n\n-----END PRIVATE KEY-----\n")
+    # HAProxy 1.8 can't
+    ph.renew_cert(full=False)
+    assert reload.call_count == 1
+    assert fake_runtime.commands == ["show info"]
+
+    fake_runtime.responses["show info"] = "Name: HAProxy\nVersion: 2.2.9-2\n"
+    fake_runtime.responses["set ssl cert"] = "Transaction created for certificate x!\n"
+    fake_runtime.responses["commit ssl cert"] = "Committing x.\nSuccess!\n"
+    ph.renew_cert(full=False)
+    assert reload.call_count == 1
+    assert fake_runtime.commands[-2:] == [
+        "set ssl cert {} <<\n-----BEGIN CERTIFICATE-----\nMIIB\n"
+        "-----END PRIVATE KEY-----".format(ph.cert_file),
+        "commit ssl cert {}".format(ph.cert_file),
+    ]
+
+    # A failed commit is aborted and haproxy reloaded
+    fake_runtime.responses["commit ssl cert"] = "Committing x.\nFailed!\n"
+    fake_runtime.responses["abort ssl cert"] = "Transaction aborted for certificate x!\n"
+    ph.renew_cert(full=False)
+    assert reload.call_count == 2
+    assert fake_runtime.commands[-1] == "abort ssl cert {}".format(ph.cert_file)
+
+
+def test_renew_ocsp(ph, monkeypatch, fake_runtime):
+    """Test the OCSP response is fetched and loaded at runtime, or by a reload."""
+    import haproxy_runtime
+    import mock
+
+    calls = []
+    status = {"cert": "good"}
+
+    def openssl(command, **kwargs):
+        calls.append(command)
+        if command[1] == "x509":
+            return b"http://ocsp.example/\n"
+        with open(command[command.index("-respout") + 1], "wb") as response:
+            response.write(b"DER")
+        return ": {}\n".format(status["cert"]).encode()
+
+    reload = mock.Mock()
+    monkeypatch.setattr("libhaproxy.host.service_reload", reload)
+    monkeypatch.setattr("libhaproxy.subprocess.check_output", openssl)
+    ph._runtime = haproxy_runtime.RuntimeAPI(fake_runtime.path)
+    fake_runtime.responses["set ssl ocsp-response"] = "OCSP Response updated!\n"
+    assert ph.renew_ocsp()
+    assert calls[1][calls[1].index("-url") + 1] == "http://ocsp.example/"
+    with open(ph.ocsp_file, "rb") as ocsp_file:
+        assert ocsp_file.read() == b"DER"
+    assert fake_runtime.commands == ["set ssl ocsp-response REVS"]
+    assert reload.call_count == 0
+
+    # The configured responder is used instead of the one in the cert
+    ph.charm_config["ocsp-responder"] = "http://responder.example/"
+    calls.clear()
+    # haproxy had no response for the cert, so it is reloaded
+    fake_runtime.responses["set ssl ocsp-response"] = (
+        "OCSP single response: Certificate ID does not match any certificate or issuer.\n"
+    )
+    assert ph.renew_ocsp()
+    assert len(calls) == 1
+    assert calls[0][calls[0].index("-url") + 1] == "http://responder.example/"
+    assert reload.call_count == 1
+
+    # Responses not confirming the cert aren't stapled
+    status["cert"] = "revoked"
+    assert not ph.renew_ocsp()
+    assert len(fake_runtime.commands) == 2
+
+
+def test_disable_ocsp(ph, monkeypatch):
+    """Test disabling stapling removes the response so it can't go stale."""
+    import mock
+
+    reload = mock.Mock()
+    remove_cron = mock.Mock()
+    monkeypatch.setattr("libhaproxy.host.service_reload", reload)
+    monkeypatch.setattr(ph, "remove_ocsp_cron", remove_cron)
+    with open(ph.ocsp_file, "wb") as ocsp_file:
+        ocsp_file.write(b"DER")
+    ph.disable_ocsp()
+    assert not os.path.exists(ph.ocsp_file)
+    assert remove_cron.call_count == 1
+    assert reload.call_count == 1
+    # Nothing to reload without a response
+    ph.disable_ocsp()
+    assert remove_cron.call_count == 2
+    assert reload.call_count == 1
+
+
 def test_renew_upnp(ph):
     """Test renewing upnp port forwards."""
     import mock
@@ -591,3 +1797,132 @@ def test_release_upnp(ph):
     with mock.patch("libhaproxy.subprocess.check_call") as mockports:
         ph.release_upnp()
         assert mockports.call_count == 3
+
+
+def test_transaction(ph, monkeypatch, config):
+    """Test saves are coalesced inside a transaction."""
+    import mock
+
+    reload = mock.Mock()
+    monkeypatch.setattr("libhaproxy.host.service_reload", reload)
+    monkeypatch.setattr("libhaproxy.hookenv.remote_unit", lambda: "unit-mock/0")
+    with ph.transaction():
+        ph.enable_stats()
+        with ph.transaction():
+            ph.enable_redirect()
+        ph.add_timeout_tunnel()
+        assert reload.call_count == 0
+    assert reload.call_count == 1
+    # Nothing pending, nothing to reload
+    with ph.transaction():
+        pass
+    assert reload.call_count == 1
+    # Reload only requests are also deferred
+    with ph.transaction():
+        ph.reload_haproxy()
+        ph.reload_haproxy()
+    assert reload.call_count == 2
+    # Relation changes are applied before their status is reported
+    with ph.transaction():
+        ph.disable_redirect()
+        assert ph.process_configs([config])["cfg_good"] is True
+        assert reload.call_count == 3
+    assert reload.call_count == 3
+
+
+def test_transaction_reload_failed(ph, monkeypatch, config):
+    """Test a failed reload inside a transaction reaches the relation."""
+    monkeypatch.setattr("libhaproxy.host.service_reload", lambda service: False)
+    monkeypatch.setattr("libhaproxy.hookenv.remote_unit", lambda: "unit-mock/0")
+    with ph.transaction():
+        status = ph.process_configs([config])
+    assert status == {"cfg_good": False, "msg": "reload failed"}
+    assert ph.save_config() == "failed"
+
+
+def test_transaction_abort(ph, monkeypatch):
+    """Test pending changes are dropped when a transaction fails."""
+    import mock
+    import pytest
+
+    reload = mock.Mock()
+    monkeypatch.setattr("libhaproxy.host.service_reload", reload)
+    with pytest.raises(ValueError):
+        with ph.transaction():
+            ph.enable_stats()
+            raise ValueError()
+    assert reload.call_count == 0
+    with ph.transaction():
+        pass
+    assert reload.call_count == 0
+
+
+def test_transaction_flush(ph, monkeypatch):
+    """Test flushing applies pending changes inside a transaction."""
+    import mock
+
+    reload = mock.Mock()
+    monkeypatch.setattr("libhaproxy.host.service_reload", reload)
+    with ph.transaction():
+        ph.enable_stats()
+        ph.flush()
+        assert reload.call_count == 1
+        ph.flush()
+        assert reload.call_count == 1
+    assert reload.call_count == 1
+
+
+def test_begin_hook_transaction(ph, monkeypatch):
+    """Test the hook transaction is committed at hook exit."""
+    import mock
+
+    reload = mock.Mock()
+    atexit = mock.Mock()
+    monkeypatch.setattr("libhaproxy.host.service_reload", reload)
+    monkeypatch.setattr("libhaproxy.hookenv.atexit", atexit)
+    ph.begin_hook_transaction()
+    ph.enable_stats()
+    ph.disable_stats()
+    assert reload.call_count == 0
+    atexit.assert_called_once_with(ph.commit)
+    ph.commit()
+    assert reload.call_count == 1
+
+
+def test_hook_log(monkeypatch):
+    """Test log records are filtered and batched."""
+    import mock
+    from libhaproxy import HookLog
+
+    juju_log = mock.Mock()
+    register = mock.Mock()
+    monkeypatch.setattr("libhaproxy.hookenv.log", juju_log)
+    monkeypatch.setattr("libhaproxy.atexit.register", register)
+    log = HookLog("DEBUG")
+    log("first", "DEBUG")
+    log("second", "Info")
+    assert juju_log.call_count == 0
+    assert register.call_args == mock.call(log.flush)
+    # Warnings go out straight away, after what was buffered before them
+    log("careful", "WARN")
+    assert juju_log.call_args_list == [
+        mock.call("DEBUG: first\nsecond", "INFO"),
+        mock.call("careful", "WARNING"),
+    ]
+    log.threshold = "INFO"
+    log("dropped", "DEBUG")
+    log("third", "INFO")
+    log.flush()
+    assert juju_log.call_args == mock.call("third", "INFO")
+    assert juju_log.call_count == 3
+    assert register.call_count == 1
+
+
+def test_runtime(ph, fake_runtime):
+    """Test the runtime client uses the socket from the global section."""
+    assert ph.runtime_socket == "/run/haproxy/admin.sock"
+    stats = ph.proxy_config.globall.config("stats", "socket /run/haproxy/admin.sock mode 660 level admin")
+    stats.value = "socket {} mode 660 level admin".format(fake_runtime.path)
+    assert ph.runtime is ph.runtime
+    assert ph.runtime.show_info()["Name"] == "HAProxy"
+    ph.runtime.close()